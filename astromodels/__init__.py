@@ -11,7 +11,9 @@ from ._version import get_versions
 
 if os.environ.get("ASTROMODELS_DEBUG", None) is None:
 
-    from .core.memoization import use_astromodels_memoization
+    from .core.evaluation_engine import EvaluationEngine
+    from .core.evaluation_grid import EvaluationGrid
+    from .core.memoization import use_astromodels_memoization, use_incremental_evaluation
     from .core.model import Model
     from .core.model_parser import clone_model, load_model
     from .core.parameter import (IndependentVariable, Parameter,
@@ -34,7 +36,7 @@ if os.environ.get("ASTROMODELS_DEBUG", None) is None:
         get_polynomial, Log_uniform_prior, Truncated_gaussian, Uniform_prior,
         TemplateModel, TemplateModelFactory, XSPECTableModel, MissingDataFile,
         Log_parabola, Blackbody, Function1D, Function2D, Function3D,
-        FunctionMeta, ModelAssertionViolation, has_naima, has_gsl,
+        FunctionMeta, ModelAssertionViolation, Synchrotron, has_naima, has_gsl,
         has_ebltable)
 
     if has_ebltable:
@@ -45,16 +47,13 @@ if os.environ.get("ASTROMODELS_DEBUG", None) is None:
 
         from .functions import Cutoff_powerlaw_flux
 
-    if has_naima:
-
-        from .functions import Synchrotron
-
     from .functions.function import get_function_class, list_functions
     from .sources import ExtendedSource, PointSource, ParticleSource
 
 
     astromodels_units = get_units()
-    from astromodels.utils.logging import setup_logger, update_logging_level, silence_warnings, activate_warnings
+
+from astromodels.utils.logging import setup_logger, update_logging_level, silence_warnings, activate_warnings
 
 import astropy.units as u
 
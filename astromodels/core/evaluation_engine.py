@@ -0,0 +1,335 @@
+__author__ = "giacomov"
+
+import concurrent.futures
+import multiprocessing
+import os
+from typing import Any, Callable, List, Optional
+
+import numpy as np
+
+from astromodels.core.evaluation_grid import EvaluationGrid, GridArray
+from astromodels.utils.configuration import numba_policy
+from astromodels.utils.logging import setup_logger
+
+log = setup_logger(__name__)
+
+_EXECUTORS = ("serial", "thread", "process")
+
+# Maximum size (in bytes) of the blocks of results computed at once by the chunked evaluations
+# (see ExtendedSource.evaluate_in_chunks)
+_memory_budget = 256 * 1024 ** 2
+
+
+class InvalidExecutor(ValueError):
+    pass
+
+
+def _as_array(values):
+
+    # Arrays of an EvaluationGrid are kept as they are, so that the data precomputed on the grid can be used
+
+    if isinstance(values, GridArray):
+
+        return values
+
+    return np.array(values, dtype=float, ndmin=1)
+
+
+def _take(array, slices, this_slice):
+
+    # Slicing would detach the array from its grid, so avoid it when there is only one chunk
+
+    return array if len(slices) == 1 else array[this_slice]
+
+
+def get_memory_budget() -> int:
+    """
+    Returns the maximum size (in bytes) of the blocks of results computed at once by chunked evaluations
+
+    :return: number of bytes
+    """
+
+    return _memory_budget
+
+
+def set_memory_budget(n_bytes: int) -> None:
+    """
+    Sets the maximum size (in bytes) of the blocks of results computed at once by chunked evaluations (such as
+    ExtendedSource.evaluate_in_chunks, or an ExtendedSource called with an output array)
+
+    :param n_bytes: number of bytes
+    :return: none
+    """
+
+    global _memory_budget
+
+    if n_bytes < 1:
+
+        log.error("The memory budget must be a positive number of bytes")
+
+        raise AssertionError()
+
+    _memory_budget = int(n_bytes)
+
+
+def get_process_context():
+    """
+    Returns the multiprocessing context used by the process pools of astromodels. A process which used the TBB
+    threading layer of numba (its default choice, when TBB is available) hangs at exit after forking, so the
+    workers are started from a fork server where possible, instead of being forked from the current process
+
+    :return: a multiprocessing context (None for the default one)
+    """
+
+    if "forkserver" in multiprocessing.get_all_start_methods():
+
+        return multiprocessing.get_context("forkserver")
+
+    return None
+
+
+# These need to be module-level functions so that they can be pickled and sent to worker processes
+
+
+def _call_with_serial_kernels(function, *args):
+
+    # The workers of a pool are already parallel, and parallel numba kernels launched from several threads (or
+    # from forked processes) can oversubscribe the CPUs or even deadlock, so the workers use serial kernels
+
+    with numba_policy(parallel=False):
+
+        return function(*args)
+
+
+def _evaluate_point_source(source, energies, tag):
+
+    return np.atleast_1d(source(energies, tag=tag))
+
+
+def _evaluate_extended_source(source, lon, lat, energies):
+
+    # The extended source squeezes its output, so restore the (n_points, n_energies) shape here
+    # to be able to stitch chunks back together
+
+    return np.reshape(source(lon, lat, energies), (lon.shape[0], energies.shape[0]))
+
+
+class EvaluationEngine(object):
+    """
+    Evaluates independent sources (and/or chunks of the input grid) concurrently.
+
+    Results are always assembled in the order of submission, so they are identical to (and as deterministic as)
+    a serial evaluation, whatever the executor.
+
+    :param executor: 'serial' (default, no pool), 'thread' (a thread pool, useful for numba kernels which release
+        the GIL) or 'process' (a process pool, for functions holding the GIL such as XSPEC or pyatomdb wrappers. The
+        workers are started with get_process_context, so the functions and the sources must be importable/picklable)
+    :param n_workers: size of the pool. If None, the number of CPUs is used
+    :param chunk_size: maximum number of energies (point sources) or sky positions (extended sources) per task.
+        If None, each source is a single task
+    """
+
+    def __init__(self, executor: str = "serial", n_workers: Optional[int] = None,
+                 chunk_size: Optional[int] = None):
+
+        if executor not in _EXECUTORS:
+
+            log.error("Executor %s is unknown. Valid executors are: %s" % (executor, ",".join(_EXECUTORS)))
+
+            raise InvalidExecutor()
+
+        if n_workers is None:
+
+            n_workers = os.cpu_count() or 1
+
+        if n_workers < 1:
+
+            log.error("The number of workers must be at least 1")
+
+            raise InvalidExecutor()
+
+        if chunk_size is not None and chunk_size < 1:
+
+            log.error("The chunk size must be a positive integer or None")
+
+            raise InvalidExecutor()
+
+        self._executor: str = executor
+        self._n_workers: int = int(n_workers)
+        self._chunk_size: Optional[int] = chunk_size
+
+        # The pool is created lazily, on first use
+        self._pool = None
+
+    @property
+    def executor(self) -> str:
+        """
+        The kind of executor used ('serial', 'thread' or 'process')
+        """
+
+        return self._executor
+
+    @property
+    def n_workers(self) -> int:
+        """
+        The size of the pool
+        """
+
+        return self._n_workers
+
+    @property
+    def chunk_size(self) -> Optional[int]:
+        """
+        The maximum number of elements of the grid evaluated in a single task (None: no chunking)
+        """
+
+        return self._chunk_size
+
+    def _get_pool(self):
+
+        if self._pool is None:
+
+            if self._executor == "thread":
+
+                self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._n_workers)
+
+            else:
+
+                self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self._n_workers,
+                                                                    mp_context=get_process_context())
+
+        return self._pool
+
+    def map(self, function: Callable, tasks: List[tuple]) -> List[Any]:
+        """
+        Apply function to each tuple of arguments in tasks, returning the results in the same order as the tasks.
+
+        :param function: a callable (a module-level function when using the 'process' executor)
+        :param tasks: a list of tuples of arguments
+        :return: list of results
+        """
+
+        if self._executor == "serial" or len(tasks) <= 1:
+
+            return [function(*task) for task in tasks]
+
+        pool = self._get_pool()
+
+        futures = [pool.submit(_call_with_serial_kernels, function, *task) for task in tasks]
+
+        return [future.result() for future in futures]
+
+    def _split(self, n: int) -> List[slice]:
+
+        if self._chunk_size is None or n <= self._chunk_size:
+
+            return [slice(0, n)]
+
+        return [slice(i, min(i + self._chunk_size, n)) for i in range(0, n, self._chunk_size)]
+
+    def evaluate_point_sources(self, sources, energies: np.ndarray, tag=None) -> np.ndarray:
+        """
+        Evaluate the differential flux of the provided point sources.
+
+        :param sources: a list of PointSource instances
+        :param energies: energies at which the fluxes are needed (or an EvaluationGrid)
+        :param tag: an optional (integration variable, a, b) tuple (see PointSource.__call__)
+        :return: an array with shape (n_sources, n_energies)
+        """
+
+        if isinstance(energies, EvaluationGrid):
+
+            energies = energies.energies
+
+        energies = _as_array(energies)
+
+        slices = self._split(energies.shape[0])
+
+        tasks = [(source, _take(energies, slices, this_slice), tag) for source in sources for this_slice in slices]
+
+        results = self.map(_evaluate_point_source, tasks)
+
+        fluxes = np.empty((len(sources), energies.shape[0]))
+
+        n_slices = len(slices)
+
+        for i, result in enumerate(results):
+
+            fluxes[i // n_slices, slices[i % n_slices]] = result
+
+        return fluxes
+
+    def evaluate_extended_sources(self, sources, lon: np.ndarray, lat: Optional[np.ndarray] = None,
+                                  energies: Optional[np.ndarray] = None) -> List[np.ndarray]:
+        """
+        Evaluate the differential flux of the provided extended sources.
+
+        :param sources: a list of ExtendedSource instances
+        :param lon: longitudes (R.A.) of the sky positions, or an EvaluationGrid with coordinates
+        :param lat: latitudes (Dec.) of the sky positions (not needed if lon is an EvaluationGrid)
+        :param energies: energies at which the fluxes are needed (not needed if lon is an EvaluationGrid)
+        :return: a list with one (squeezed) array with shape (n_points, n_energies) per source
+        """
+
+        if isinstance(lon, EvaluationGrid):
+
+            if not lon.has_coordinates:
+
+                log.error("The evaluation grid %s has no coordinates" % lon.name)
+
+                raise AssertionError()
+
+            lon, lat, energies = lon.ra, lon.dec, lon.energies
+
+        lon = _as_array(lon)
+        lat = _as_array(lat)
+        energies = _as_array(energies)
+
+        slices = self._split(lon.shape[0])
+
+        tasks = [(source, _take(lon, slices, this_slice), _take(lat, slices, this_slice), energies)
+                 for source in sources for this_slice in slices]
+
+        results = self.map(_evaluate_extended_source, tasks)
+
+        n_slices = len(slices)
+
+        fluxes = []
+
+        for i in range(len(sources)):
+
+            fluxes.append(np.squeeze(np.concatenate(results[i * n_slices:(i + 1) * n_slices], axis=0)))
+
+        return fluxes
+
+    def shutdown(self) -> None:
+        """
+        Shut down the pool (if any). It will be re-created if the engine is used again.
+        """
+
+        if self._pool is not None:
+
+            self._pool.shutdown(wait=True)
+
+            self._pool = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+
+        self.shutdown()
+
+    def __getstate__(self):
+
+        # Pools cannot be pickled (which is needed to pickle/deepcopy a Model)
+        state = self.__dict__.copy()
+        state["_pool"] = None
+
+        return state
+
+    def __repr__(self):
+
+        return "EvaluationEngine(executor=%s, n_workers=%s, chunk_size=%s)" % (
+            self._executor, self._n_workers, self._chunk_size)
@@ -0,0 +1,243 @@
+__author__ = "giacomov"
+
+import collections
+from typing import Any, Callable, Hashable, Optional
+
+import numpy as np
+
+from astromodels.core.memoization import _compute_fingerprint
+from astromodels.utils.logging import setup_logger
+
+log = setup_logger(__name__)
+
+# Maximum number of precomputed items kept by each grid. Keys depending on free parameters (like a free redshift)
+# would otherwise make the storage grow without limits
+_MAX_ENTRIES = 256
+
+
+class GridArray(np.ndarray):
+    """
+    A read-only array belonging to an EvaluationGrid. It behaves exactly like a normal array, but functions receiving
+    it can reach the grid to store and retrieve precomputed data (see get_grid_data).
+
+    Arrays derived from it (slices, results of operations...) are not part of the grid anymore.
+    """
+
+    def __new__(cls, values, grid):
+
+        obj = np.array(values, dtype=float, ndmin=1).view(cls)
+
+        obj.flags.writeable = False
+
+        obj._grid = grid
+
+        # The content cannot change, so the fingerprint is computed only once
+        obj._fingerprint = _compute_fingerprint(obj)
+
+        return obj
+
+    def __array_finalize__(self, obj):
+
+        self._grid = None
+        self._fingerprint = None
+
+    def __array_wrap__(self, array, context=None, return_scalar=False):
+
+        # Results of ufuncs are plain arrays
+
+        array = np.asarray(array)
+
+        if return_scalar and array.ndim == 0:
+
+            return array[()]
+
+        return array
+
+    def __reduce__(self):
+
+        # When pickled on its own this is just a normal array
+
+        return np.array, (self.view(np.ndarray),)
+
+    @property
+    def evaluation_grid(self) -> Optional["EvaluationGrid"]:
+        """
+        The grid this array belongs to (None for derived arrays)
+        """
+
+        return self._grid
+
+    @property
+    def fingerprint(self) -> Optional[tuple]:
+        """
+        The fingerprint of the content (see astromodels.core.memoization.array_fingerprint)
+        """
+
+        return self._fingerprint
+
+
+class EvaluationGrid(object):
+    """
+    A fixed set of energies (and optionally of sky coordinates) at which a model is going to be evaluated many
+    times. Functions evaluated on the arrays of the grid can attach to it data which depend only on the grid
+    (like logarithms, sorting indices or interpolated tables), which are then computed only once.
+
+    Instances are usually created with Model.register_grid.
+
+    :param name: name of the grid
+    :param energies: energies of the grid
+    :param ra: (optional) R.A. of the sky positions of the grid
+    :param dec: (optional) Dec. of the sky positions of the grid
+    """
+
+    def __init__(self, name: str, energies: np.ndarray, ra: Optional[np.ndarray] = None,
+                 dec: Optional[np.ndarray] = None):
+
+        if (ra is None) != (dec is None):
+
+            log.error("You have to provide both ra and dec, or none of them")
+
+            raise AssertionError()
+
+        self._name: str = str(name)
+
+        self._energies: GridArray = GridArray(energies, self)
+
+        if ra is not None:
+
+            self._ra: Optional[GridArray] = GridArray(ra, self)
+            self._dec: Optional[GridArray] = GridArray(dec, self)
+
+            if self._ra.shape != self._dec.shape:
+
+                log.error("ra and dec must have the same shape")
+
+                raise AssertionError()
+
+        else:
+
+            self._ra = None
+            self._dec = None
+
+        self._data = collections.OrderedDict()
+
+    @property
+    def name(self) -> str:
+
+        return self._name
+
+    @property
+    def energies(self) -> GridArray:
+        """
+        The energies of the grid (read-only)
+        """
+
+        return self._energies
+
+    @property
+    def ra(self) -> Optional[GridArray]:
+        """
+        The R.A. of the sky positions of the grid (read-only), or None
+        """
+
+        return self._ra
+
+    @property
+    def dec(self) -> Optional[GridArray]:
+        """
+        The Dec. of the sky positions of the grid (read-only), or None
+        """
+
+        return self._dec
+
+    @property
+    def has_coordinates(self) -> bool:
+
+        return self._ra is not None
+
+    def get_data(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        Return the data attached to this grid with the given key, computing them with factory() the first time.
+
+        :param key: a hashable key. It must include everything (besides the grid) the data depend on, for example
+            the name of the function and the value of the parameters used
+        :param factory: a callable without arguments computing the data
+        :return: the data
+        """
+
+        try:
+
+            data = self._data[key]
+
+        except KeyError:
+
+            data = factory()
+
+            self._data[key] = data
+
+            if len(self._data) > _MAX_ENTRIES:
+
+                self._data.popitem(last=False)
+
+        else:
+
+            self._data.move_to_end(key)
+
+        return data
+
+    def clear(self) -> None:
+        """
+        Remove all precomputed data attached to the grid
+
+        :return: none
+        """
+
+        self._data.clear()
+
+    @property
+    def n_entries(self) -> int:
+        """
+        Number of precomputed items currently attached to the grid
+        """
+
+        return len(self._data)
+
+    def __getstate__(self):
+
+        # Precomputed data are not pickled (they can be large, and they are recomputed on demand)
+
+        return {
+            "name": self._name,
+            "energies": self._energies.view(np.ndarray),
+            "ra": None if self._ra is None else self._ra.view(np.ndarray),
+            "dec": None if self._dec is None else self._dec.view(np.ndarray),
+        }
+
+    def __setstate__(self, state):
+
+        self.__init__(state["name"], state["energies"], state["ra"], state["dec"])
+
+    def __repr__(self):
+
+        return "EvaluationGrid(name=%s, n_energies=%i, n_points=%s)" % (
+            self._name, self._energies.shape[0], None if self._ra is None else self._ra.shape[0])
+
+
+def get_grid_data(x: np.ndarray, key: Hashable, factory: Callable[[], Any]) -> Any:
+    """
+    If x is an array of an EvaluationGrid, return the data attached to the grid with the given key (computing
+    them the first time), otherwise just return factory().
+
+    :param x: the input array of a function
+    :param key: key for the data (see EvaluationGrid.get_data)
+    :param factory: a callable without arguments computing the data
+    :return: the data
+    """
+
+    grid = getattr(x, "_grid", None)
+
+    if grid is None:
+
+        return factory()
+
+    return grid.get_data(key, factory)
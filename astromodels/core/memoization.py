@@ -2,11 +2,27 @@ from builtins import range
 import collections
 import functools
 import contextlib
+import itertools
+import weakref
 import astropy.units as u
+import numpy as np
+
+from astromodels.utils.cached_files import get_array_fingerprint
 
 _WITH_MEMOIZATION = False
 _CACHE_SIZE = 20
 
+_WITH_INCREMENTAL_EVALUATION = False
+_N_GRIDS = 4
+
+# Fingerprints of the arrays whose content cannot change, by id, so that they are computed only once per array.
+# They are removed when the arrays are garbage collected
+_immutable_fingerprints = {}
+
+# Global counter used to tag every new state of parameters and functions. Being global, a state version
+# is never reused, not even by different objects
+_state_counter = itertools.count(1)
+
 
 @contextlib.contextmanager
 def use_astromodels_memoization(switch, cache_size=_CACHE_SIZE):
@@ -89,3 +105,174 @@ def memoize(method):
     memoizer.input_object = method
 
     return memoizer
+
+
+def new_state_version():
+    """
+    Returns a new, never used before, state version
+
+    :return: an integer
+    """
+
+    return next(_state_counter)
+
+
+@contextlib.contextmanager
+def use_incremental_evaluation(switch, n_grids=_N_GRIDS):
+    """
+    Activate/deactivate incremental evaluation of sources temporarily. When active, each source keeps the last
+    result computed for each input grid, and returns it without re-evaluating when none of its parameters
+    (including those reached through links and independent variables) changed in the meantime.
+
+    NOTE: the returned arrays are read-only, as they are shared with the cache
+
+    :param switch: True (incremental evaluation on) or False (off)
+    :param n_grids: number of different input grids to remember for each source. Default: 4
+    :return:
+    """
+
+    global _WITH_INCREMENTAL_EVALUATION
+    global _N_GRIDS
+
+    old_status = bool(_WITH_INCREMENTAL_EVALUATION)
+    old_n_grids = int(_N_GRIDS)
+
+    _WITH_INCREMENTAL_EVALUATION = bool(switch)
+    _N_GRIDS = int(n_grids)
+
+    try:
+
+        yield
+
+    finally:
+
+        _WITH_INCREMENTAL_EVALUATION = old_status
+        _N_GRIDS = old_n_grids
+
+
+def is_incremental_evaluation_active():
+
+    return _WITH_INCREMENTAL_EVALUATION
+
+
+def _is_immutable(a):
+
+    # Whether the content of the array cannot change: the array and all the arrays it is a view of are read-only,
+    # and the memory belongs to one of them (or to an immutable object)
+
+    while isinstance(a, np.ndarray):
+
+        if a.flags.writeable:
+
+            return False
+
+        a = a.base
+
+    return a is None or isinstance(a, bytes)
+
+
+def _compute_fingerprint(a):
+
+    # A strong digest (sha224) of the content, computed without copying the array (unless it is not contiguous)
+
+    return a.shape, a.dtype.str, get_array_fingerprint(a)
+
+
+def _get_fingerprint(a):
+
+    # Arrays of an EvaluationGrid are read-only and carry their (precomputed) fingerprint
+
+    fingerprint = getattr(a, "_fingerprint", None)
+
+    if fingerprint is not None:
+
+        return fingerprint
+
+    if not _is_immutable(a):
+
+        return _compute_fingerprint(a)
+
+    key = id(a)
+
+    entry = _immutable_fingerprints.get(key)
+
+    if entry is not None and entry[0]() is a:
+
+        return entry[1]
+
+    fingerprint = _compute_fingerprint(a)
+
+    _immutable_fingerprints[key] = (weakref.ref(a, lambda _: _immutable_fingerprints.pop(key, None)), fingerprint)
+
+    return fingerprint
+
+
+def array_fingerprint(*arrays):
+    """
+    Returns a hashable fingerprint of the content of the provided arrays, which can be used as a key for caches
+    depending on input grids (energies, coordinates...). The fingerprint contains a strong digest of the content,
+    so that different grids do not share the same key. It is computed only once for arrays which cannot change
+    (the arrays of an EvaluationGrid, and read-only arrays owning their memory), and at every call otherwise.
+
+    :param arrays: one or more numpy arrays
+    :return: a tuple
+    """
+
+    return tuple(_get_fingerprint(a) for a in arrays)
+
+
+class EvaluationCache(object):
+    """
+    Keeps the last result computed for each input grid, together with the state it was computed for.
+    Only the most recent grids are kept (see use_incremental_evaluation). The content is not pickled.
+    """
+
+    def __init__(self):
+
+        self._entries = collections.OrderedDict()
+
+    def get(self, grid_key, state):
+        """
+        Return the result for the given grid, if it was computed for the given state, otherwise None
+        """
+
+        entry = self._entries.get(grid_key)
+
+        if entry is None or entry[0] != state:
+
+            return None
+
+        self._entries.move_to_end(grid_key)
+
+        return entry[1]
+
+    def store(self, grid_key, state, result):
+        """
+        Store the result for the given grid and state, and return it as a read-only array
+        """
+
+        result = np.asarray(result)
+
+        result.flags.writeable = False
+
+        self._entries[grid_key] = (state, result)
+
+        self._entries.move_to_end(grid_key)
+
+        while len(self._entries) > max(_N_GRIDS, 1):
+
+            self._entries.popitem(last=False)
+
+        return result
+
+    def clear(self):
+
+        self._entries.clear()
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def __getstate__(self):
+
+        return {"_entries": collections.OrderedDict()}
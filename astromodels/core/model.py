@@ -12,9 +12,13 @@ import numpy as np
 import pandas as pd
 import scipy.integrate
 
+from astromodels.core.evaluation_engine import EvaluationEngine
+from astromodels.core.evaluation_grid import EvaluationGrid
 from astromodels.core.memoization import use_astromodels_memoization
+from astromodels.core.model_hdf5 import save_model_dict
 from astromodels.core.my_yaml import my_yaml
 from astromodels.core.parameter import IndependentVariable, Parameter
+from astromodels.core.spatial_index import SpatialIndex
 from astromodels.core.tree import DuplicatedNode, Node
 from astromodels.functions.function import get_function
 from astromodels.sources.source import (EXTENDED_SOURCE, PARTICLE_SOURCE,
@@ -93,6 +97,18 @@ class Model(Node):
         # This will keep track of independent variables (if any)
         self._independent_variables = {}
 
+        # The engine used to evaluate many sources at once (serial by default)
+        self._evaluation_engine: EvaluationEngine = EvaluationEngine()
+
+        # The registered evaluation grids (see register_grid)
+        self._evaluation_grids: Dict[str, EvaluationGrid] = collections.OrderedDict()
+
+        # Index of the boundaries of the extended sources, built on demand (see spatial_index)
+        self._spatial_index: Optional[SpatialIndex] = None
+
+        # Sources not built yet, when the model has been loaded lazily (see load_model)
+        self._pending_sources = None
+
     def _add_source(
             self, source: Union[PointSource, ExtendedSource,
                                 ParticleSource]) -> None:
@@ -203,6 +219,9 @@ class Model(Node):
 
         :return: dictionary of parameters
         """
+
+        self._materialize_all()
+
         self._update_parameters()
 
         return self._parameters
@@ -215,6 +234,8 @@ class Model(Node):
         :return: dictionary of free parameters
         """
 
+        self._materialize_all()
+
         # Refresh the list
 
         self._update_parameters()
@@ -242,6 +263,8 @@ class Model(Node):
         :return: dictionary of linked parameters
         """
 
+        self._materialize_all()
+
         # Refresh the list
 
         self._update_parameters()
@@ -291,6 +314,8 @@ class Model(Node):
         :return: the parameter
         """
 
+        self._materialize_path(path)
+
         return self._get_child_from_path(path)
 
     def __contains__(self, path: str) -> bool:
@@ -306,6 +331,8 @@ class Model(Node):
 
         try:
 
+            self._materialize_path(path)
+
             _ = self._get_child_from_path(path)
 
         except (AttributeError, KeyError, TypeError):
@@ -316,6 +343,105 @@ class Model(Node):
 
             return True
 
+    def __getattr__(self, name: str):
+
+        # This is called only when the normal lookup fails: sources not built yet are built on first access
+
+        pending_sources = self.__dict__.get("_pending_sources", None)
+
+        if pending_sources is not None and name in pending_sources:
+
+            self.materialize_sources([name])
+
+            return getattr(self, name)
+
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+
+    def _materialize_path(self, path: str) -> None:
+
+        if self._pending_sources is not None:
+
+            # The first element of the path is the name of the source
+
+            source_name = path.split(".")[0]
+
+            if source_name in self._pending_sources:
+
+                self.materialize_sources([source_name])
+
+    def _materialize_all(self) -> None:
+
+        # Queries about the whole model (lists of sources, parameters, fluxes...) need all the sources: the ones not
+        # built yet (see load_model) are built at the first of them, otherwise they would be silently ignored
+
+        if self._pending_sources is not None and len(self._pending_sources) > 0:
+
+            log.info("Building the %i sources of the model which were not built yet" % len(self._pending_sources))
+
+            self.materialize_sources()
+
+    def _set_pending_sources(self, pending_sources) -> None:
+
+        self._pending_sources = pending_sources
+
+    @property
+    def pending_sources(self) -> List[str]:
+        """
+        Returns the names of the sources which have not been built yet, when the model has been loaded lazily
+        (see load_model)
+
+        :return: list of names
+        """
+
+        if self._pending_sources is None:
+
+            return []
+
+        return self._pending_sources.names
+
+    def materialize_sources(self,
+                            names: Optional[Iterable[str]] = None,
+                            j2000_ra: Optional[float] = None,
+                            j2000_dec: Optional[float] = None,
+                            radius: Optional[float] = None) -> List[str]:
+        """
+        Builds the sources not built yet (when the model has been loaded lazily, see load_model) selected by name
+        and/or within a cone (region of interest). Sources linked to the selected ones are built as well. With no
+        selection all the remaining sources are built.
+
+        :param names: names of the sources to build
+        :param j2000_ra: R.A. of the center of the region of interest (deg)
+        :param j2000_dec: Dec. of the center of the region of interest (deg)
+        :param radius: radius of the region of interest (deg)
+        :return: the names of the sources which have been built
+        """
+
+        if self._pending_sources is None:
+
+            return []
+
+        cone = (j2000_ra, j2000_dec, radius)
+
+        if any(x is not None for x in cone) and any(x is None for x in cone):
+
+            log.error("You have to provide j2000_ra, j2000_dec and radius to select sources in a cone")
+
+            raise AssertionError()
+
+        if names is None and radius is None:
+
+            selected = self._pending_sources.names
+
+        else:
+
+            selected = list(names) if names is not None else []
+
+            if radius is not None:
+
+                selected.extend(self._pending_sources.select(j2000_ra, j2000_dec, radius))
+
+        return self._pending_sources.materialize(self, selected)
+
     def __iter__(self):
         """
         This allows the model to be iterated on, like in:
@@ -341,6 +467,9 @@ class Model(Node):
 
         :return: collections.OrderedDict()
         """
+
+        self._materialize_all()
+
         return self._point_sources
 
     @property
@@ -351,6 +480,9 @@ class Model(Node):
         :return: collections.OrderedDict()
 
         """
+
+        self._materialize_all()
+
         return self._extended_sources
 
     @property
@@ -361,6 +493,9 @@ class Model(Node):
         :return: collections.OrderedDict()
 
         """
+
+        self._materialize_all()
+
         return self._particle_sources
 
     @property
@@ -406,6 +541,14 @@ class Model(Node):
         :return: a new Model instance without the source
         """
 
+        if self._pending_sources is not None and source_name in self._pending_sources:
+
+            # Not built yet
+
+            self._pending_sources.discard(source_name)
+
+            return
+
         self.unlink_all_from_source(source_name, warn=True)
 
         self._remove_source(source_name)
@@ -1017,11 +1160,24 @@ class Model(Node):
 
                     raise ModelInternalError("Found an unknown class at the top level")
 
+        # Sources not built yet are kept as they were loaded
+
+        if self._pending_sources is not None:
+
+            data.update(self._pending_sources.get_definitions())
+
         return data
 
-    def save(self, output_file, overwrite=False):
+    def save(self, output_file, overwrite=False, binary=False):
 
-        """Save the model to disk"""
+        """
+        Save the model to disk
+
+        :param output_file: name of the output file
+        :param overwrite: whether to overwrite an existing file (default: False)
+        :param binary: if True, use the binary (HDF5) format, which is much faster to write and read and much more
+        compact than the default YAML format. load_model reads both
+        """
 
         if os.path.exists(output_file) and overwrite is False:
 
@@ -1039,6 +1195,12 @@ class Model(Node):
 
             try:
 
+                if binary:
+
+                    save_model_dict(data, output_file)
+
+                    return
+
                 # Get the YAML representation of the data
 
                 representation = my_yaml.dump(data, default_flow_style=False)
@@ -1063,6 +1225,9 @@ class Model(Node):
 
         :return: number of point sources
         """
+
+        self._materialize_all()
+
         return len(self._point_sources)
 
     def get_point_source_position(self, id) -> Tuple[float]:
@@ -1073,6 +1238,8 @@ class Model(Node):
         :return: a tuple with R.A. and Dec.
         """
 
+        self._materialize_all()
+
         pts = list(self._point_sources.values())[id]
 
         return pts.position.get_ra(), pts.position.get_dec()
@@ -1082,42 +1249,189 @@ class Model(Node):
         Get the fluxes from the id-th point source
 
         :param id: id of the source
-        :param energies: energies at which you need the flux
+        :param energies: energies at which you need the flux (or an EvaluationGrid, see register_grid)
         :param tag: a tuple (integration variable, a, b) specifying the integration to perform. If this
         parameter is specified then the returned value will be the average flux for the source computed as the integral
         between a and b over the integration variable divided by (b-a). The integration variable must be an independent
         variable contained in the model. If b is None, then instead of integrating the integration variable will be
-        set to a and the model evaluated in a.
+        set to a and the model evaluated in a. The integral is computed for all the energies at once, with an
+        adaptive Gauss-Kronrod rule by default, or with the method given as optional fourth element of the tuple
+        ("gauss_kronrod" or "gauss_legendre", see astromodels.utils.integration.integrate_vectorized)
         :return: fluxes
         """
-        
+
+        self._materialize_all()
+
         return list(self._point_sources.values())[id](energies, tag=tag)
 
+    def get_point_source_fluxes_grid(self, id: int, energies: np.ndarray, variables: Dict[Any, np.ndarray]) -> np.ndarray:
+        """
+        Get the fluxes from the id-th point source for many values of one or more independent variables at once,
+        like:
+
+        > cube = model.get_point_source_fluxes_grid(0, energies, {time: times})
+
+        :param id: id of the source
+        :param energies: energies at which you need the flux (or an EvaluationGrid, see register_grid)
+        :param variables: a dictionary with independent variables contained in the model as keys, and 1d arrays
+        of values as items, all with the same length (see PointSource.evaluate_grid)
+        :return: fluxes, with shape (n_values, n_energies)
+        """
+
+        self._materialize_all()
+
+        return list(self._point_sources.values())[id].evaluate_grid(energies, variables)
+
     def get_point_source_name(self, id: int) -> str:
 
+        self._materialize_all()
+
         return list(self._point_sources.values())[id].name
 
+    @property
+    def evaluation_engine(self) -> EvaluationEngine:
+        """
+        The engine used to evaluate many sources at once (see get_all_point_source_fluxes and
+        get_all_extended_source_fluxes). Assign a new EvaluationEngine instance to change the executor, the
+        pool size or the chunking policy, like:
+
+        > model.evaluation_engine = EvaluationEngine("thread", n_workers=32)
+
+        :return: an EvaluationEngine instance
+        """
+
+        return self._evaluation_engine
+
+    @evaluation_engine.setter
+    def evaluation_engine(self, engine: EvaluationEngine) -> None:
+
+        if not isinstance(engine, EvaluationEngine):
+
+            log.error("The evaluation engine must be an instance of EvaluationEngine")
+
+            raise AssertionError()
+
+        self._evaluation_engine.shutdown()
+
+        self._evaluation_engine = engine
+
+    def register_grid(self, name: str, energies: np.ndarray, j2000_ra: Optional[np.ndarray] = None,
+                      j2000_dec: Optional[np.ndarray] = None) -> EvaluationGrid:
+        """
+        Register a fixed grid of energies (and optionally of sky positions) at which the model is going to be
+        evaluated many times (for example during a fit). The returned grid can be used in place of the energies
+        (and positions) in all the get_*_fluxes methods, as well as when calling sources directly. Functions
+        evaluated on it compute their grid-dependent quantities (logarithms, sorting, interpolated
+        cross sections...) only once, instead of at every evaluation.
+
+        :param name: name for the grid. An existing grid with the same name is replaced
+        :param energies: the energies of the grid
+        :param j2000_ra: (optional) R.A. of the sky positions of the grid
+        :param j2000_dec: (optional) Dec. of the sky positions of the grid
+        :return: an EvaluationGrid instance
+        """
+
+        grid = EvaluationGrid(name, energies, j2000_ra, j2000_dec)
+
+        self._evaluation_grids[grid.name] = grid
+
+        return grid
+
+    def get_grid(self, name: str) -> EvaluationGrid:
+        """
+        Return the evaluation grid registered with the given name
+
+        :param name: name of the grid
+        :return: an EvaluationGrid instance
+        """
+
+        if name not in self._evaluation_grids:
+
+            log.error("Evaluation grid %s does not exist" % name)
+
+            raise AssertionError()
+
+        return self._evaluation_grids[name]
+
+    def remove_grid(self, name: str) -> None:
+        """
+        Remove the evaluation grid registered with the given name
+
+        :param name: name of the grid
+        :return: none
+        """
+
+        self.get_grid(name).clear()
+
+        self._evaluation_grids.pop(name)
+
+    @property
+    def evaluation_grids(self) -> Dict[str, EvaluationGrid]:
+        """
+        Returns a dictionary of the registered evaluation grids (see register_grid)
+
+        :return: dictionary of EvaluationGrid instances
+        """
+
+        return self._evaluation_grids
+
+    def get_all_point_source_fluxes(self, energies: np.ndarray, tag=None) -> np.ndarray:
+        """
+        Get the fluxes from all point sources at once, using the evaluation engine of this model
+
+        :param energies: energies at which you need the flux (or an EvaluationGrid, see register_grid)
+        :param tag: an optional tuple (integration variable, a, b), see get_point_source_fluxes
+        :return: an array of fluxes with shape (n_point_sources, n_energies), in the same order as point_sources
+        """
+
+        self._materialize_all()
+
+        return self._evaluation_engine.evaluate_point_sources(list(self._point_sources.values()), energies, tag=tag)
+
     def get_number_of_extended_sources(self) -> int:
         """
         Return the number of extended sources
 
         :return: number of extended sources
         """
+
+        self._materialize_all()
+
         return len(self._extended_sources)
 
-    def get_extended_source_fluxes(self, id: int, j2000_ra: float, j2000_dec: float, energies: np.ndarray) -> np.ndarray:
+    def get_extended_source_fluxes(self, id: int, j2000_ra: float, j2000_dec: Optional[float] = None,
+                                   energies: Optional[np.ndarray] = None) -> np.ndarray:
         """
         Get the flux of the id-th extended sources at the given position at the given energies
 
         :param id: id of the source
-        :param j2000_ra: R.A. where the flux is desired
-        :param j2000_dec: Dec. where the flux is desired
-        :param energies: energies at which the flux is desired
+        :param j2000_ra: R.A. where the flux is desired, or an EvaluationGrid with positions (see register_grid)
+        :param j2000_dec: Dec. where the flux is desired (not needed with an EvaluationGrid)
+        :param energies: energies at which the flux is desired (not needed with an EvaluationGrid)
         :return: flux array
         """
 
+        self._materialize_all()
+
         return list(self._extended_sources.values())[id](j2000_ra, j2000_dec, energies)
 
+    def get_all_extended_source_fluxes(self, j2000_ra: np.ndarray, j2000_dec: Optional[np.ndarray] = None,
+                                       energies: Optional[np.ndarray] = None) -> List[np.ndarray]:
+        """
+        Get the fluxes of all extended sources at the given positions and energies at once, using the evaluation
+        engine of this model
+
+        :param j2000_ra: R.A. where the flux is desired, or an EvaluationGrid with positions (see register_grid)
+        :param j2000_dec: Dec. where the flux is desired (not needed with an EvaluationGrid)
+        :param energies: energies at which the flux is desired (not needed with an EvaluationGrid)
+        :return: a list of flux arrays, in the same order as extended_sources
+        """
+
+        self._materialize_all()
+
+        return self._evaluation_engine.evaluate_extended_sources(
+            list(self._extended_sources.values()), j2000_ra, j2000_dec, energies)
+
     def get_extended_source_name(self, id: int) -> str:
         """
         Return the name of the n-th extended source
@@ -1126,35 +1440,68 @@ class Model(Node):
         :return: the name of the id-th source
         """
 
+        self._materialize_all()
+
         return list(self._extended_sources.values())[id].name
 
     def get_extended_source_boundaries(self, id: int):
 
+        self._materialize_all()
+
         (ra_min, ra_max), (dec_min, dec_max) = list(self._extended_sources.values())[
             id
         ].get_boundaries()
 
         return ra_min, ra_max, dec_min, dec_max
 
-    def is_inside_any_extended_source(self, j2000_ra: float, j2000_dec: float) -> bool:
+    @property
+    def spatial_index(self) -> SpatialIndex:
+        """
+        The index of the boundaries of the extended sources, used for containment queries. It is rebuilt
+        automatically when extended sources are added or removed, or when their spatial parameters change.
+
+        :return: a SpatialIndex instance
+        """
 
-        for ext_source in list(self.extended_sources.values()):
+        self._materialize_all()
 
-            (ra_min, ra_max), (dec_min, dec_max) = ext_source.get_boundaries()
+        sources = list(self._extended_sources.values())
 
-            # Transform from the 0...360 convention to the -180..180 convention, so that
-            # the comparison is easier
-            if ra_min > 180:
+        if self._spatial_index is None or not self._spatial_index.is_up_to_date(sources):
 
-                ra_min = -(360 - ra_min)
+            self._spatial_index = SpatialIndex(sources)
+
+        return self._spatial_index
+
+    def is_inside_any_extended_source(self, j2000_ra: float, j2000_dec: float) -> Union[bool, np.ndarray]:
+        """
+        Check whether the provided position(s) are within the boundaries of any extended source
+
+        :param j2000_ra: R.A. (a float or an array)
+        :param j2000_dec: Dec. (a float or an array)
+        :return: a boolean, or a boolean mask if arrays were provided
+        """
 
-            if ra_min <= j2000_ra <= ra_max and dec_min <= j2000_dec <= dec_max:
+        mask = self.spatial_index.contains(j2000_ra, j2000_dec)
 
-                return True
+        if np.ndim(j2000_ra) == 0:
 
-        # If we are here, it means that no extended source contains the provided coordinates
+            return bool(mask[0])
 
-        return False
+        return mask
+
+    def get_extended_sources_at(self, j2000_ra: np.ndarray,
+                                j2000_dec: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return, for each of the provided positions, the ids of the extended sources whose boundaries contain it
+
+        :param j2000_ra: R.A. of the positions
+        :param j2000_dec: Dec. of the positions
+        :return: a CSR pair (indptr, ids): the ids (as in get_extended_source_fluxes) of the sources containing the
+        position i are ids[indptr[i]:indptr[i + 1]]
+        """
+
+        return self.spatial_index.get_source_ids(j2000_ra, j2000_dec)
 
     def get_number_of_particle_sources(self) -> int:
         """
@@ -1163,6 +1510,8 @@ class Model(Node):
         :return: number of particle sources
         """
 
+        self._materialize_all()
+
         return len(self._particle_sources)
 
     def get_particle_source_fluxes(self, id: int, energies: np.ndarray) -> np.ndarray:
@@ -1174,10 +1523,14 @@ class Model(Node):
         :return: fluxes
         """
 
+        self._materialize_all()
+
         return list(self._particle_sources.values())[id](energies)
 
     def get_particle_source_name(self, id: int) -> str:
 
+        self._materialize_all()
+
         return list(self._particle_sources.values())[id].name
 
     def get_total_flux(self, energies: np.ndarray) -> float:
@@ -1187,10 +1540,6 @@ class Model(Node):
         :return:
         """
 
-        fluxes = []
-
-        for src in self._point_sources:
-
-            fluxes.append(self._point_sources[src](energies))
+        fluxes = self.get_all_point_source_fluxes(energies)
 
         return np.sum(fluxes, axis=0)
@@ -0,0 +1,318 @@
+__author__ = "giacomov"
+
+import collections
+import json
+from typing import Any, Dict, List
+
+import h5py
+import numpy as np
+
+from astromodels.utils.logging import setup_logger
+
+log = setup_logger(__name__)
+
+# Binary (HDF5) representation of the dictionary returned by Model.to_dict_with_types.
+#
+# The structure of the model (sources, components, functions, links...) is stored once, as JSON, with every
+# parameter replaced by a placeholder. The content of the parameters (value, bounds, delta, free flag, units...) is
+# stored in columnar arrays, one element per parameter. Reading the file back gives exactly the same dictionary
+# which would be obtained from the YAML representation.
+
+_FORMAT_NAME = "astromodels model"
+_FORMAT_VERSION = 1
+
+_PLACEHOLDER = "__parameter__"
+_EXTRAS = "__extras__"
+
+# Keys identifying the dictionary of a parameter (or of an independent variable)
+_PARAMETER_KEYS = frozenset(("value", "desc", "min_value", "max_value", "unit"))
+
+# Columns, with the python type of the elements stored in them
+_FLOAT_FIELDS = ("value", "min_value", "max_value", "delta")
+_BOOL_FIELDS = ("is_normalization", "free")
+_STRING_FIELDS = ("desc", "unit")
+
+# (field, type, placeholder used in the column when the element is not stored there)
+_COLUMNS = tuple((field, float, np.nan) for field in _FLOAT_FIELDS) + \
+           tuple((field, bool, False) for field in _BOOL_FIELDS) + \
+           tuple((field, str, -1) for field in _STRING_FIELDS)
+
+# Status of an element of a column
+_IN_COLUMN = 0
+_IS_NONE = 1
+_IN_EXTRAS = 2
+
+
+class ModelHDF5Error(RuntimeError):
+    pass
+
+
+def _is_parameter(data) -> bool:
+
+    return isinstance(data, dict) and _PARAMETER_KEYS.issubset(data.keys())
+
+
+class _Encoder(object):
+
+    def __init__(self):
+
+        self._layouts: List[tuple] = []
+        self._layout_ids: Dict[tuple, int] = {}
+
+        self._strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+
+        self.columns = collections.defaultdict(list)
+
+    def _get_id(self, item, items, ids):
+
+        try:
+
+            return ids[item]
+
+        except KeyError:
+
+            ids[item] = len(items)
+            items.append(item)
+
+            return ids[item]
+
+    def _encode_parameter(self, data):
+
+        columns = self.columns
+
+        parameter_id = len(columns["layout"])
+
+        layout = tuple(data.keys())
+
+        columns["layout"].append(self._get_id(layout, self._layouts, self._layout_ids))
+
+        placeholder = collections.OrderedDict([(_PLACEHOLDER, parameter_id)])
+
+        extras = collections.OrderedDict()
+
+        for field, expected_type, default in _COLUMNS:
+
+            value = data.get(field, None)
+
+            if field not in data or value is None:
+
+                status = _IS_NONE
+
+                stored = default
+
+            elif type(value) is expected_type:
+
+                status = _IN_COLUMN
+
+                stored = self._get_id(value, self._strings, self._string_ids) if expected_type is str else value
+
+            else:
+
+                # Anything else (for example the "f(variable)" value of linked parameters) goes in the structure
+
+                status = _IN_EXTRAS
+
+                stored = default
+
+                extras[field] = value
+
+            columns[field].append(stored)
+            columns["%s_status" % field].append(status)
+
+        if extras:
+
+            placeholder[_EXTRAS] = extras
+
+        # Everything else (laws of linked parameters, priors...) is part of the structure
+
+        for key, value in data.items():
+
+            if key not in _FLOAT_FIELDS and key not in _BOOL_FIELDS and key not in _STRING_FIELDS:
+
+                placeholder[key] = self.encode(value)
+
+        return placeholder
+
+    def encode(self, data):
+
+        if _is_parameter(data):
+
+            return self._encode_parameter(data)
+
+        elif isinstance(data, dict):
+
+            return collections.OrderedDict((key, self.encode(value)) for key, value in data.items())
+
+        elif isinstance(data, list):
+
+            return [self.encode(value) for value in data]
+
+        elif data is None or type(data) in (str, float, int, bool):
+
+            return data
+
+        else:
+
+            log.error("Cannot store an object of type %s in the binary format" % type(data))
+
+            raise ModelHDF5Error()
+
+    @property
+    def header(self) -> Dict[str, Any]:
+
+        return {"layouts": [list(layout) for layout in self._layouts], "strings": self._strings}
+
+
+class _Decoder(object):
+
+    def __init__(self, header, columns):
+
+        self._layouts = [tuple(layout) for layout in header["layouts"]]
+        self._strings = header["strings"]
+
+        # Lists are much faster than arrays to access element by element
+        self._columns = {name: column.tolist() for name, column in columns.items()}
+
+    def _decode_parameter(self, placeholder):
+
+        i = placeholder[_PLACEHOLDER]
+
+        columns = self._columns
+
+        extras = placeholder.get(_EXTRAS, {})
+
+        data = collections.OrderedDict()
+
+        for key in self._layouts[columns["layout"][i]]:
+
+            if key in placeholder:
+
+                data[key] = self.decode(placeholder[key])
+
+                continue
+
+            status = columns["%s_status" % key][i]
+
+            if status == _IN_COLUMN:
+
+                value = columns[key][i]
+
+                data[key] = self._strings[value] if key in _STRING_FIELDS else value
+
+            elif status == _IS_NONE:
+
+                data[key] = None
+
+            else:
+
+                data[key] = extras[key]
+
+        return data
+
+    def decode(self, data):
+
+        if isinstance(data, dict):
+
+            if _PLACEHOLDER in data:
+
+                return self._decode_parameter(data)
+
+            return collections.OrderedDict((key, self.decode(value)) for key, value in data.items())
+
+        elif isinstance(data, list):
+
+            return [self.decode(value) for value in data]
+
+        return data
+
+
+def save_model_dict(model_dict, filename) -> None:
+    """
+    Save the dictionary representation of a model (see Model.to_dict_with_types) in the binary (HDF5) format
+
+    :param model_dict: the dictionary
+    :param filename: output file
+    :return: none
+    """
+
+    encoder = _Encoder()
+
+    structure = encoder.encode(model_dict)
+
+    document = json.dumps({"header": encoder.header, "structure": structure}).encode("utf-8")
+
+    with h5py.File(filename, "w") as f:
+
+        f.attrs["format"] = _FORMAT_NAME
+        f.attrs["version"] = _FORMAT_VERSION
+
+        f.create_dataset("structure", data=np.frombuffer(document, dtype=np.uint8))
+
+        group = f.create_group("parameters")
+
+        for field in _FLOAT_FIELDS:
+
+            group.create_dataset(field, data=np.array(encoder.columns[field], dtype=np.float64))
+
+        for field in _BOOL_FIELDS:
+
+            group.create_dataset(field, data=np.array(encoder.columns[field], dtype=bool))
+
+        for field in _STRING_FIELDS + ("layout",):
+
+            group.create_dataset(field, data=np.array(encoder.columns[field], dtype=np.int32))
+
+        for field in _FLOAT_FIELDS + _BOOL_FIELDS + _STRING_FIELDS:
+
+            group.create_dataset("%s_status" % field,
+                                 data=np.array(encoder.columns["%s_status" % field], dtype=np.uint8))
+
+
+def load_model_dict(filename) -> Dict[str, Any]:
+    """
+    Read the dictionary representation of a model from a file in the binary (HDF5) format
+
+    :param filename: input file
+    :return: the dictionary (identical to the one returned by Model.to_dict_with_types when the model was saved)
+    """
+
+    with h5py.File(filename, "r") as f:
+
+        if f.attrs.get("format", None) != _FORMAT_NAME:
+
+            log.error("File %s does not contain an astromodels model" % filename)
+
+            raise ModelHDF5Error()
+
+        if f.attrs["version"] > _FORMAT_VERSION:
+
+            log.error("File %s was written by a more recent version of astromodels" % filename)
+
+            raise ModelHDF5Error()
+
+        document = json.loads(f["structure"][()].tobytes().decode("utf-8"),
+                              object_pairs_hook=collections.OrderedDict)
+
+        columns = {name: dataset[()] for name, dataset in f["parameters"].items()}
+
+    decoder = _Decoder(document["header"], columns)
+
+    return decoder.decode(document["structure"])
+
+
+def is_binary_model_file(filename) -> bool:
+    """
+    Whether the provided file is in the binary (HDF5) format
+
+    :param filename: a file name
+    :return: True or False
+    """
+
+    try:
+
+        return h5py.is_hdf5(filename)
+
+    except (IOError, OSError):
+
+        return False
@@ -2,16 +2,27 @@ from builtins import object, str
 
 __author__ = "giacomov"
 
+import collections
+import copy
+import copyreg
+import io
+import itertools
+import pickle
 import re
 import warnings
 
+import numpy as np
+
 from astromodels.core import (model, parameter, polarization, sky_direction,
                               spectral_component)
+from astromodels.core.model_hdf5 import is_binary_model_file, load_model_dict
 from astromodels.core.my_yaml import my_yaml
+from astromodels.core.tree import Node
 from astromodels.functions import function
 from astromodels.sources import extended_source, particle_source, point_source
 from astromodels.sources.source import (EXTENDED_SOURCE, PARTICLE_SOURCE,
                                         POINT_SOURCE)
+from astromodels.utils.angular_distance import angular_distance
 from astromodels.utils.logging import setup_logger
 
 log = setup_logger(__name__)
@@ -29,28 +40,54 @@ class ModelSyntaxError(RuntimeError):
     pass
 
 
-def load_model(filename):
+def load_model(filename, lazy=False):
     """
     Load a model from a file.
 
+    With lazy=True the sources are not built when loading, but only when they are first accessed (for example as
+    model.source_name, or through a path like model["source_name.spectrum.main..."]), or when they are selected with
+    Model.materialize_sources (by name, or with a cone around a position). Queries about the whole model (its
+    sources, parameters, number of sources, fluxes of all the sources...) build all the remaining sources first.
+    Sources not built yet are kept as they are when saving the model. Links are resolved when the source containing
+    the linked parameter is built, building also the sources it depends on.
+
     :param filename: the name of the file containing the model
+    :param lazy: whether to build the sources on demand (default: False)
     :return: an instance of a Model
     """
 
-    parser = ModelParser(filename)
+    parser = ModelParser(filename, lazy=lazy)
 
     return parser.get_model()
 
 
-def clone_model(model_instance):
+def clone_model(model_instance, share_assets=True):
     """
     Returns a copy of the given model with all objects cloned. This is equivalent to saving the model to
     a file and reload it, but it doesn't require writing or reading to/from disk. The original model is not touched.
 
+    By default only the state of the model (parameters, links, free flags...) is copied, while the large immutable
+    data of the functions (template tables and interpolators, maps, cross sections...) are shared with the original,
+    so cloning is very fast even for big models. With share_assets=False the model is re-built from scratch from
+    its dictionary representation, like load_model does.
+
     :param model: model to be cloned
+    :param share_assets: whether to share the immutable data of the functions with the original model (default: True)
     :return: a cloned copy of the given model
     """
 
+    if share_assets:
+
+        try:
+
+            return _clone_sharing_assets(model_instance)
+
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+
+            # Some function holds something that cannot be copied: re-build the model instead
+
+            log.debug("Cannot clone the model sharing its assets (%s). Re-building it." % e)
+
     data = model_instance.to_dict_with_types()
 
     parser = ModelParser(model_dict=data)
@@ -58,13 +95,384 @@ def clone_model(model_instance):
     return parser.get_model()
 
 
+# Assets shared by the models being cloned right now (see _clone_sharing_assets), by clone id
+_shared_assets = {}
+_clone_counter = itertools.count()
+
+
+def _get_shared_asset(clone_id, asset_id):
+
+    return _shared_assets[clone_id][asset_id]
+
+
+class _SharedAssetReference(object):
+
+    # Stands in for a shared asset in the pickled state of a function, and becomes the asset itself when unpickled
+
+    def __init__(self, clone_id, asset_id):
+
+        self._clone_id = clone_id
+        self._asset_id = asset_id
+
+    def __reduce__(self):
+
+        return _get_shared_asset, (self._clone_id, self._asset_id)
+
+
+class _CloningPickler(pickle.Pickler):
+
+    def __init__(self, file, clone_id):
+
+        super(_CloningPickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self._clone_id = clone_id
+
+        self._shared = _shared_assets[clone_id]
+
+        # Pickle the model as any other node of the tree, instead of through its dictionary representation
+        # (see serialization.py)
+        self.dispatch_table = copyreg.dispatch_table.copy()
+        self.dispatch_table[model.Model] = Node.__reduce__
+
+    def reducer_override(self, obj):
+
+        if isinstance(obj, function.Function) and obj._shared_attributes:
+
+            reduced = obj.__reduce__()
+
+            state = dict(reduced[2]["__dict__"])
+
+            for attribute in obj._shared_attributes:
+
+                value = state.get(attribute, None)
+
+                if value is not None:
+
+                    self._shared[id(value)] = value
+
+                    state[attribute] = _SharedAssetReference(self._clone_id, id(value))
+
+            reduced[2]["__dict__"] = state
+
+            return reduced
+
+        if isinstance(obj, parameter.ParameterBase):
+
+            # Callbacks are not part of the model (they are not saved either), so clones start without them
+
+            reduced = obj.__reduce__()
+
+            reduced[2]["__dict__"] = dict(reduced[2]["__dict__"], _callbacks=[])
+
+            return reduced
+
+        return NotImplemented
+
+
+def _clone_sharing_assets(model_instance):
+
+    clone_id = next(_clone_counter)
+
+    _shared_assets[clone_id] = {}
+
+    try:
+
+        buffer = io.BytesIO()
+
+        _CloningPickler(buffer, clone_id).dump(model_instance)
+
+        return pickle.loads(buffer.getvalue())
+
+    finally:
+
+        _shared_assets.pop(clone_id)
+
+
+def _get_source_name(source_name_with_type):
+
+    return source_name_with_type.split()[0]
+
+
+def _apply_links(new_model, links):
+
+    for link in links:
+
+        path = link["parameter_path"]
+        variable = link["variable"]
+        law = link["law"]
+
+        new_model[path].add_auxiliary_variable(new_model[variable], law)
+
+
+def _apply_extra_setups(new_model, extra_setups):
+
+    for extra_setup in extra_setups:
+
+        path = extra_setup["function_path"]
+
+        for property, value in list(extra_setup["extra_setup"].items()):
+
+            # First, check to see if the we have a valid path in the new model.
+            # If we aren't given a path, interpret it as being given a value.
+            if value in new_model:
+                new_model[path].__setattr__(property, new_model[value])
+            else:
+                new_model[path].__setattr__(property, value)
+
+
+class PendingSources(object):
+    """
+    The sources of a model loaded lazily (see load_model) which have not been built yet, kept as their definitions
+    """
+
+    def __init__(self):
+
+        # Definitions by name of the source, with the name including the type as key in the model dictionary
+        self._definitions = collections.OrderedDict()
+
+    def add(self, source_name_with_type, definition):
+
+        self._definitions[_get_source_name(source_name_with_type)] = (source_name_with_type, definition)
+
+    def discard(self, source_name):
+
+        self._definitions.pop(source_name, None)
+
+    def __contains__(self, source_name):
+
+        return source_name in self._definitions
+
+    def __len__(self):
+
+        return len(self._definitions)
+
+    @property
+    def names(self):
+
+        return list(self._definitions.keys())
+
+    def get_definitions(self):
+        """
+        Returns the definitions of the sources, as in the dictionary representation of a model
+
+        :return: an ordered dictionary
+        """
+
+        return collections.OrderedDict(
+            (name_with_type, copy.deepcopy(definition)) for name_with_type, definition in self._definitions.values()
+        )
+
+    def select(self, j2000_ra, j2000_dec, radius):
+        """
+        Returns the names of the sources which might be within the given distance from a position. The test
+        uses the position of point sources and the boundaries of extended sources, and it is conservative: sources
+        whose position cannot be known without building them (e.g., with linked coordinates) are always selected.
+        Particle sources are never selected.
+
+        :param j2000_ra: R.A. of the center of the cone (deg)
+        :param j2000_dec: Dec. of the center of the cone (deg)
+        :param radius: radius of the cone (deg)
+        :return: list of names
+        """
+
+        selected = []
+
+        for name, (name_with_type, definition) in self._definitions.items():
+
+            if name_with_type.find("(%s)" % POINT_SOURCE) > 0:
+
+                position = _get_position(definition.get("position", {}))
+
+                if position is None or angular_distance(j2000_ra, j2000_dec, *position) <= radius:
+
+                    selected.append(name)
+
+            elif name_with_type.find("(%s)" % EXTENDED_SOURCE) > 0:
+
+                if _boundaries_overlap(_get_boundaries(name, definition), j2000_ra, j2000_dec, radius):
+
+                    selected.append(name)
+
+        return selected
+
+    def materialize(self, new_model, source_names):
+        """
+        Builds the sources with the given names, together with the sources their links depend on, and adds them
+        to the model. Names which are not pending are ignored.
+
+        :param new_model: the model the sources belong to
+        :param source_names: list of names
+        :return: the names of the sources which have been built
+        """
+
+        parsers = []
+
+        # The sources are added in the order of the definitions (like when the model is not loaded lazily), since
+        # the ids of the sources (see Model.get_point_source_fluxes) depend on it
+        order = {name: i for i, name in enumerate(self._definitions)}
+
+        to_build = list(source_names)
+
+        while to_build:
+
+            source_name = to_build.pop()
+
+            if source_name not in self._definitions:
+
+                continue
+
+            name_with_type, definition = self._definitions.pop(source_name)
+
+            # The parsers modify the definitions, which must stay intact for saving the model
+            this_parser = SourceParser(name_with_type, copy.deepcopy(definition))
+
+            parsers.append((order[source_name], this_parser))
+
+            # The linked variables must exist before the links are set up
+
+            for link in this_parser.links:
+
+                to_build.append(str(link["variable"]).split(".")[0])
+
+            for extra_setup in this_parser.extra_setups:
+
+                to_build.extend(str(value).split(".")[0] for value in extra_setup["extra_setup"].values())
+
+        parsers = [this_parser for _, this_parser in sorted(parsers, key=lambda x: x[0])]
+
+        for this_parser in parsers:
+
+            new_model._add_source(this_parser.get_source())
+
+        new_model._update_parameters()
+
+        for this_parser in parsers:
+
+            _apply_links(new_model, this_parser.links)
+
+            _apply_extra_setups(new_model, this_parser.extra_setups)
+
+        return [this_parser.get_source().name for this_parser in parsers]
+
+
+def _get_coordinate(definition):
+
+    # Coordinates which are linked (like "f(...)") are not known before building the source
+
+    try:
+
+        return float(definition["value"])
+
+    except (KeyError, TypeError, ValueError):
+
+        return None
+
+
+def _get_position(position_definition):
+
+    # Returns (R.A., Dec.) from the definition of the position of a point source, or None if unknown
+
+    if "ra" in position_definition and "dec" in position_definition:
+
+        ra = _get_coordinate(position_definition["ra"])
+        dec = _get_coordinate(position_definition["dec"])
+
+        if ra is None or dec is None:
+
+            return None
+
+        return ra, dec
+
+    if "l" in position_definition and "b" in position_definition:
+
+        l = _get_coordinate(position_definition["l"])
+        b = _get_coordinate(position_definition["b"])
+
+        if l is None or b is None:
+
+            return None
+
+        this_sky_direction = sky_direction.SkyDirection(l=l, b=b)
+
+        return this_sky_direction.get_ra(), this_sky_direction.get_dec()
+
+    return None
+
+
+def _get_boundaries(source_name, ext_source_definition):
+
+    # Builds only the spatial shape of the extended source, to get its boundaries
+
+    name_of_spatial_shape = list(ext_source_definition.keys())[0]
+
+    spatial_shape_parser = ShapeParser(source_name)
+
+    try:
+
+        spatial_shape = spatial_shape_parser.parse(
+            "n.a.",
+            name_of_spatial_shape,
+            copy.deepcopy(ext_source_definition[name_of_spatial_shape]),
+            is_spatial=True,
+        )
+
+    except ModelSyntaxError:  # pragma: no cover
+
+        return None
+
+    if spatial_shape_parser.links:
+
+        # The shape depends on other parameters, so its boundaries are not known yet
+
+        return None
+
+    return spatial_shape.get_boundaries()
+
+
+def _boundaries_overlap(boundaries, j2000_ra, j2000_dec, radius):
+
+    # Conservative test: whether the cone might overlap the box (min. R.A., max. R.A.), (min. Dec., max. Dec.)
+
+    if boundaries is None:
+
+        return True
+
+    (ra_min, ra_max), (dec_min, dec_max) = boundaries
+
+    if j2000_dec + radius < dec_min or j2000_dec - radius > dec_max:
+
+        return False
+
+    if ra_max - ra_min >= 360.0:
+
+        return True
+
+    # Maximum difference in R.A. between a point in the cone and its center
+
+    max_dec = min(abs(j2000_dec) + radius, 90.0)
+
+    if max_dec >= 90.0:
+
+        return True
+
+    delta_ra = np.rad2deg(np.arcsin(min(np.sin(np.deg2rad(radius)) / np.cos(np.deg2rad(max_dec)), 1.0)))
+
+    width = (ra_max - ra_min) % 360.0
+
+    distance = (j2000_ra - ra_min) % 360.0
+
+    # Either the center is within the R.A. range, or it is within delta_ra from one of its edges
+
+    return distance <= width + delta_ra or 360.0 - distance <= delta_ra
+
+
 def model_unpickler(state):
 
     return ModelParser(model_dict=state).get_model()
 
 
 class ModelParser(object):
-    def __init__(self, model_file=None, model_dict=None):
+    def __init__(self, model_file=None, model_dict=None, lazy=False):
 
         assert (model_file is not None) or (model_dict is not None), (
             "You have to provide either a model file or a" "model dictionary"
@@ -76,9 +484,15 @@ class ModelParser(object):
 
             try:
 
-                with open(model_file) as f:
+                if is_binary_model_file(model_file):
+
+                    self._model_dict = load_model_dict(model_file)
 
-                    self._model_dict = my_yaml.load(f, Loader=my_yaml.FullLoader)
+                else:
+
+                    with open(model_file) as f:
+
+                        self._model_dict = my_yaml.load(f, Loader=my_yaml.FullLoader)
 
             except IOError:
 
@@ -97,6 +511,9 @@ class ModelParser(object):
 
             self._model_dict = model_dict
 
+        # Whether to build the sources on demand (see load_model)
+        self._lazy = lazy
+
         self._parse()
 
     def _parse(self):
@@ -111,6 +528,7 @@ class ModelParser(object):
         self._links = []
         self._external_parameter_links = []
         self._extra_setups = []
+        self._pending_sources = PendingSources()
 
         for source_or_var_name, source_or_var_definition in list(
             self._model_dict.items()
@@ -145,6 +563,10 @@ class ModelParser(object):
                 self._links.extend(this_parser.links)
             #                self._external_parameter_links.extend(this_parser.links)
 
+            elif self._lazy:
+
+                self._pending_sources.add(source_or_var_name, source_or_var_definition)
+
             else:
 
                 this_parser = SourceParser(source_or_var_name, source_or_var_definition)
@@ -180,30 +602,20 @@ class ModelParser(object):
 
             new_model.add_external_parameter(parameter)
 
-        # Now set up the links
-
-        for link in self._links:
-
-            path = link["parameter_path"]
-            variable = link["variable"]
-            law = link["law"]
+        # The sources not built yet (if any) are built on demand by the model. Links to their parameters
+        # build them as soon as they are set up
 
-            new_model[path].add_auxiliary_variable(new_model[variable], law)
+        if len(self._pending_sources) > 0:
 
-        # Finally the extra_setups (if any)
+            new_model._set_pending_sources(self._pending_sources)
 
-        for extra_setup in self._extra_setups:
+        # Now set up the links
 
-            path = extra_setup["function_path"]
+        _apply_links(new_model, self._links)
 
-            for property, value in list(extra_setup["extra_setup"].items()):
+        # Finally the extra_setups (if any)
 
-                # First, check to see if the we have a valid path in the new model.
-                # If we aren't given a path, interpret it as being given a value.
-                if value in new_model:
-                    new_model[path].__setattr__(property, new_model[value])
-                else:
-                    new_model[path].__setattr__(property, value)
+        _apply_extra_setups(new_model, self._extra_setups)
 
         return new_model
 
@@ -17,6 +17,7 @@ import astropy.units as u
 import numpy as np
 import scipy.stats
 
+from astromodels.core.memoization import new_state_version
 from astromodels.core.parameter_transformation import ParameterTransformation
 from astromodels.utils.logging import setup_logger
 
@@ -176,6 +177,10 @@ class ParameterBase(Node):
         # We start from a empty list of callbacks.
         self._callbacks = []
 
+        # The state version changes every time the value changes. It is used by the incremental evaluation
+        # of sources to know whether a result computed earlier is still valid
+        self._version: int = new_state_version()
+
         # Assign to members
 
         # Store the units as an astropy.units.Unit instance
@@ -382,6 +387,23 @@ class ParameterBase(Node):
 
             return new_quantity.value
 
+    @property
+    def state_version(self):
+        """
+        Returns a hashable token which changes every time the value of this parameter might have changed,
+        also through links (the auxiliary variable and the parameters of the law)
+
+        :return: the state version
+        """
+
+        if self._aux_variable:
+
+            law = self._aux_variable["law"]
+
+            return (self._version, self._aux_variable["variable"].state_version, law.state_version)
+
+        return self._version
+
     def has_auxiliary_variable(self) -> bool:
 
         if self._aux_variable:
@@ -504,6 +526,8 @@ class ParameterBase(Node):
             # Update
             self._internal_value = new_internal_value
 
+            self._version = new_state_version()
+
             # Call the callbacks (if any)
             for callback in self._callbacks:
 
@@ -554,6 +578,8 @@ class ParameterBase(Node):
 
             self._internal_value = new_internal_value
 
+            self._version = new_state_version()
+
             # Call callbacks if any
 
             for callback in self._callbacks:
@@ -1208,6 +1234,8 @@ class Parameter(ParameterBase):
         self._aux_variable["law"] = law
         self._aux_variable["variable"] = variable
 
+        self._version = new_state_version()
+
         # Now add the law as an attribute
         # so the user will be able to access its parameters as this.name.parameter_name
 
@@ -1250,6 +1278,8 @@ class Parameter(ParameterBase):
 
             self._aux_variable = {}
 
+            self._version = new_state_version()
+
             # Set the parameter to the status it has before the auxiliary variable was created
 
             self.free = self._old_free
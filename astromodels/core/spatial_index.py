@@ -0,0 +1,221 @@
+__author__ = "giacomov"
+
+from typing import Tuple
+
+import numpy as np
+
+from astromodels.utils.logging import setup_logger
+
+log = setup_logger(__name__)
+
+
+# Width of the declination bands used to bucket the sources, and number of points tested at once (the memory used
+# by a query is proportional to the number of points in a chunk times the number of candidates per point)
+_DEC_BAND_WIDTH = 1.0
+_N_POINTS_PER_CHUNK = 65536
+
+
+def _expand_ranges(starts, counts):
+
+    # Concatenation of the ranges [start, start + count) (vectorized)
+
+    total = int(np.sum(counts))
+
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    return np.repeat(starts, counts) + offsets
+
+
+def _get_spatial_key(source) -> tuple:
+
+    # The boundaries of a shape depend on the values of its parameters and, for some shapes, on their bounds
+    # (e.g. the Gaussian is truncated at twice the maximum sigma allowed)
+
+    shape = source.spatial_shape
+
+    return (shape.state_version,
+            tuple((p.min_value, p.max_value) for p in shape.parameters.values()))
+
+
+class SpatialIndex(object):
+    """
+    An index of the bounding boxes (from get_boundaries) of a list of extended sources, allowing vectorized
+    containment queries. R.A. intervals crossing 0 (i.e., with minimum larger than maximum) are handled correctly.
+
+    The sources are bucketed in declination bands, so that each point is tested only against the sources
+    overlapping its band.
+
+    The index knows whether it is out of date (see is_up_to_date), for example after a change of the position
+    or of the size of a source.
+
+    :param sources: list of ExtendedSource instances
+    """
+
+    def __init__(self, sources):
+
+        self._sources = list(sources)
+
+        self._keys = [_get_spatial_key(source) for source in self._sources]
+
+        n_sources = len(self._sources)
+
+        self._ra_min = np.zeros(n_sources)
+        self._ra_max = np.zeros(n_sources)
+        self._dec_min = np.zeros(n_sources)
+        self._dec_max = np.zeros(n_sources)
+
+        for i, source in enumerate(self._sources):
+
+            (ra_min, ra_max), (dec_min, dec_max) = source.get_boundaries()
+
+            if ra_max - ra_min >= 360.0:
+
+                # The whole R.A. range
+
+                ra_min, ra_max = 0.0, 360.0
+
+            else:
+
+                ra_min, ra_max = ra_min % 360.0, ra_max % 360.0
+
+            self._ra_min[i] = ra_min
+            self._ra_max[i] = ra_max
+            self._dec_min[i] = dec_min
+            self._dec_max[i] = dec_max
+
+        self._wraps = self._ra_min > self._ra_max
+
+        # The sources overlapping each declination band, as a CSR pair (the sources of the band i are
+        # self._band_sources[self._band_indptr[i]:self._band_indptr[i + 1]], in increasing order)
+
+        self._n_bands = int(np.ceil(180.0 / _DEC_BAND_WIDTH))
+
+        first_band = self._get_band(self._dec_min)
+        n_bands_per_source = self._get_band(self._dec_max) - first_band + 1
+
+        bands = _expand_ranges(first_band, n_bands_per_source)
+        sources = np.repeat(np.arange(n_sources), n_bands_per_source)
+
+        order = np.lexsort((sources, bands))
+
+        self._band_sources = sources[order]
+
+        self._band_indptr = np.zeros(self._n_bands + 1, dtype=np.int64)
+
+        np.cumsum(np.bincount(bands, minlength=self._n_bands), out=self._band_indptr[1:])
+
+    def _get_band(self, dec):
+
+        band = np.floor((np.asarray(dec) + 90.0) / _DEC_BAND_WIDTH).astype(np.int64)
+
+        return np.clip(band, 0, self._n_bands - 1)
+
+    @property
+    def n_sources(self) -> int:
+
+        return len(self._sources)
+
+    def is_up_to_date(self, sources) -> bool:
+        """
+        Whether this index is still valid for the provided list of sources (same sources, in the same order, with
+        unchanged spatial parameters)
+
+        :param sources: list of ExtendedSource instances
+        :return: True or False
+        """
+
+        sources = list(sources)
+
+        if len(sources) != len(self._sources):
+
+            return False
+
+        for source, indexed_source, key in zip(sources, self._sources, self._keys):
+
+            if source is not indexed_source or _get_spatial_key(source) != key:
+
+                return False
+
+        return True
+
+    def _get_chunk_source_ids(self, ra, dec):
+
+        # All the pairs (point, candidate source) of this chunk, with the candidates of the band of each point
+
+        band = self._get_band(dec)
+
+        n_candidates = self._band_indptr[band + 1] - self._band_indptr[band]
+
+        points = np.repeat(np.arange(ra.shape[0]), n_candidates)
+        candidates = self._band_sources[_expand_ranges(self._band_indptr[band], n_candidates)]
+
+        point_ra = ra[points]
+        point_dec = dec[points]
+
+        above_min = point_ra >= self._ra_min[candidates]
+        below_max = point_ra <= self._ra_max[candidates]
+
+        # For intervals crossing R.A. = 0 one of the two conditions is enough
+        in_ra = np.where(self._wraps[candidates], above_min | below_max, above_min & below_max)
+
+        in_dec = (point_dec >= self._dec_min[candidates]) & (point_dec <= self._dec_max[candidates])
+
+        inside = in_ra & in_dec
+
+        # The pairs are sorted by point, and then by source
+        return np.bincount(points[inside], minlength=ra.shape[0]), candidates[inside]
+
+    def get_source_ids(self, ra: np.ndarray, dec: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns, for each point, the ids (positions in the list of sources) of the sources containing it, as a CSR
+        pair (indptr, ids): the ids of the sources containing the point i are ids[indptr[i]:indptr[i + 1]], in
+        increasing order
+
+        :param ra: R.A. of the points (any convention, 0..360 or -180..180)
+        :param dec: Dec. of the points
+        :return: (indptr, ids), with indptr of length n_points + 1
+        """
+
+        ra = np.array(ra, dtype=float, ndmin=1) % 360.0
+        dec = np.array(dec, dtype=float, ndmin=1)
+
+        if ra.shape != dec.shape or ra.ndim != 1:
+
+            log.error("ra and dec must be 1d arrays with the same shape")
+
+            raise AssertionError()
+
+        n_points = ra.shape[0]
+
+        indptr = np.zeros(n_points + 1, dtype=np.int64)
+
+        ids = []
+
+        for start in range(0, n_points, _N_POINTS_PER_CHUNK):
+
+            stop = min(start + _N_POINTS_PER_CHUNK, n_points)
+
+            counts, chunk_ids = self._get_chunk_source_ids(ra[start:stop], dec[start:stop])
+
+            indptr[start + 1:stop + 1] = counts
+
+            ids.append(chunk_ids)
+
+        np.cumsum(indptr, out=indptr)
+
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+
+        return indptr, ids
+
+    def contains(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        """
+        Returns a boolean mask, True for the points within the boundaries of at least one source
+
+        :param ra: R.A. of the points
+        :param dec: Dec. of the points
+        :return: boolean array with the same length as ra
+        """
+
+        indptr, _ = self.get_source_ids(ra, dec)
+
+        return np.diff(indptr) > 0
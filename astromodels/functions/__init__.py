@@ -4,10 +4,8 @@ from .functions_1D import (
     has_ebltable, has_gsl, has_naima, Band, Band_Calderone, Band_grbm,
     Broken_powerlaw, Cutoff_powerlaw, Inverse_cutoff_powerlaw, Powerlaw,
     Powerlaw_Eflux, Powerlaw_flux, SmoothlyBrokenPowerLaw, Quartic,
-    get_polynomial, Super_cutoff_powerlaw, PhAbs, TbAbs, WAbs, has_atomdb)
-
-if has_naima:
-    from .functions_1D import Synchrotron
+    get_polynomial, Super_cutoff_powerlaw, PhAbs, TbAbs, WAbs, has_atomdb,
+    Synchrotron)
 
 if has_gsl:
 
@@ -18,7 +16,7 @@ if has_ebltable:
 
 if has_atomdb:
 
-    from .apec import APEC, VAPEC
+    from .functions_1D import APEC, VAPEC
 
 from .dark_matter.dm_models import DMFitFunction, DMSpectra
 
@@ -36,7 +34,8 @@ from .functions_3D import (Continuous_injection_diffusion,
 from .priors import (Cauchy, Cosine_Prior, Gaussian, Log_normal,
                      Log_uniform_prior, Truncated_gaussian, Uniform_prior)
 from .template_model import (MissingDataFile, TemplateModel,
-                             TemplateModelFactory, XSPECTableModel)
+                             TemplateModelFactory, XSPECTableModel,
+                             convert_hdf_template)
 
 __all__ = [
     "Band", "Band_Calderone", "Band_grbm", "Broken_powerlaw",
@@ -52,8 +51,9 @@ __all__ = [
     "DMFitFunction", "Cauchy", "Cosine_Prior", "Gaussian", "Log_normal",
     "Log_uniform_prior", "Truncated_gaussian", "Uniform_prior",
     "TemplateModel", "TemplateModelFactory", "XSPECTableModel",
-    "MissingDataFile", "Log_parabola", "Blackbody", "Function1D", "Function2D",
-    "Function3D", "FunctionMeta", "ModelAssertionViolation", "Quartic", "get_polynomial"
+    "convert_hdf_template", "MissingDataFile", "Log_parabola", "Blackbody", "Function1D", "Function2D",
+    "Function3D", "FunctionMeta", "ModelAssertionViolation", "Quartic", "get_polynomial",
+    "Synchrotron"
 ]
 
 if has_atomdb:
@@ -63,10 +63,6 @@ if has_gsl:
 
     __all__.extend(["Cutoff_powerlaw_flux"])
 
-if has_naima:
-
-    __all__.extend(["Synchrotron"])
-
 if has_ebltable:
 
     __all__.extend(["EBLattenuation"])
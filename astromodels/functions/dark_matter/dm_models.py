@@ -1,18 +1,235 @@
 from __future__ import print_function
 
+import functools
+
 import astropy.units as astropy_units
 import numpy as np
 import six
-from scipy.interpolate import RegularGridInterpolator
 
+from astromodels.functions import numba_functions as nb_func
 from astromodels.functions.function import Function1D, FunctionMeta
+from astromodels.utils.cached_files import get_file_key, load_cached_array
 from astromodels.utils.data_files import _get_data_file_path
 from astromodels.utils.logging import setup_logger
 
 log = setup_logger(__name__)
 
+"""
+    Mapping between the channel codes and the rows in the gammamc file
+    dmSpecTab.npy created to match this mapping too
+
+    1 : 8, # ee
+    2 : 6, # mumu
+    3 : 3, # tautau
+    4 : 1, # bb
+    5 : 2, # tt
+    6 : 7, # gg
+    7 : 4, # ww
+    8 : 5, # zz
+    9 : 0, # cc
+    10 : 10, # uu
+    11 : 11, # dd
+    12 : 9, # ss
+"""
+
+_channel_index_mapping = {
+    1: 8,  # ee
+    2: 6,  # mumu
+    3: 3,  # tautau
+    4: 1,  # bb
+    5: 2,  # tt
+    6: 7,  # gg
+    7: 4,  # ww
+    8: 5,  # zz
+    9: 0,  # cc
+    10: 10,  # uu
+    11: 11,  # dd
+    12: 9,  # ss
+}
+
+# Number of decades in x = log10(E/M)
+_ndec = 10.0
+_xedge = np.linspace(0, 1.0, 251)
+_x = 0.5 * (_xedge[1:] + _xedge[:-1]) * _ndec - _ndec
+
+# These are the mass points of the Fermi tables (gammamc_dif.dat) in GeV
+_mass_f = np.array(
+    [
+        2.0,
+        4.0,
+        6.0,
+        8.0,
+        10.0,
+        25.0,
+        50.0,
+        80.3,
+        91.2,
+        100.0,
+        150.0,
+        176.0,
+        200.0,
+        250.0,
+        350.0,
+        500.0,
+        750.0,
+        1000.0,
+        1500.0,
+        2000.0,
+        3000.0,
+        5000.0,
+        7000.0,
+        1e4,
+    ]
+)
+
+# These are the mass points of the HAWC tables (dmSpecTab.npy) in GeV
+_mass_h = np.array(
+    [
+        50.0,
+        61.2,
+        74.91,
+        91.69,
+        112.22,
+        137.36,
+        168.12,
+        205.78,
+        251.87,
+        308.29,
+        377.34,
+        461.86,
+        565.31,
+        691.93,
+        846.91,
+        1036.6,
+        1268.78,
+        1552.97,
+        1900.82,
+        2326.57,
+        2847.69,
+        3485.53,
+        4266.23,
+        5221.81,
+        6391.41,
+        7823.0,
+        9575.23,
+        11719.94,
+        14345.03,
+        17558.1,
+        21490.85,
+        26304.48,
+        32196.3,
+        39407.79,
+        48234.54,
+        59038.36,
+        72262.07,
+        88447.7,
+        108258.66,
+        132506.99,
+        162186.57,
+        198513.95,
+        242978.11,
+        297401.58,
+        364015.09,
+        445549.04,
+        545345.37,
+        667494.6,
+        817003.43,
+        1000000.0,
+    ]
+)
+
+for _array in (_x, _mass_f, _mass_h):
+
+    _array.flags.writeable = False
+
+
+def _read_fermi_table():
+
+    return np.loadtxt(_get_data_file_path("dark_matter/gammamc_dif.dat")).reshape((12, len(_mass_f), len(_x)))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_dn_table(name):
+    """
+    Returns the masses, the x = log10(E/M) and the spectra dN/dx[channel, mass, x] of a table of spectra: "fermi"
+    (2 GeV < m_DM < 10 TeV) or "combined" (the Fermi spectra, and above 10 TeV the HAWC spectra up to 1 PeV).
+    The tables are converted once to binary files in the cache directory, which are memory-mapped, so they are
+    shared by all the instances (and all the processes)
+    """
+
+    tablepath_f = _get_data_file_path("dark_matter/gammamc_dif.dat")
+
+    if name == "fermi":
+
+        return _mass_f, _x, load_cached_array(tablepath_f, "dn_table", _read_fermi_table)
+
+    elif name == "combined":
+
+        tablepath_h = _get_data_file_path("dark_matter/dmSpecTab.npy")
+
+        mass = np.append(_mass_f, _mass_h[27:])
+
+        mass.flags.writeable = False
+
+        def _read_combined_table():
+
+            dn = np.zeros((12, len(mass), len(_x)))
+            dn[:, 0:24, :] = _read_fermi_table()
+            dn[:, 24:, :] = np.load(tablepath_h)[:, 27:, :]
+
+            return dn
+
+        # The combined table depends on both the files
+
+        dn = load_cached_array(tablepath_h, "combined_dn_table_%s" % get_file_key(tablepath_f), _read_combined_table)
+
+        return mass, _x, dn
+
+    else:
+
+        log.error("Unknown table of dark matter spectra %s" % name)
+
+        raise AssertionError()
+
+
+def _interpolate_dn(table, mass, channel, xm):
+
+    # dN/dx for the channel at the mass, for all the x = log10(E/M) at once (0 above the mass)
 
-class DMFitFunction(Function1D, metaclass=FunctionMeta):
+    mass_nodes, x_nodes, dn = _get_dn_table(table)
+
+    xm = np.asarray(xm, dtype=float)
+
+    dn = nb_func.dm_spectrum_eval(mass_nodes, x_nodes, dn[_channel_index_mapping[int(channel)]],
+                                  float(mass), xm.reshape(-1))
+
+    return dn.reshape(xm.shape)
+
+
+class _DMSpectraTable(object):
+
+    # The table of spectra is never stored in the instances, so that all the instances, their clones and the
+    # unpickled copies use the same memory-mapped table (see _get_dn_table)
+
+    _dn_table_name = None
+
+    @property
+    def _mass(self):
+
+        return _get_dn_table(self._dn_table_name)[0]
+
+    @property
+    def _x(self):
+
+        return _get_dn_table(self._dn_table_name)[1]
+
+    @property
+    def _dn(self):
+
+        return _get_dn_table(self._dn_table_name)[2]
+
+
+class DMFitFunction(_DMSpectraTable, Function1D, metaclass=FunctionMeta):
     r"""
     description :
 
@@ -49,88 +266,12 @@ class DMFitFunction(Function1D, metaclass=FunctionMeta):
             fix : yes
     """
 
-    def _setup(self):
+    _dn_table_name = "fermi"
 
-        tablepath = _get_data_file_path("dark_matter/gammamc_dif.dat")
-
-        self._data = np.loadtxt(tablepath)
-
-        """
-            Mapping between the channel codes and the rows in the gammamc file
-
-            1 : 8, # ee
-            2 : 6, # mumu
-            3 : 3, # tautau
-            4 : 1, # bb
-            5 : 2, # tt
-            6 : 7, # gg
-            7 : 4, # ww
-            8 : 5, # zz
-            9 : 0, # cc
-            10 : 10, # uu
-            11 : 11, # dd
-            12 : 9, # ss
-        """
-
-        channel_index_mapping = {
-            1: 8,  # ee
-            2: 6,  # mumu
-            3: 3,  # tautau
-            4: 1,  # bb
-            5: 2,  # tt
-            6: 7,  # gg
-            7: 4,  # ww
-            8: 5,  # zz
-            9: 0,  # cc
-            10: 10,  # uu
-            11: 11,  # dd
-            12: 9,  # ss
-        }
+    def _setup(self):
 
-        # Number of decades in x = log10(E/M)
-        ndec = 10.0
-        xedge = np.linspace(0, 1.0, 251)
-        self._x = 0.5 * (xedge[1:] + xedge[:-1]) * ndec - ndec
-
-        ichan = channel_index_mapping[int(self.channel.value)]
-
-        # These are the mass points
-        self._mass = np.array(
-            [
-                2.0,
-                4.0,
-                6.0,
-                8.0,
-                10.0,
-                25.0,
-                50.0,
-                80.3,
-                91.2,
-                100.0,
-                150.0,
-                176.0,
-                200.0,
-                250.0,
-                350.0,
-                500.0,
-                750.0,
-                1000.0,
-                1500.0,
-                2000.0,
-                3000.0,
-                5000.0,
-                7000.0,
-                1e4,
-            ]
-        )
-        self._dn = self._data.reshape((12, 24, 250))
-
-        self._dn_interp = RegularGridInterpolator(
-            [self._mass, self._x],
-            self._dn[ichan, :, :],
-            bounds_error=False,
-            fill_value=None,
-        )
+        # The table is read only once (see _get_dn_table) and the spectrum is interpolated at evaluation time for the
+        # current channel and mass
 
         if self.mass.value > 10000:
 
@@ -177,7 +318,8 @@ class DMFitFunction(Function1D, metaclass=FunctionMeta):
         if isinstance(x, astropy_units.Quantity):
 
             # We need to convert to GeV
-            xx = x.to(astropy_units.GeV)
+            xx = x.to_value(astropy_units.GeV)
+            mass_value = mass.to_value(astropy_units.GeV)
 
         else:
 
@@ -187,18 +329,18 @@ class DMFitFunction(Function1D, metaclass=FunctionMeta):
 
             # xm expects gamma ray energies in MeV
             xx = np.multiply(x, keVtoGeV)
+            mass_value = mass
 
-        xm = np.log10(np.divide(xx, mass))
+        xm = np.log10(np.divide(xx, mass_value))
         phip = (
             1.0 / (8.0 * np.pi) * np.power(mass, -2) * (sigmav * J)
         )  # units of this should be 1 / cm**2 / s
-        dn = self._dn_interp((mass, xm))
-        dn[xm > 0] = 0
+        dn = _interpolate_dn(self._dn_table_name, mass_value, channel, xm)
 
         return np.multiply(phip, np.divide(dn, x))
 
 
-class DMSpectra(Function1D, metaclass=FunctionMeta):
+class DMSpectra(_DMSpectraTable, Function1D, metaclass=FunctionMeta):
     r"""
     description :
 
@@ -237,159 +379,12 @@ class DMSpectra(Function1D, metaclass=FunctionMeta):
             fix : yes
     """
 
-    def _setup(self):
-
-        # Get and open the two data files
+    _dn_table_name = "combined"
 
-        tablepath_h = _get_data_file_path("dark_matter/dmSpecTab.npy")
-        self._data_h = np.load(tablepath_h)
-
-        tablepath_f = _get_data_file_path("dark_matter/gammamc_dif.dat")
-        self._data_f = np.loadtxt(tablepath_f)
-
-        """
-            Mapping between the channel codes and the rows in the gammamc file
-            dmSpecTab.npy created to match this mapping too
-
-            1 : 8, # ee
-            2 : 6, # mumu
-            3 : 3, # tautau
-            4 : 1, # bb
-            5 : 2, # tt
-            6 : 7, # gg
-            7 : 4, # ww
-            8 : 5, # zz
-            9 : 0, # cc
-            10 : 10, # uu
-            11 : 11, # dd
-            12 : 9, # ss
-            """
-
-        channel_index_mapping = {
-            1: 8,  # ee
-            2: 6,  # mumu
-            3: 3,  # tautau
-            4: 1,  # bb
-            5: 2,  # tt
-            6: 7,  # gg
-            7: 4,  # ww
-            8: 5,  # zz
-            9: 0,  # cc
-            10: 10,  # uu
-            11: 11,  # dd
-            12: 9,  # ss
-        }
+    def _setup(self):
 
-        # Number of decades in x = log10(E/M)
-        ndec = 10.0
-        xedge = np.linspace(0, 1.0, 251)
-        self._x = 0.5 * (xedge[1:] + xedge[:-1]) * ndec - ndec
-
-        ichan = channel_index_mapping[int(self.channel.value)]
-
-        # These are the mass points in GeV
-        self._mass_h = np.array(
-            [
-                50.0,
-                61.2,
-                74.91,
-                91.69,
-                112.22,
-                137.36,
-                168.12,
-                205.78,
-                251.87,
-                308.29,
-                377.34,
-                461.86,
-                565.31,
-                691.93,
-                846.91,
-                1036.6,
-                1268.78,
-                1552.97,
-                1900.82,
-                2326.57,
-                2847.69,
-                3485.53,
-                4266.23,
-                5221.81,
-                6391.41,
-                7823.0,
-                9575.23,
-                11719.94,
-                14345.03,
-                17558.1,
-                21490.85,
-                26304.48,
-                32196.3,
-                39407.79,
-                48234.54,
-                59038.36,
-                72262.07,
-                88447.7,
-                108258.66,
-                132506.99,
-                162186.57,
-                198513.95,
-                242978.11,
-                297401.58,
-                364015.09,
-                445549.04,
-                545345.37,
-                667494.6,
-                817003.43,
-                1000000.0,
-            ]
-        )
-
-        # These are the mass points in GeV
-        self._mass_f = np.array(
-            [
-                2.0,
-                4.0,
-                6.0,
-                8.0,
-                10.0,
-                25.0,
-                50.0,
-                80.3,
-                91.2,
-                100.0,
-                150.0,
-                176.0,
-                200.0,
-                250.0,
-                350.0,
-                500.0,
-                750.0,
-                1000.0,
-                1500.0,
-                2000.0,
-                3000.0,
-                5000.0,
-                7000.0,
-                1e4,
-            ]
-        )
-
-        self._mass = np.append(self._mass_f, self._mass_h[27:])
-
-        self._dn_f = self._data_f.reshape((12, 24, 250))
-
-        # Is this really used?
-        self._dn_h = self._data_h
-
-        self._dn = np.zeros((12, len(self._mass), 250))
-        self._dn[:, 0:24, :] = self._dn_f
-        self._dn[:, 24:, :] = self._dn_h[:, 27:, :]
-
-        self._dn_interp = RegularGridInterpolator(
-            [self._mass, self._x],
-            self._dn[ichan, :, :],
-            bounds_error=False,
-            fill_value=None,
-        )
+        # The table is read only once (see _get_dn_table) and the spectrum is interpolated at evaluation time for the
+        # current channel and mass
 
         if self.channel.value in [1, 6, 7] and self.mass.value > 10000.0:
             log.error(
@@ -432,7 +427,8 @@ class DMSpectra(Function1D, metaclass=FunctionMeta):
         if isinstance(x, astropy_units.Quantity):
 
             # We need to convert to GeV
-            xx = x.to(astropy_units.MeV)
+            xx = x.to_value(astropy_units.GeV)
+            mass_value = mass.to_value(astropy_units.GeV)
 
         else:
 
@@ -442,13 +438,13 @@ class DMSpectra(Function1D, metaclass=FunctionMeta):
 
             # xm expects gamma ray energies in MeV
             xx = np.multiply(x, keVtoGeV)
+            mass_value = mass
 
-        xm = np.log10(np.divide(xx, mass))
+        xm = np.log10(np.divide(xx, mass_value))
 
         phip = (
             1.0 / (8.0 * np.pi) * np.power(mass, -2) * (sigmav * J)
         )  # units of this should be 1 / cm**2
-        dn = self._dn_interp((mass, xm))  # note this is unitless (dx = d(xm))
-        dn[xm > 0] = 0
+        dn = _interpolate_dn(self._dn_table_name, mass_value, channel, xm)  # note this is unitless (dx = d(xm))
 
         return np.multiply(phip, np.divide(dn, x))
@@ -17,7 +17,7 @@ import numpy as np
 import six
 from yaml.reader import ReaderError
 
-from astromodels.core.memoization import memoize
+from astromodels.core.memoization import memoize, new_state_version
 from astromodels.core.my_yaml import my_yaml
 from astromodels.core.parameter import Parameter
 from astromodels.core.parameter_transformation import get_transformation
@@ -490,6 +490,15 @@ class Function(Node):
 
     """
 
+    # Names of the attributes holding large, immutable data (tables, maps, interpolators...). Clones of a model
+    # (see clone_model) share them with the original instead of copying or re-building them. Such attributes
+    # must never be modified in place, only replaced
+    _shared_attributes = ()
+
+    # Whether evaluate works when the parameters are arrays, broadcasting them against x (see
+    # Function1D.evaluate_rows). Only functions made of element-wise numpy (or numba) operations should declare it
+    _supports_broadcasting = False
+
     def __init__(self, name: str=None, function_definition: str=None, parameters: Dict[str, Parameter]=None):
 
         # I use default values only to avoid warnings from pycharm and other software about the
@@ -541,6 +550,10 @@ class Function(Node):
 
         self._is_prior = False
 
+        # This changes when something other than a parameter, which affects the output of the function, changes
+        # (see _mark_state_changed)
+        self._state_version = new_state_version()
+
     @property
     def n_dim(self) -> int:
         """
@@ -591,6 +604,27 @@ class Function(Node):
 
         return not (self._fixed_units is None)
 
+    @property
+    def state_version(self):
+        """
+        Returns a hashable token which changes every time the output of this function might have changed, i.e.,
+        when one of its parameters changes (also through links) or when its internal state changes
+
+        :return: the state version
+        """
+
+        return (self._state_version,) + tuple(parameter.state_version for parameter in self._parameters.values())
+
+    def _mark_state_changed(self) -> None:
+        """
+        Functions must call this when something which is not a parameter, but which affects their output, changes
+        (for example a data file or a particle distribution)
+
+        :return: none
+        """
+
+        self._state_version = new_state_version()
+
     @property
     def is_prior(self) -> bool:
         """
@@ -1031,6 +1065,58 @@ class Function1D(Function):
 
         return self.evaluate(x, *values)
 
+    def evaluate_rows(self, x: np.ndarray, row_values: Dict[int, np.ndarray], n_rows: int) -> np.ndarray:
+        """
+        Evaluates the function (fast version, without units) for many sets of values of its parameters at once.
+
+        :param x: 1d array with the values of the independent variable
+        :param row_values: dictionary with an array of n_rows values for the parameters which change from row to
+        row, with the id of the parameter (id(parameter)) as key. The other parameters keep their current value
+        :param n_rows: number of rows
+        :return: array with shape (n_rows, x.shape[0])
+        """
+
+        parameters = self._get_children()
+
+        varying = [row_values.get(id(parameter), None) for parameter in parameters]
+
+        if all(values is None for values in varying):
+
+            return np.broadcast_to(self.fast_call(x), (n_rows, x.shape[0]))
+
+        current_values = [parameter.value for parameter in parameters]
+
+        if self._supports_broadcasting:
+
+            # One call for all the rows
+
+            args = [current if values is None else values[:, np.newaxis]
+                    for current, values in zip(current_values, varying)]
+
+            return np.broadcast_to(self.evaluate(x[np.newaxis, :], *args), (n_rows, x.shape[0]))
+
+        # One call for each distinct set of values of the parameters
+
+        varying_ids = [i for i, values in enumerate(varying) if values is not None]
+
+        table = np.column_stack([varying[i] for i in varying_ids])
+
+        unique_rows, inverse = np.unique(table, axis=0, return_inverse=True)
+
+        results = []
+
+        for row in unique_rows:
+
+            args = list(current_values)
+
+            for i, value in zip(varying_ids, row):
+
+                args[i] = value
+
+            results.append(self.evaluate(x, *args))
+
+        return np.array(results)[inverse.reshape(-1)]
+
     def get_boundaries(self):
         """
         Returns the boundaries of this function. By default there is no boundary, but subclasses can
@@ -1603,6 +1689,11 @@ class CompositeFunction(Function):
         "A list containing the function used to build this composite function"
         return self._functions
 
+    @property
+    def state_version(self):
+
+        return tuple(function.state_version for function in self._functions)
+
     def evaluate(self):  # pragma: no cover
 
         raise NotImplementedError(
@@ -1619,6 +1710,27 @@ class CompositeFunction(Function):
 
     fast_call = __call__
 
+    def evaluate_rows(self, x, row_values, n_rows):
+        """
+        Evaluates the function for many sets of values of the parameters at once (see Function1D.evaluate_rows)
+        """
+
+        if self._np_operator == "compose":
+
+            inner = self._f2.evaluate_rows(x, row_values, n_rows)
+
+            # The outer function is evaluated on a different x for each row
+
+            return np.array([
+                self._f1.evaluate_rows(inner[i], {key: values[i:i + 1] for key, values in row_values.items()}, 1)[0]
+                for i in range(n_rows)
+            ])
+
+        terms = [f.evaluate_rows(x, row_values, n_rows) if hasattr(f, "evaluate") else f
+                 for f in (self._f1, self._f2) if f is not None]
+
+        return self._np_operator(*terms)
+
     # Override the to_dict method of the Node class to add the expression to re-build this
     # composite function
     def to_dict(self, minimal=False):
@@ -6,9 +6,6 @@ from .functions import (Blackbody,  DiracDelta,
 
 
 
-if has_naima:
-    from .functions import Synchrotron
-
 if has_gsl:
 
     from .functions import Cutoff_powerlaw_flux
@@ -20,6 +17,8 @@ from .apec import  has_atomdb
 
 from .absorption import PhAbs, TbAbs, WAbs
 
+from .synchrotron import Synchrotron
+
 from .polynomials import Constant, Line, Quadratic, Cubic, Quartic, get_polynomial
 
 from .powerlaws import (Band, Band_Calderone, Band_grbm, Broken_powerlaw,
@@ -41,7 +40,7 @@ __all__ = ["Band", "Band_Calderone", "Band_grbm", "Broken_powerlaw",
            "Quadratic", "Sin", "StepFunction", "StepFunctionUpper",
            "PhAbs", "TbAbs", "WAbs",
            "Log_parabola",
-           "Blackbody","Quartic", "get_polynomial"
+           "Blackbody","Quartic", "get_polynomial", "Synchrotron"
            ]
 
 if has_atomdb:
@@ -53,11 +52,6 @@ if has_gsl:
     __all__.extend(["Cutoff_powerlaw_flux"])
 
 
-if has_naima:
-
-    __all__.extend(["Synchrotron"])
-
-
 if has_ebltable:
 
     __all__.extend(["EBLattenuation"])
@@ -1,15 +1,21 @@
+import collections
+import functools
 import os
 import sys
+import threading
+
 import astropy.units as astropy_units
 import numpy as np
-import numba as nb
 import six
 from astropy.io import fits
 from pathlib import Path
 
 from interpolation import interp
 
+from astromodels.core.evaluation_grid import get_grid_data
+from astromodels.core.memoization import array_fingerprint
 from astromodels.functions.function import Function1D, FunctionMeta
+from astromodels.functions.numba_functions import kernel
 from astromodels.utils import configuration
 from astromodels.utils.data_files import _get_data_file_path
 from astromodels.utils.logging import setup_logger
@@ -39,9 +45,72 @@ _abund_info[
     "ASPL"] = "aspl\nfrom Asplund M., Grevesse N., Sauval A.J. & Scott P. (2009, ARAA, 47, 481)\nhttps://heasarc.nasa.gov/xanadu/xspec/manual/XSabund.html"
 
 
+# Cross sections interpolated at the rest-frame energies of the last arrays which are not part of an EvaluationGrid,
+# shared by all the absorption models of the process
+
+_N_CACHED_XSECT = 16
+
+_xsect_cache = collections.OrderedDict()
+
+_xsect_cache_lock = threading.Lock()
+
+
+def _compute_xsect(model, abund_table, x, redshift):
+
+    xsect_ene, xsect_val = _get_xsect_table(model, abund_table)
+
+    xsect_interp = interp(xsect_ene, xsect_val, x * (1 + redshift))
+
+    xsect_interp.flags.writeable = False
+
+    return xsect_interp
+
+
+def _get_cached_xsect(model, abund_table, x, redshift):
+
+    key = (model, abund_table, float(redshift)) + array_fingerprint(x)
+
+    with _xsect_cache_lock:
+
+        xsect_interp = _xsect_cache.get(key)
+
+        if xsect_interp is not None:
+
+            _xsect_cache.move_to_end(key)
+
+            return xsect_interp
+
+    xsect_interp = _compute_xsect(model, abund_table, x, redshift)
+
+    with _xsect_cache_lock:
+
+        _xsect_cache[key] = xsect_interp
+
+        if len(_xsect_cache) > _N_CACHED_XSECT:
+
+            _xsect_cache.popitem(last=False)
+
+    return xsect_interp
+
+
+def _interpolate_xsect(function, x, redshift):
+    """
+    interpolates the cross section of the function at the rest-frame energies. The result is computed only once per
+    energy grid, abundance table and redshift: on the arrays of an EvaluationGrid it is kept with the grid, for other
+    arrays in a cache shared by all the absorption models
+    """
+
+    model = function._xsect_model
+
+    key = (model, function._abund_table, float(redshift))
+
+    return get_grid_data(x, key, lambda: _get_cached_xsect(model, function._abund_table, x, redshift))
+
+
+@functools.lru_cache(maxsize=None)
 def _get_xsect_table(model, abund_table):
     """
-    contructs the abundance table from the values given
+    contructs the abundance table from the values given. Tables are read only once per process and are read-only
     """
 
     if not model in _abs_tables:
@@ -67,8 +136,13 @@ def _get_xsect_table(model, abund_table):
         xsect_ene = dxs["ENERGY"]
         xsect_val = dxs["SIGMA"]
 
-    return np.array(xsect_ene, dtype=np.float64), np.array(xsect_val,
-                                                           dtype=np.float64)
+    xsect_ene = np.array(xsect_ene, dtype=np.float64)
+    xsect_val = np.array(xsect_val, dtype=np.float64)
+
+    xsect_ene.flags.writeable = False
+    xsect_val.flags.writeable = False
+
+    return xsect_ene, xsect_val
 
 
 # PhAbs class
@@ -100,6 +174,11 @@ class PhAbs(Function1D, metaclass=FunctionMeta):
 
 
     """
+
+    _shared_attributes = ("xsect_ene", "xsect_val")
+
+    _xsect_model = "phabs"
+
     def _setup(self):
         self._fixed_units = (astropy_units.keV,
                              astropy_units.dimensionless_unscaled)
@@ -130,10 +209,12 @@ class PhAbs(Function1D, metaclass=FunctionMeta):
 
             log.info("defaulting to AG89")
             self.xsect_ene, self.xsect_val = _get_xsect_table(
-                "phabs", abund_table)
+                "phabs", "AG89")
 
             self._abund_table = "AG89"
 
+        self._mark_state_changed()
+
     def evaluate(self, x, NH, redshift):
 
         if isinstance(x, astropy_units.Quantity):
@@ -149,10 +230,16 @@ class PhAbs(Function1D, metaclass=FunctionMeta):
             _redshift = redshift
             _x = x
 
-        xsect_interp = interp(self.xsect_ene, self.xsect_val,
-                              _x * (1 + _redshift))
+        xsect_interp = _interpolate_xsect(self, _x, _redshift)
+
+        if isinstance(NH, astropy_units.Quantity):
+
+            spec = np.exp(-NH * xsect_interp * _unit) * _y_unit
+
+        else:
+
+            spec = _numba_eval(NH, xsect_interp)
 
-        spec = np.exp(-NH * xsect_interp * _unit) * _y_unit
 
         return spec
 
@@ -186,6 +273,11 @@ class TbAbs(Function1D, metaclass=FunctionMeta):
 
 
     """
+
+    _shared_attributes = ("xsect_ene", "xsect_val")
+
+    _xsect_model = "tbabs"
+
     def _setup(self):
 
         self.init_xsect()
@@ -217,10 +309,12 @@ class TbAbs(Function1D, metaclass=FunctionMeta):
             log.info("defaulting to WILM")
 
             self.xsect_ene, self.xsect_val = _get_xsect_table(
-                "tbabs", abund_table)
+                "tbabs", "WILM")
 
             self._abund_table = "WILM"
 
+        self._mark_state_changed()
+
     @property
     def abundance_table(self):
         print(_abund_info[self._abund_table])
@@ -241,8 +335,7 @@ class TbAbs(Function1D, metaclass=FunctionMeta):
             _redshift = redshift
             _x = x
 
-        xsect_interp = interp(self.xsect_ene, self.xsect_val,
-                              _x * (1 + _redshift))
+        xsect_interp = _interpolate_xsect(self, _x, _redshift)
 
         spec = _numba_eval(NH, xsect_interp) * _y_unit
 
@@ -277,6 +370,11 @@ class WAbs(Function1D, metaclass=FunctionMeta):
 
 
     """
+
+    _shared_attributes = ("xsect_ene", "xsect_val")
+
+    _xsect_model = "wabs"
+
     def _setup(self):
         self._fixed_units = (astropy_units.keV,
                              astropy_units.dimensionless_unscaled)
@@ -299,6 +397,8 @@ class WAbs(Function1D, metaclass=FunctionMeta):
 
         self._abund_table = "AG89"
 
+        self._mark_state_changed()
+
     @property
     def abundance_table(self):
         print(_abund_info[self._abund_table])
@@ -318,16 +418,13 @@ class WAbs(Function1D, metaclass=FunctionMeta):
             _redshift = redshift
             _x = x
 
-        xsect_interp = interp(self.xsect_ene, self.xsect_val,
-                              _x * (1 + _redshift))
-
-        xsect_interp = interp( self.xsect_ene, self.xsect_val, _x * (1+ _redshift))
+        xsect_interp = _interpolate_xsect(self, _x, _redshift)
 
         spec = _numba_eval(NH,xsect_interp) * _y_unit
 
         return spec
 
-@nb.njit(fastmath=True)
+@kernel
 def _numba_eval(nh, xsect_interp):
 
-    return np.exp(-nh * xsect_interp )
+    return np.exp(-nh * xsect_interp)
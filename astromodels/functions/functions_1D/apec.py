@@ -1,3 +1,4 @@
+import concurrent.futures
 import os
 import sys
 from functools import lru_cache, wraps
@@ -7,9 +8,13 @@ import numpy as np
 import six
 from astropy.io import fits
 
+from astromodels.core.evaluation_engine import get_process_context
+from astromodels.core.evaluation_grid import get_grid_data
+from astromodels.core.memoization import array_fingerprint
 from astromodels.functions.function import Function1D, FunctionMeta
 from astromodels.utils import configuration
 from astromodels.utils.data_files import _get_data_file_path
+from astromodels.utils.logging import setup_logger
 import gc
 
 try:
@@ -22,10 +27,388 @@ except:
 
     has_atomdb = False
 
+log = setup_logger(__name__)
+
+# Elements whose abundance is the abund parameter of APEC
+_APEC_METALS = (6, 7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30)
+
+# Elements whose abundance is set by each abundance parameter of VAPEC (the elements without a parameter follow Fe)
+_VAPEC_ELEMENTS = (
+    ("Fe", (26, 9, 11, 15, 17, 19, 21, 22, 23, 24, 25, 27, 29, 30)),
+    ("C", (6,)),
+    ("N", (7,)),
+    ("O", (8,)),
+    ("Ne", (10,)),
+    ("Mg", (12,)),
+    ("Al", (13,)),
+    ("Si", (14,)),
+    ("S", (16,)),
+    ("Ar", (18,)),
+    ("Ca", (20,)),
+    ("Ni", (28,)),
+)
+
+# Default number of temperatures of the tables of spectra (log-spaced between the bounds of kT)
+_N_TABULATED_TEMPERATURES = 200
+
+def _get_ebounds(x, redshift):
+    """
+    builds the bin boundaries (in the observer frame) and the bin sizes around the provided energies
+    """
+
+    nval = len(x)
+
+    xz = x * (1.0 + redshift)
+
+    ebplus = (np.roll(xz, -1) + xz)[: nval - 1] / 2.0
+
+    ebounds = np.empty(nval + 1)
+
+    ebounds[1:nval] = ebplus
+
+    ebounds[0] = xz[0] - (ebplus[0] - xz[0])
+
+    ebounds[nval] = xz[nval - 1] + (xz[nval - 1] - ebplus[nval - 2])
+
+    binsize = (np.roll(ebounds, -1) - ebounds)[:nval]
+
+    return ebounds, binsize
+
+
+def _get_response_key(x, redshift):
+
+    return array_fingerprint(x) + (float(redshift),)
+
+
+def _prepare_session(function, x, redshift, abundances):
+    """
+    Sets the response and the abundances of the session of an APEC or VAPEC instance, skipping what did not change
+    since the previous call, and returns the sizes of the bins
+
+    :param function: the APEC or VAPEC instance
+    :param x: the energies
+    :param redshift: the redshift
+    :param abundances: sequence of (elements, abundance)
+    :return: the sizes of the bins around x
+    """
+
+    sess = function.session
+
+    # On the energies of an EvaluationGrid the bins are computed only once per redshift
+
+    ebounds, binsize = get_grid_data(x, ("apec_ebounds", float(redshift)),
+                                     lambda: _get_ebounds(x, redshift))
+
+    response_key = _get_response_key(x, redshift)
+
+    if function._response_key != response_key:
+
+        sess.set_response(ebounds, raw=True)
+
+        function._response_key = response_key
+
+        # Set again all the abundances on a new response
+
+        function._abundances = {}
+
+    for elements, abundance in abundances:
+
+        abundance = float(abundance)
+
+        if function._abundances.get(elements) != abundance:
+
+            sess.set_abund(list(elements), abundance)
+
+            function._abundances[elements] = abundance
+
+    return binsize
+
+
+# Each worker process computing a table of spectra has its own session
+
+_worker_session = None
+
+
+def _init_tabulation_worker(abund_table, ebounds):
+
+    global _worker_session
+
+    _worker_session = pyatomdb.spectrum.CIESession(abundset=abund_table)
+
+    _worker_session.set_response(ebounds, raw=True)
+
+
+def _compute_spectra(abundances, temperatures):
+
+    for elements, abundance in abundances:
+
+        _worker_session.set_abund(list(elements), abundance)
+
+    return np.array([_worker_session.return_spectrum(kT) for kT in temperatures])
+
+
+class _SpectrumTable(object):
+    """
+    Spectra (for K = 1) tabulated for a grid of energies and a redshift on a grid of temperatures, for a basis of
+    abundances. In collisional equilibrium the spectrum is linear in the abundance of each element, so the spectrum for
+    any abundances is exactly a linear combination of the spectra of the basis: the first element of the basis has all
+    the abundances at 0, the others have the abundance of one group of elements at 1. Each spectrum of the basis is
+    interpolated linearly in log(spectrum) vs. log(kT), which follows the exponential cutoff of the continuum much
+    better than a linear interpolation of the spectrum (in the bins where the spectrum is zero, the interpolation is
+    linear), and the interpolated spectra are then combined with the weights of the abundances. The spectra are computed
+    in background worker processes, and the table can be used once all of them are available.
+    """
+
+    def __init__(self, abund_table, x, redshift, temperatures, basis, n_workers=None):
+
+        ebounds, binsize = _get_ebounds(np.asarray(x, dtype=float), redshift)
+
+        self._key = _get_response_key(x, redshift)
+
+        self._log_temperatures = np.log(temperatures)
+
+        self._n_temperatures = len(temperatures)
+
+        self._n_basis = len(basis)
+
+        self._normalization = 1.0 / binsize / 1e-14
+
+        self._values = None
+
+        self._log_values = None
+
+        self._positive = None
+
+        if n_workers is None:
+
+            n_workers = os.cpu_count() or 1
+
+        # Split the temperatures so that all the workers are used even with a small basis
+
+        n_chunks = max(1, min(self._n_temperatures, int(np.ceil(n_workers / self._n_basis))))
+
+        self._chunks = np.array_split(np.arange(self._n_temperatures), n_chunks)
+
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                                          mp_context=get_process_context(),
+                                                          initializer=_init_tabulation_worker,
+                                                          initargs=(abund_table, ebounds))
+
+        self._futures = [[executor.submit(_compute_spectra, abundances, temperatures[chunk])
+                          for chunk in self._chunks]
+                         for abundances in basis]
+
+        # The workers exit once all the spectra have been computed
+
+        executor.shutdown(wait=False)
+
+    def is_ready(self):
+
+        if self._values is not None:
+
+            return True
+
+        if self._futures is None or not all(future.done() for futures in self._futures for future in futures):
+
+            return False
+
+        values = np.empty((self._n_basis, self._n_temperatures, self._normalization.shape[0]))
+
+        try:
+
+            for i, futures in enumerate(self._futures):
+
+                for chunk, future in zip(self._chunks, futures):
+
+                    values[i, chunk] = future.result()
+
+        except Exception as e:
+
+            log.warning("The computation of the table of spectra failed (%s). Spectra will be computed exactly" % e)
+
+            self._futures = None
+
+            return False
+
+        values = values * self._normalization
+
+        self._positive = values > 0
+
+        self._log_values = np.log(np.where(self._positive, values, 1.0))
+
+        self._values = values
+
+        self._futures = None
+
+        return True
+
+    def wait(self):
+
+        if self._futures is not None:
+
+            concurrent.futures.wait([future for futures in self._futures for future in futures])
+
+        return self.is_ready()
+
+    def get_spectrum(self, x, redshift, kT, weights):
+        """
+        Returns the spectrum interpolated at kT for the combination of the basis with the given weights, or None if
+        the table cannot be used (not ready yet, other energies or redshift, kT out of the grid)
+        """
+
+        if not self.is_ready():
+
+            return None
+
+        log_kT = np.log(kT)
+
+        if not self._log_temperatures[0] <= log_kT <= self._log_temperatures[-1]:
+
+            return None
+
+        if _get_response_key(x, redshift) != self._key:
+
+            return None
+
+        idx = min(int(np.searchsorted(self._log_temperatures, log_kT, side="right")) - 1, self._n_temperatures - 2)
+
+        fraction = (log_kT - self._log_temperatures[idx]) / (
+            self._log_temperatures[idx + 1] - self._log_temperatures[idx])
+
+        positive = self._positive[:, idx] & self._positive[:, idx + 1]
+
+        spectra = np.where(positive,
+                           np.exp(self._log_values[:, idx] * (1 - fraction) + self._log_values[:, idx + 1] * fraction),
+                           self._values[:, idx] * (1 - fraction) + self._values[:, idx + 1] * fraction)
+
+        return np.dot(weights, spectra)
+
+
+def _get_temperatures(kT, temperatures):
+
+    if temperatures is None:
+
+        temperatures = np.geomspace(kT.min_value, kT.max_value, _N_TABULATED_TEMPERATURES)
+
+    temperatures = np.unique(np.asarray(temperatures, dtype=float))
+
+    if temperatures.shape[0] < 2 or temperatures[0] <= 0:
+
+        log.error("The table of spectra needs at least 2 positive temperatures")
+
+        raise AssertionError()
+
+    return temperatures
+
+
+class _APECTabulation(object):
+
+    # Management of the pyatomdb session and of the table of spectra, common to APEC and VAPEC. The classes only
+    # provide _get_basis, the settings of the abundances of the spectra in the table (see _SpectrumTable)
+
+    def _setup(self):
+
+        self.session = None
+
+        self._abund_table = None
+
+        # Response and abundances currently set in the session, so that they are set again only when they change
+
+        self._response_key = None
+
+        self._abundances = {}
+
+        self._table = None
+
+    def init_session(self, abund_table="AG89"):
+        # initialize PyAtomDB session
+        self.session = pyatomdb.spectrum.CIESession(abundset=abund_table)
+
+        if abund_table != self._abund_table:
+
+            self._table = None
+
+        self._abund_table = abund_table
+
+        self._response_key = None
+
+        self._abundances = {}
+
+        self._mark_state_changed()
+
+    def clean(self):
+        """
+        Clean the current APEC session to avoid having too many open files
+        :returns: 
+        """
+        
+        self.session = None
+        del self.session
+
+        self._response_key = None
+        self._abundances = {}
+
+        gc.collect()
+
+    def tabulate(self, x, temperatures=None, n_workers=None, wait=False):
+        """
+        Starts computing, in background worker processes, a table of spectra on the energies x (as passed to the
+        function) at the current redshift, for a grid of temperatures. Once complete, the table is used instead of
+        pyatomdb on the same energies and redshift, for any abundances and any temperature within the grid. The spectrum
+        depends linearly on the abundances, so only a few spectra per temperature are computed (see _get_basis): two
+        for APEC (abundance 0 and 1), 12 + 1 for VAPEC (all the abundances at 0, and each abundance parameter at 1 in
+        turn). The combination of the abundances is exact, while the dependence on kT is interpolated in log(spectrum)
+        vs. log(kT) between the temperatures of the grid. The relative error of the interpolation grows with the
+        square of the spacing of the grid and, on the exponential cutoff of the continuum, linearly with E/kT: with the
+        default grid (200 temperatures between the bounds of kT, 0.08 and 64 keV) it is about 1.5e-4 * E/kT (1.5e-3
+        at E = 10 kT). Use a denser grid (or a narrower range of temperatures) for a better accuracy, or clear_table
+        to always compute the spectra exactly
+
+        :param x: the energies
+        :param temperatures: the grid of temperatures (default: 200 log-spaced values between the bounds of kT)
+        :param n_workers: number of worker processes (default: the number of CPUs)
+        :param wait: if True, wait until the table is complete (default: False)
+        :return: (none)
+        """
+
+        if self._abund_table is None:
+
+            log.error("please run init_session(abund) before tabulate")
+
+            raise AssertionError()
+
+        temperatures = _get_temperatures(self.kT, temperatures)
+
+        self._table = _SpectrumTable(self._abund_table, x, self.redshift.value, temperatures, self._get_basis(),
+                                     n_workers=n_workers)
+
+        if wait:
+
+            self._table.wait()
+
+        self._mark_state_changed()
+
+    def clear_table(self):
+        """
+        Removes the table of spectra computed by tabulate, so that spectra are always computed by pyatomdb
+
+        :return: (none)
+        """
+
+        self._table = None
+
+        self._mark_state_changed()
+
+    @staticmethod
+    def _get_basis():
+
+        raise NotImplementedError()
+
+
 if has_atomdb:
     # APEC class
     
-    class APEC(Function1D, metaclass=FunctionMeta):
+    class APEC(_APECTabulation, Function1D, metaclass=FunctionMeta):
         r"""
         description :
             The Astrophysical Plasma Emission Code (APEC, Smith et al. 2001)
@@ -71,72 +454,25 @@ if has_atomdb:
 
             self.K.unit = y_unit
 
-        def init_session(self, abund_table="AG89"):
-            # initialize PyAtomDB session
-            self.session = pyatomdb.spectrum.CIESession(abundset=abund_table)
+        @staticmethod
+        def _get_basis():
 
-        def clean(self):
-            """
-            Clean the current APEC session to avoid having too many open files
-            :returns: 
-            """
-            
-            self.session = None
-            del self.session
-            gc.collect()
+            return [((_APEC_METALS, 0.0),), ((_APEC_METALS, 1.0),)]
 
         def evaluate(self, x, K, kT, abund, redshift):
             assert self.session is not None, "please run init_session(abund)"
 
+            if self._table is not None:
+
+                spec = self._table.get_spectrum(x, redshift, kT, np.array([1.0 - abund, abund]))
+
+                if spec is not None:
+
+                    return K * spec
+
             sess = self.session
 
-            nval = len(x)
-
-            xz = x * (1.0 + redshift)
-
-            ebplus = (np.roll(xz, -1) + xz)[: nval - 1] / 2.0
-
-            ebounds = np.empty(nval + 1)
-
-            ebounds[1:nval] = ebplus
-
-            ebounds[0] = xz[0] - (ebplus[0] - xz[0])
-
-            ebounds[nval] = xz[nval - 1] + (xz[nval - 1] - ebplus[nval - 2])
-
-            binsize = (np.roll(ebounds, -1) - ebounds)[:nval]
-
-            sess.set_response(ebounds, raw=True)
-
-            sess.set_abund(
-                [
-                    6,
-                    7,
-                    8,
-                    9,
-                    10,
-                    11,
-                    12,
-                    13,
-                    14,
-                    16,
-                    17,
-                    18,
-                    19,
-                    20,
-                    21,
-                    22,
-                    23,
-                    24,
-                    25,
-                    26,
-                    27,
-                    28,
-                    29,
-                    30,
-                ],
-                abund,
-            )
+            binsize = _prepare_session(self, x, redshift, ((_APEC_METALS, abund),))
 
             spec = sess.return_spectrum(kT) / binsize / 1e-14
 
@@ -144,7 +480,7 @@ if has_atomdb:
 
     # VAPEC class
     
-    class VAPEC(Function1D, metaclass=FunctionMeta):
+    class VAPEC(_APECTabulation, Function1D, metaclass=FunctionMeta):
         r"""
         description :
             The Astrophysical Plasma Emission Code (APEC, Smith et al. 2001), variable abundances for individual elements
@@ -287,99 +623,39 @@ if has_atomdb:
 
             self.K.unit = y_unit
 
-        def init_session(self, abund_table="AG89"):
-            # initialize PyAtomDB session
-            self.session = pyatomdb.spectrum.CIESession(abundset=abund_table)
+        @staticmethod
+        def _get_basis():
 
-        def clean(self):
-            """
-            Clean the current APEC session to avoid having too many open files
-            :returns: 
-            """
-            
-            self.session = None
-            del self.session
-            gc.collect()
+            # All the abundances at 0, then the abundances of each parameter at 1 in turn
+
+            return [tuple((elements, float(name == this_name)) for name, elements in _VAPEC_ELEMENTS)
+                    for this_name in [None] + [name for name, _ in _VAPEC_ELEMENTS]]
 
         def evaluate(
             self, x, K, kT, Fe, C, N, O, Ne, Mg, Al, Si, S, Ar, Ca, Ni, redshift
         ):
             assert self.session is not None, "please run init_session(abund)"
 
-            sess = self.session
-
-            nval = len(x)
-
-            xz = x * (1.0 + redshift)
-
-            ebplus = (np.roll(xz, -1) + xz)[: nval - 1] / 2.0
-
-            ebounds = np.empty(nval + 1)
-
-            ebounds[1:nval] = ebplus
-
-            ebounds[0] = xz[0] - (ebplus[0] - xz[0])
+            values = dict(Fe=Fe, C=C, N=N, O=O, Ne=Ne, Mg=Mg, Al=Al, Si=Si, S=S, Ar=Ar, Ca=Ca, Ni=Ni)
 
-            ebounds[nval] = xz[nval - 1] + (xz[nval - 1] - ebplus[nval - 2])
+            if self._table is not None:
 
-            binsize = (np.roll(ebounds, -1) - ebounds)[:nval]
+                abundances = np.array([values[name] for name, _ in _VAPEC_ELEMENTS], dtype=float)
 
-            sess.set_response(ebounds, raw=True)
+                spec = self._table.get_spectrum(x, redshift, kT,
+                                                np.concatenate([[1.0 - abundances.sum()], abundances]))
 
-            sess.set_abund(
-                [6, ], C,
-            )
+                if spec is not None:
 
-            sess.set_abund(
-                [7, ], N,
-            )
+                    return K * spec
 
-            sess.set_abund(
-                [8, ], O,
-            )
-
-            sess.set_abund(
-                [10, ], Ne,
-            )
-
-            sess.set_abund(
-                [12, ], Mg,
-            )
-
-            sess.set_abund(
-                [13, ], Al,
-            )
-
-            sess.set_abund(
-                [14, ], Si,
-            )
-
-            sess.set_abund(
-                [16, ], S,
-            )
-
-            sess.set_abund(
-                [18, ], Ar,
-            )
-
-            sess.set_abund(
-                [20, ], Ca,
-            )
-
-            sess.set_abund(
-                [26, ], Fe,
-            )
+            sess = self.session
 
-            sess.set_abund(
-                [28, ], Ni,
-            )
+            # Remaining elements are set to Fe
 
-            sess.set_abund(
-                [9, 11, 15, 17, 19, 21, 22, 23, 24, 25, 27, 29, 30], Fe
-            )  # Remaining elements are set to Fe
+            binsize = _prepare_session(self, x, redshift,
+                                       [(elements, values[name]) for name, elements in _VAPEC_ELEMENTS])
 
             spec = sess.return_spectrum(kT) / binsize / 1e-14
 
             return K * spec
-
-
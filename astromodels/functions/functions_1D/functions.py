@@ -1,10 +1,15 @@
 from __future__ import division
 
+import collections
+import functools
+import importlib.util
+
 import astropy.units as astropy_units
 import numpy as np
 from past.utils import old_div
 
 import astromodels.functions.numba_functions as nb_func
+from astromodels.core.memoization import array_fingerprint
 from astromodels.core.units import get_units
 from astromodels.functions.function import (Function1D, FunctionMeta,
                                             ModelAssertionViolation)
@@ -51,27 +56,10 @@ class InvalidUsageForFunction(Exception):
 
 import astropy.units as u
 
-try:
-
-    # Naima is for numerical computation of Synch. and Inverse compton spectra in randomly oriented
-    # magnetic fields
-
-
-    import naima
-
-except ImportError:
-
-    if _startup_flag:
-
-        log.warning(
-            "The naima package is not available. Models that depend on it will not be available"
-        )
-
-    has_naima = False
-
-else:
+# Naima is not needed anymore by the Synchrotron function (see synchrotron.py). The flag is kept for backward
+# compatibility
 
-    has_naima = True
+has_naima = importlib.util.find_spec("naima") is not None
 
 try:
 
@@ -322,6 +310,8 @@ class Sin(Function1D, metaclass=FunctionMeta):
 
     """
 
+    _supports_broadcasting = True
+
     def _set_units(self, x_unit, y_unit):
         # The normalization has the same unit of y
         self.K.unit = y_unit
@@ -379,155 +369,6 @@ class DiracDelta(Function1D, metaclass=FunctionMeta):
         return out
 
 
-if has_naima:
-
-    class Synchrotron(Function1D, metaclass=FunctionMeta):
-        r"""
-        description :
-            Synchrotron spectrum from an input particle distribution, using Naima (naima.readthedocs.org)
-        latex: not available
-        parameters :
-            B :
-                desc : magnetic field
-                initial value : 3.24e-6
-                unit: Gauss
-            distance :
-                desc : distance of the source
-                initial value : 1.0
-                unit : kpc
-            emin :
-                desc : minimum energy for the particle distribution
-                initial value : 1
-                fix : yes
-                unit: GeV
-            emax :
-                desc : maximum energy for the particle distribution
-                initial value : 510e3
-                fix : yes
-                unit: GeV
-            need:
-                desc: number of points per decade in which to evaluate the function
-                initial value : 10
-                min : 2
-                max : 100
-                fix : yes
-        """
-
-        def _set_units(self, x_unit, y_unit):
-
-            # This function can only be used as a spectrum,
-            # so let's check that x_unit is a energy and y_unit is
-            # differential flux
-
-            if hasattr(x_unit, "physical_type") and x_unit.physical_type == "energy":
-
-                # Now check that y is a differential flux
-                current_units = get_units()
-                should_be_unitless = y_unit * (
-                    current_units.energy * current_units.time * current_units.area
-                )
-
-                if (
-                    not hasattr(should_be_unitless, "physical_type")
-                    or should_be_unitless.decompose().physical_type != "dimensionless"
-                ):
-                    # y is not a differential flux
-                    raise InvalidUsageForFunction(
-                        "Unit for y is not differential flux. The function synchrotron "
-                        "can only be used as a spectrum."
-                    )
-            else:
-
-                raise InvalidUsageForFunction(
-                    "Unit for x is not an energy. The function synchrotron can only be used "
-                    "as a spectrum"
-                )
-
-                # we actually don't need to do anything as the units are already set up
-
-        def set_particle_distribution(self, function):
-
-            self._particle_distribution = function
-
-            # Now set the units for the function
-
-            current_units = get_units()
-
-            self._particle_distribution.set_units(
-                current_units.energy, current_units.energy ** (-1)
-            )
-
-            # Naima wants a function which accepts a quantity as x (in units of eV) and returns an astropy quantity,
-            # so we need to create a wrapper which will remove the unit from x and add the unit to the return
-            # value
-
-            self._particle_distribution_wrapper = lambda x: old_div(
-                function(x.value), current_units.energy
-            )
-
-        def get_particle_distribution(self):
-
-            return self._particle_distribution
-
-        particle_distribution = property(
-            get_particle_distribution,
-            set_particle_distribution,
-            doc="""Get/set particle distribution for electrons""",
-        )
-
-        def fix_units(self, x, B, distance, emin, emax):
-
-            if isinstance(x, u.Quantity):
-                return (
-                    True,
-                    x.to(get_units().energy),
-                    B.to(u.Gauss),
-                    distance.to(u.kpc),
-                    emin.to(u.GeV),
-                    emax.to(u.GeV),
-                )
-            else:
-                return (
-                    False,
-                    x * (get_units().energy),
-                    B * (u.Gauss),
-                    distance * (u.kpc),
-                    emin * (u.GeV),
-                    emax * (u.GeV),
-                )
-
-        # noinspection PyPep8Naming
-        def evaluate(self, x, B, distance, emin, emax, need):
-
-            has_units, x, B, distance, emin, emax = self.fix_units(
-                x, B, distance, emin, emax
-            )
-
-            _synch = naima.models.Synchrotron(
-                self._particle_distribution_wrapper,
-                B,
-                Eemin=emin,
-                Eemax=emax,
-                nEed=need,
-            )
-
-            if has_units:
-                return _synch.flux(x, distance=distance)
-            else:
-                return _synch.flux(x, distance=distance).value
-
-        def to_dict(self, minimal=False):
-
-            data = super(Function1D, self).to_dict(minimal)
-
-            if not minimal:
-                data["extra_setup"] = {
-                    "particle_distribution": self.particle_distribution.path
-                }
-
-            return data
-
-
 class _ComplexTestFunction(Function1D, metaclass=FunctionMeta):
     r"""
     description :
@@ -771,6 +612,8 @@ class Exponential_cutoff(Function1D, metaclass=FunctionMeta):
             min : 1
     """
 
+    _supports_broadcasting = True
+
     def _set_units(self, x_unit, y_unit):
         # K has units of y
 
@@ -785,6 +628,46 @@ class Exponential_cutoff(Function1D, metaclass=FunctionMeta):
 
 if has_ebltable:
 
+    @functools.lru_cache(maxsize=None)
+    def _read_ebl_model(modelname):
+        """
+        Reads an EBL model (only once per model), returning the ebltable.tau_from_model.OptDepth instance and the
+        table of optical depths: nodes in log10(energy/keV) and in redshift, and the table itself with shape
+        (n_energies, n_redshifts). ebltable interpolates the table with a linear spline, i.e., bilinearly in
+        log10(energy) and redshift and clamping at the edges, which is what numba_functions.ebl_optical_depth_eval
+        does
+
+        :param modelname: name of the EBL model
+        :return: (OptDepth instance, (log10 energies, redshifts, table))
+        """
+
+        # passing modelname to ebltable, which will check if defined
+        optical_depth = ebltau.OptDepth.readmodel(model=modelname)
+
+        # ebltable uses log10 of energies in GeV
+        log_energies = np.array(optical_depth.x, dtype=float) + 6.0
+        redshifts = np.array(optical_depth.y, dtype=float)
+        table = np.ascontiguousarray(optical_depth.Z, dtype=float)
+
+        for array in (log_energies, redshifts, table):
+
+            array.flags.writeable = False
+
+        return optical_depth, (log_energies, redshifts, table)
+
+    def _locate_energies(log_energy_nodes, energies):
+
+        # Cell of each energy in the table, and position within it (energies outside of the table are clamped)
+
+        log_energies = np.clip(np.log10(np.maximum(energies, 1e-300)), log_energy_nodes[0], log_energy_nodes[-1])
+
+        cells = np.clip(np.searchsorted(log_energy_nodes, log_energies, side="right") - 1, 0,
+                        log_energy_nodes.shape[0] - 2)
+
+        weights = (log_energies - log_energy_nodes[cells]) / (log_energy_nodes[cells + 1] - log_energy_nodes[cells])
+
+        return [cells, weights]
+
     class EBLattenuation(Function1D, metaclass=FunctionMeta):
         r"""
         description :
@@ -810,15 +693,29 @@ if has_ebltable:
 
         """
 
+        _shared_attributes = ("_tau", "_tau_table")
+
+        # Number of energy grids for which the position in the table of optical depths is kept
+        _N_CACHED_GRIDS = 4
+
         def _setup(self):
 
+            self._energy_lookups = collections.OrderedDict()
+
             # define EBL model, use dominguez as default
-            self._tau = ebltau.OptDepth.readmodel(model="dominguez")
+            self._load_ebl_model("dominguez")
+
+        def _load_ebl_model(self, modelname):
+
+            self._tau, self._tau_table = _read_ebl_model(modelname)
+
+            self._energy_lookups.clear()
 
         def set_ebl_model(self, modelname):
 
-            # passing modelname to ebltable, which will check if defined
-            self._tau = ebltau.OptDepth.readmodel(model=modelname)
+            self._load_ebl_model(modelname)
+
+            self._mark_state_changed()
 
         def _set_units(self, x_unit, y_unit):
 
@@ -842,19 +739,54 @@ if has_ebltable:
             self.redshift.unit = astropy_units.dimensionless_unscaled
             self.attenuation.unit = astropy_units.dimensionless_unscaled
 
+        def _get_optical_depth(self, energies, redshift):
+
+            # Energies are in keV. The position of the energies in the table is computed only once for each energy
+            # grid, and the optical depth at the last redshift is kept, so that with a fixed redshift the evaluation
+            # is just an exp
+
+            key = array_fingerprint(energies)
+
+            try:
+
+                lookup = self._energy_lookups[key]
+
+            except KeyError:
+
+                lookup = _locate_energies(self._tau_table[0], energies) + [None, None]
+
+                self._energy_lookups[key] = lookup
+
+                if len(self._energy_lookups) > self._N_CACHED_GRIDS:
+
+                    self._energy_lookups.popitem(last=False)
+
+            else:
+
+                self._energy_lookups.move_to_end(key)
+
+            if lookup[2] != redshift:
+
+                _, z_nodes, table = self._tau_table
+
+                lookup[3] = nb_func.ebl_optical_depth_eval(table, lookup[0], lookup[1], z_nodes, float(redshift))
+                lookup[2] = redshift
+
+            return lookup[3]
+
         def evaluate(self, x, redshift, attenuation):
 
             if isinstance(x, astropy_units.Quantity):
 
-                # ebltable expects TeV
-                eTeV = x.to(astropy_units.TeV).value
-                return (
-                    np.exp(-self._tau.opt_depth(redshift.value, eTeV) * attenuation)
-                    * astropy_units.dimensionless_unscaled
-                )
+                ekeV = x.to(astropy_units.keV).value
+
+                tau = self._get_optical_depth(ekeV.reshape(-1), redshift.value).reshape(ekeV.shape)
+
+                return np.exp(-tau * attenuation.value) * astropy_units.dimensionless_unscaled
 
             else:
 
                 # otherwise it's in keV
-                eTeV = old_div(x, 1e9)
-                return np.exp(-self._tau.opt_depth(redshift, eTeV) * attenuation)
+                tau = self._get_optical_depth(np.reshape(x, -1), redshift).reshape(np.shape(x))
+
+                return np.exp(-tau * attenuation)
@@ -40,6 +40,9 @@ class Constant(Function1D, metaclass=FunctionMeta):
             initial value : 0
 
     """
+
+    _supports_broadcasting = True
+
     def _set_units(self, x_unit, y_unit):
         self.k.unit = y_unit
 
@@ -69,6 +72,9 @@ class Line(Function1D, metaclass=FunctionMeta):
             initial value : 1
 
     """
+
+    _supports_broadcasting = True
+
     def _set_units(self, x_unit, y_unit):
         # a has units of y_unit / x_unit, so that a*x has units of y_unit
         self.a.unit = y_unit
@@ -107,6 +113,9 @@ class Quadratic(Function1D, metaclass=FunctionMeta):
 
 
     """
+
+    _supports_broadcasting = True
+
     def _set_units(self, x_unit, y_unit):
         # a has units of y_unit / x_unit, so that a*x has units of y_unit
         self.a.unit = y_unit
@@ -153,6 +162,8 @@ class Cubic(Function1D, metaclass=FunctionMeta):
 
     """
 
+    _supports_broadcasting = True
+
     def _set_units(self, x_unit, y_unit):
         # a has units of y_unit / x_unit, so that a*x has units of y_unit
         self.a.unit = y_unit
@@ -211,6 +222,8 @@ class Quartic(Function1D, metaclass=FunctionMeta):
 
     """
 
+    _supports_broadcasting = True
+
     def _set_units(self, x_unit, y_unit):
         # a has units of y_unit / x_unit, so that a*x has units of y_unit
         self.a.unit = y_unit
@@ -72,6 +72,8 @@ class Powerlaw(Function1D, metaclass=FunctionMeta):
 
     """
 
+    _supports_broadcasting = True
+
     def _set_units(self, x_unit, y_unit):
         # The index is always dimensionless
         self.index.unit = astropy_units.dimensionless_unscaled
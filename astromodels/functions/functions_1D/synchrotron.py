@@ -0,0 +1,334 @@
+import functools
+
+import astropy.units as u
+import numpy as np
+from astropy import constants
+
+from astromodels.core.memoization import array_fingerprint
+from astromodels.core.units import get_units
+from astromodels.functions.function import Function1D, FunctionMeta
+from astromodels.functions.functions_1D.functions import InvalidUsageForFunction
+from astromodels.utils.logging import setup_logger
+
+log = setup_logger(__name__)
+
+# Physical constants in cgs units (the charge of the electron in esu)
+
+_ELECTRON_CHARGE = constants.e.gauss.value
+_MEC2 = (constants.m_e * constants.c ** 2).cgs.value
+_MEC = (constants.m_e * constants.c).cgs.value
+_HBAR = constants.hbar.cgs.value
+
+_MEC2_GEV = (constants.m_e * constants.c ** 2).to_value(u.GeV)
+
+# Critical energy (erg) of an electron with Lorentz factor gamma in a magnetic field B (G) is
+# _CRITICAL_ENERGY * B * gamma ** 2. The number of photons emitted per unit time and energy E (erg) by the electron is
+# _EMISSIVITY * B / E * G(E / E_c)
+
+_CRITICAL_ENERGY = 3 * _ELECTRON_CHARGE * _HBAR / (2 * _MEC)
+_EMISSIVITY = np.sqrt(3) * _ELECTRON_CHARGE ** 3 / (2 * np.pi * _MEC2 * _HBAR)
+
+# The synchrotron kernel G(x) averaged over an isotropic distribution of pitch angles is the product of a smooth
+# function and exp(-x). The former is tabulated as log10 on a uniform grid in log10(x). Below the table it goes as
+# x^(1/3), above it it is constant (and G is 0 in double precision anyway)
+
+_LOG10_X_MIN = -14.0
+_LOG10_X_MAX = 3.0
+_TABLE_SIZE = 4096
+
+
+def _akp10_prefactor(x):
+
+    cb = np.cbrt(x)
+
+    gt1 = 1.808 * cb / np.sqrt(1 + 3.4 * cb ** 2)
+    gt2 = 1 + 2.210 * cb ** 2 + 0.347 * cb ** 4
+    gt3 = 1 + 1.353 * cb ** 2 + 0.217 * cb ** 4
+
+    return gt1 * (gt2 / gt3)
+
+
+def _akp10_kernel(x):
+    """
+    Approximation of the angle-averaged synchrotron kernel from Aharonian, Kelner & Prosekin 2010 (PhRvD 82,
+    043002), eq. D7, accurate to better than 0.2%. This is the same kernel used by naima
+
+    :param x: ratio between the photon energy and the critical energy
+    :return: G(x)
+    """
+
+    return _akp10_prefactor(x) * np.exp(-x)
+
+
+_LOG10_X_TABLE = np.linspace(_LOG10_X_MIN, _LOG10_X_MAX, _TABLE_SIZE)
+_LOG10_PREFACTOR_TABLE = np.log10(_akp10_prefactor(10 ** _LOG10_X_TABLE))
+
+_LOG10_X_STEP = _LOG10_X_TABLE[1] - _LOG10_X_TABLE[0]
+
+
+def synchrotron_kernel(x):
+    """
+    Angle-averaged synchrotron kernel G(x), interpolated (linearly in log-log) from a precomputed table
+
+    :param x: ratio between the photon energy and the critical energy (array)
+    :return: G(x)
+    """
+
+    log10_x = np.log10(x)
+
+    # The table is uniform in log10(x), so the position in the table is found with no search
+
+    position = np.clip((log10_x - _LOG10_X_MIN) / _LOG10_X_STEP, 0, _TABLE_SIZE - 1)
+
+    idx = np.minimum(position.astype(np.int64), _TABLE_SIZE - 2)
+
+    fraction = position - idx
+
+    log10_prefactor = _LOG10_PREFACTOR_TABLE[idx] * (1 - fraction) + _LOG10_PREFACTOR_TABLE[idx + 1] * fraction
+
+    # Asymptotic behavior below the table
+
+    log10_prefactor = np.where(log10_x < _LOG10_X_MIN,
+                               _LOG10_PREFACTOR_TABLE[0] + (log10_x - _LOG10_X_MIN) / 3.0,
+                               log10_prefactor)
+
+    return 10 ** log10_prefactor * np.exp(-x)
+
+
+_KPC_TO_CM = u.kpc.to(u.cm)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_conversion_factors(energy_unit, area_unit, time_unit):
+
+    # Conversions between the cgs units used in the computation and the current units: energy to erg, m_e c^2 in
+    # the energy unit, and differential flux from 1 / (erg cm2 s) to the current unit
+
+    return (energy_unit.to(u.erg),
+            _MEC2_GEV * u.GeV.to(energy_unit),
+            (energy_unit * area_unit * time_unit).to(u.erg * u.cm ** 2 * u.s))
+
+
+@functools.lru_cache(maxsize=16)
+def _get_electron_grid(emin, emax, need):
+    """
+    Returns the grid of Lorentz factors of the electrons (need points per decade between emin and emax, in GeV, with
+    a minimum of 10 points as in naima) and the weights of the trapezoidal rule in log space on it, so that the
+    integral of f over the Lorentz factor is np.dot(weights, f(gamma))
+    """
+
+    log10_gamma_min = np.log10(emin / _MEC2_GEV)
+    log10_gamma_max = np.log10(emax / _MEC2_GEV)
+
+    n_points = max(10, int(need * (log10_gamma_max - log10_gamma_min)))
+
+    gamma = np.logspace(log10_gamma_min, log10_gamma_max, n_points)
+
+    # d(gamma) = gamma d(ln gamma)
+
+    half_steps = np.diff(np.log(gamma)) / 2.0
+
+    weights = np.zeros(n_points)
+    weights[:-1] += half_steps
+    weights[1:] += half_steps
+    weights *= gamma
+
+    gamma.flags.writeable = False
+    weights.flags.writeable = False
+
+    return gamma, weights
+
+
+class Synchrotron(Function1D, metaclass=FunctionMeta):
+    r"""
+    description :
+        Synchrotron spectrum from an input particle distribution, for a randomly oriented magnetic field (same
+        model as Naima, naima.readthedocs.org, which is not needed)
+    latex: not available
+    parameters :
+        B :
+            desc : magnetic field
+            initial value : 3.24e-6
+            unit: Gauss
+        distance :
+            desc : distance of the source
+            initial value : 1.0
+            unit : kpc
+        emin :
+            desc : minimum energy for the particle distribution
+            initial value : 1
+            fix : yes
+            unit: GeV
+        emax :
+            desc : maximum energy for the particle distribution
+            initial value : 510e3
+            fix : yes
+            unit: GeV
+        need:
+            desc: number of points per decade in which to evaluate the function
+            initial value : 10
+            min : 2
+            max : 100
+            fix : yes
+    """
+
+    def _setup(self):
+
+        self._particle_distribution = None
+
+        # Last kernel matrix computed, with its key (photon energies, magnetic field and grid of electrons)
+
+        self._kernel_matrix = (None, None)
+
+    def _set_units(self, x_unit, y_unit):
+
+        # This function can only be used as a spectrum,
+        # so let's check that x_unit is a energy and y_unit is
+        # differential flux
+
+        if hasattr(x_unit, "physical_type") and x_unit.physical_type == "energy":
+
+            # Now check that y is a differential flux
+            current_units = get_units()
+            should_be_unitless = y_unit * (
+                current_units.energy * current_units.time * current_units.area
+            )
+
+            if (
+                not hasattr(should_be_unitless, "physical_type")
+                or should_be_unitless.decompose().physical_type != "dimensionless"
+            ):
+                # y is not a differential flux
+                raise InvalidUsageForFunction(
+                    "Unit for y is not differential flux. The function synchrotron "
+                    "can only be used as a spectrum."
+                )
+        else:
+
+            raise InvalidUsageForFunction(
+                "Unit for x is not an energy. The function synchrotron can only be used "
+                "as a spectrum"
+            )
+
+            # we actually don't need to do anything as the units are already set up
+
+    def set_particle_distribution(self, function):
+
+        self._particle_distribution = function
+
+        # Now set the units for the function
+
+        current_units = get_units()
+
+        self._particle_distribution.set_units(
+            current_units.energy, current_units.energy ** (-1)
+        )
+
+        self._mark_state_changed()
+
+    @property
+    def state_version(self):
+
+        # The output depends also on the parameters of the particle distribution
+
+        if self._particle_distribution is None:
+
+            return super(Synchrotron, self).state_version
+
+        return (
+            super(Synchrotron, self).state_version,
+            self._particle_distribution.state_version,
+        )
+
+    def get_particle_distribution(self):
+
+        return self._particle_distribution
+
+    particle_distribution = property(
+        get_particle_distribution,
+        set_particle_distribution,
+        doc="""Get/set particle distribution for electrons""",
+    )
+
+    def _get_kernel_matrix(self, energies, B, emin, emax, need):
+
+        # Matrix of G(E / E_c) for all the electrons (rows) and photon energies (columns). It changes only with the
+        # magnetic field and the grids, so it is kept between calls where only the particle distribution changes
+
+        key = array_fingerprint(energies) + (B, emin, emax, need)
+
+        if self._kernel_matrix[0] != key:
+
+            gamma, _ = _get_electron_grid(emin, emax, need)
+
+            critical_energies = _CRITICAL_ENERGY * B * gamma ** 2
+
+            matrix = synchrotron_kernel(energies[np.newaxis, :] / critical_energies[:, np.newaxis])
+
+            matrix.flags.writeable = False
+
+            self._kernel_matrix = (key, matrix)
+
+        return self._kernel_matrix[1]
+
+    # noinspection PyPep8Naming
+    def evaluate(self, x, B, distance, emin, emax, need):
+
+        if self._particle_distribution is None:
+
+            log.error("The particle distribution of %s has not been set" % self.name)
+
+            raise AssertionError()
+
+        current_units = get_units()
+
+        has_units = isinstance(x, u.Quantity)
+
+        if has_units:
+
+            x = x.to_value(current_units.energy)
+            B = B.to_value(u.Gauss)
+            distance = distance.to_value(u.kpc)
+            emin = emin.to_value(u.GeV)
+            emax = emax.to_value(u.GeV)
+            need = float(need)
+
+        shape = np.shape(x)
+
+        to_erg, mec2, to_flux_unit = _get_conversion_factors(current_units.energy, current_units.area,
+                                                             current_units.time)
+
+        energies = np.atleast_1d(np.asarray(x, dtype=float)).reshape(-1) * to_erg
+
+        gamma, weights = _get_electron_grid(float(emin), float(emax), float(need))
+
+        # Number of electrons per unit Lorentz factor
+
+        n_electrons = self._particle_distribution(gamma * mec2) * mec2
+
+        kernel_matrix = self._get_kernel_matrix(energies, float(B), float(emin), float(emax), float(need))
+
+        # Photons per unit time and energy (erg), integrated over the electrons
+
+        spectrum = _EMISSIVITY * B / energies * np.dot(weights * n_electrons, kernel_matrix)
+
+        flux = spectrum / (4 * np.pi * (distance * _KPC_TO_CM) ** 2) * to_flux_unit
+
+        flux = flux.reshape(shape)
+
+        if has_units:
+
+            return flux / (current_units.energy * current_units.area * current_units.time)
+
+        return flux
+
+    def to_dict(self, minimal=False):
+
+        data = super(Function1D, self).to_dict(minimal)
+
+        if not minimal:
+            data["extra_setup"] = {
+                "particle_distribution": self.particle_distribution.path
+            }
+
+        return data
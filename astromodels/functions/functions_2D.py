@@ -2,15 +2,19 @@ from __future__ import division
 from past.utils import old_div
 import numpy as np
 from astropy.coordinates import SkyCoord, ICRS, BaseCoordinateFrame
-from astropy.io import fits
 from astropy import wcs
 import astropy.units as u
 
+import astromodels.functions.numba_functions as nb_func
 from astromodels.functions.function import Function2D, FunctionMeta
-from astromodels.utils.angular_distance import angular_distance
+from astromodels.functions.numba_functions import can_use_kernels
+from astromodels.core.memoization import array_fingerprint
+from astromodels.utils.angular_distance import (angular_distance, angular_distance_from_center,
+                                                get_pixel_coordinates, unit_vector)
+from astromodels.utils.cached_files import get_array_fingerprint, load_cached_metadata, open_fits_data
 from astromodels.utils.vincenty import vincenty
 
-import hashlib
+import collections
 
 from astromodels.utils.logging import setup_logger
 
@@ -66,6 +70,8 @@ class Latitude_galactic_diffuse(Function2D, metaclass=FunctionMeta):
 
         self._frame = new_frame
 
+        self._mark_state_changed()
+
     def _set_units(self, x_unit, y_unit, z_unit):
 
         self.K.unit = z_unit
@@ -165,7 +171,13 @@ class Gaussian_on_sphere(Function2D, metaclass=FunctionMeta):
 
         lon, lat = x,y
 
-        angsep = angular_distance(lon0, lat0, lon, lat)
+        if can_use_kernels(lon, lat, sigma):
+
+            vectors = get_pixel_coordinates(lon, lat).unit_vectors
+
+            return nb_func.gaussian_on_sphere_eval(vectors, unit_vector(lon0, lat0), sigma).reshape(np.shape(lon))
+
+        angsep = angular_distance_from_center(lon0, lat0, lon, lat)
 
         s2 = sigma**2
 
@@ -280,7 +292,25 @@ class Asymm_Gaussian_on_sphere(Function2D, metaclass=FunctionMeta):
         lon, lat = x,y
 
         b = a * np.sqrt(1. - e**2)
-        
+
+        if can_use_kernels(lon, lat, a, theta):
+
+            phi = np.deg2rad(theta + 90.)
+
+            cos2_phi = np.cos(phi) ** 2
+            sin2_phi = np.sin(phi) ** 2
+            sin_2phi = np.sin(2. * phi)
+
+            A = cos2_phi / (2. * b ** 2) + sin2_phi / (2. * a ** 2)
+            B = -sin_2phi / (4. * b ** 2) + sin_2phi / (4. * a ** 2)
+            C = sin2_phi / (2. * b ** 2) + cos2_phi / (2. * a ** 2)
+
+            lon = np.asarray(lon, dtype=float)
+            lat = np.asarray(lat, dtype=float)
+
+            return nb_func.asymm_gaussian_on_sphere_eval(lon.reshape(-1), lat.reshape(-1), lon0, lat0, a, b,
+                                                         A, B, C).reshape(lon.shape)
+
         dX = np.atleast_1d( angular_distance( lon0, lat0, lon, lat0) )
         dY = np.atleast_1d( angular_distance( lon0, lat0, lon0, lat) )
 
@@ -403,7 +433,13 @@ class Disk_on_sphere(Function2D, metaclass=FunctionMeta):
 
         lon, lat = x,y
 
-        angsep = angular_distance(lon0, lat0, lon, lat)
+        if can_use_kernels(lon, lat, radius):
+
+            vectors = get_pixel_coordinates(lon, lat).unit_vectors
+
+            return nb_func.disk_on_sphere_eval(vectors, unit_vector(lon0, lat0), radius).reshape(np.shape(lon))
+
+        angsep = angular_distance_from_center(lon0, lat0, lon, lat)
 
         return np.power(old_div(180, np.pi), 2) * 1. / (np.pi * radius ** 2) * (angsep <= radius)
 
@@ -543,10 +579,17 @@ class Ellipse_on_sphere(Function2D, metaclass=FunctionMeta):
         
         # lon/lat of point in question
         lon, lat = x, y
-        
+
+        if can_use_kernels(lon, lat, a, theta):
+
+            vectors = get_pixel_coordinates(lon, lat).unit_vectors
+
+            return nb_func.ellipse_on_sphere_eval(vectors, unit_vector(self.lon1, self.lat1),
+                                                  unit_vector(self.lon2, self.lat2), a, b).reshape(np.shape(lon))
+
         # sum of geodesic distances to focii (should be <= 2a to be in ellipse)
-        angsep1 = angular_distance(self.lon1, self.lat1, lon, lat)
-        angsep2 = angular_distance(self.lon2, self.lat2, lon, lat)
+        angsep1 = angular_distance_from_center(self.lon1, self.lat1, lon, lat)
+        angsep2 = angular_distance_from_center(self.lon2, self.lat2, lon, lat)
         angsep  = angsep1 + angsep2
         
         return np.power(old_div(180, np.pi), 2) * 1. / (np.pi * a * b) * (angsep <= 2*a)
@@ -618,6 +661,11 @@ class SpatialTemplate_2D(Function2D, metaclass=FunctionMeta):
                 fix: yes
         
         """
+
+    _shared_attributes = ("_map", "_wcs")
+
+    # Number of sets of input coordinates for which the pixel lookup is kept
+    _N_CACHED_LOOKUPS = 4
     
     def _set_units(self, x_unit, y_unit, z_unit):
         
@@ -631,6 +679,10 @@ class SpatialTemplate_2D(Function2D, metaclass=FunctionMeta):
         self._frame = "icrs"
         self._fitsfile = None
         self._map = None
+        self._interpolation = "nearest"
+
+        # Pixel lookups (indexes in the flattened map and weights) by fingerprint of the input coordinates
+        self._pixel_lookups = collections.OrderedDict()
     
     
     def load_file(self,fitsfile, ihdu=0):
@@ -640,34 +692,38 @@ class SpatialTemplate_2D(Function2D, metaclass=FunctionMeta):
             raise RuntimeError( "Need to specify a fits file with a template map." )
         
         self._fitsfile=fitsfile
-        
-        with fits.open(self._fitsfile) as f:
-    
-            self._wcs = wcs.WCS( header = f[ihdu].header )
-            self._map = f[ihdu].data
-              
-            self._nX = f[ihdu].header['NAXIS1']
-            self._nY = f[ihdu].header['NAXIS2']
-
-            #note: map coordinates are switched compared to header. NAXIS1 is coordinate 1, not 0. 
-            #see http://docs.astropy.org/en/stable/io/fits/#working-with-image-data
-            assert self._map.shape[1] == self._nX, "NAXIS1 = %d in fits header, but %d in map" % (self._nX, self._map.shape[1])
-            assert self._map.shape[0] == self._nY, "NAXIS2 = %d in fits header, but %d in map" % (self._nY, self._map.shape[0])
-            
-            #test if the map is normalized as expected
-            area = wcs.utils.proj_plane_pixel_area( self._wcs )
-            dOmega = (area*u.deg*u.deg).to(u.sr).value
-            total = self._map.sum() * dOmega
 
-            if not np.isclose( total, 1,  rtol=1e-2):
-                log.warning("2D template read from {} is normalized to {} (expected: 1)".format(self._fitsfile, total) )
-            
-            #hash sum uniquely identifying the template function (defined by its 2D map array and coordinate system)
-            #this is needed so that the memoization won't confuse different SpatialTemplate_2D objects.
-            h = hashlib.sha224()
-            h.update( self._map)
-            h.update( repr(self._wcs).encode('utf-8') )
-            self.hash = int(h.hexdigest(), 16)
+        # The map is memory-mapped read-only, so that all the instances (and processes) using the same file share it
+        header, self._map = open_fits_data(self._fitsfile, ihdu)
+
+        self._wcs = wcs.WCS( header = header )
+
+        self._nX = header['NAXIS1']
+        self._nY = header['NAXIS2']
+
+        #note: map coordinates are switched compared to header. NAXIS1 is coordinate 1, not 0.
+        #see http://docs.astropy.org/en/stable/io/fits/#working-with-image-data
+        assert self._map.shape[1] == self._nX, "NAXIS1 = %d in fits header, but %d in map" % (self._nX, self._map.shape[1])
+        assert self._map.shape[0] == self._nY, "NAXIS2 = %d in fits header, but %d in map" % (self._nY, self._map.shape[0])
+
+        #hash sum uniquely identifying the template function (defined by its 2D map array and coordinate system)
+        #this is needed so that the memoization won't confuse different SpatialTemplate_2D objects.
+        #Both the hash and the sum of the map are computed only the first time the file is used
+        metadata = load_cached_metadata(self._fitsfile, "spatial_template_2D_%i" % ihdu,
+                                        lambda: {"sum": float(self._map.sum()),
+                                                 "hash": get_array_fingerprint(self._map, repr(self._wcs))})
+
+        #test if the map is normalized as expected
+        area = wcs.utils.proj_plane_pixel_area( self._wcs )
+        dOmega = (area*u.deg*u.deg).to(u.sr).value
+        total = metadata["sum"] * dOmega
+
+        if not np.isclose( total, 1,  rtol=1e-2):
+            log.warning("2D template read from {} is normalized to {} (expected: 1)".format(self._fitsfile, total) )
+
+        self.hash = metadata["hash"]
+
+        self._pixel_lookups.clear()
             
 
     def to_dict(self, minimal=False):
@@ -676,7 +732,8 @@ class SpatialTemplate_2D(Function2D, metaclass=FunctionMeta):
 
          if not minimal:
          
-            data['extra_setup'] = {"_fitsfile": self._fitsfile, "_frame": self._frame }
+            data['extra_setup'] = {"_fitsfile": self._fitsfile, "_frame": self._frame,
+                                   "_interpolation": self._interpolation}
   
          return data
         
@@ -691,28 +748,146 @@ class SpatialTemplate_2D(Function2D, metaclass=FunctionMeta):
         assert new_frame.lower() in ['icrs', 'galactic', 'fk5', 'fk4', 'fk4_no_e' ]
                 
         self._frame = new_frame
+
+        self._pixel_lookups.clear()
+
+        self._mark_state_changed()
+
+    @property
+    def interpolation(self):
+        """
+        How the map is evaluated between the centers of its pixels ('nearest' or 'bilinear')
+        """
+
+        return self._interpolation
+
+    def set_interpolation(self, method):
+        """
+        Set how the map is evaluated at positions between the centers of its pixels
+
+        :param method: 'nearest' (default, the value of the pixel containing the position) or 'bilinear' (bilinear
+        interpolation between the 4 closest pixels, pixels outside of the map count as zero)
+        :return: (none)
+        """
+
+        if method not in ("nearest", "bilinear"):
+
+            log.error("Interpolation method must be 'nearest' or 'bilinear', got %s" % method)
+
+            raise AssertionError()
+
+        self._interpolation = method
+
+        self._pixel_lookups.clear()
+
+        self._mark_state_changed()
+
+    def _compute_pixel_lookup(self, x, y):
+
+        # We assume x and y are R.A. and Dec
+        coord = SkyCoord(ra=x, dec=y, frame=self._frame, unit="deg")
+
+        #transform input coordinates to pixel coordinates;
+        #SkyCoord takes care of necessary coordinate frame transformations.
+        Xpix, Ypix = coord.to_pixel(self._wcs)
+
+        Xpix = np.atleast_1d(Xpix)
+        Ypix = np.atleast_1d(Ypix)
+
+        # The centers of the pixels are at integer coordinates (WCS convention), so the pixel containing a position
+        # is the closest integer (truncating would shift the map by half a pixel)
+
+        if self._interpolation == "nearest":
+
+            Xpix = np.floor(Xpix + 0.5).astype(int)
+            Ypix = np.floor(Ypix + 0.5).astype(int)
+
+            # find pixels that are in the template ROI, the others are zero
+            iz = (Xpix<self._nX) & (Xpix>=0) & (Ypix<self._nY) & (Ypix>=0)
+
+            return np.flatnonzero(iz), Ypix[iz] * self._nX + Xpix[iz], None
+
+        # Bilinear interpolation: the 4 pixels around each position (the centers of the pixels are at integer
+        # coordinates), with their weights. Pixels outside of the map get a weight of zero
+
+        X0 = np.floor(Xpix)
+        Y0 = np.floor(Ypix)
+
+        fX = Xpix - X0
+        fY = Ypix - Y0
+
+        X0 = X0.astype(int)
+        Y0 = Y0.astype(int)
+
+        indexes = []
+        weights = []
+
+        for dX, dY, weight in [(0, 0, (1 - fX) * (1 - fY)), (1, 0, fX * (1 - fY)),
+                               (0, 1, (1 - fX) * fY), (1, 1, fX * fY)]:
+
+            this_X = X0 + dX
+            this_Y = Y0 + dY
+
+            iz = (this_X<self._nX) & (this_X>=0) & (this_Y<self._nY) & (this_Y>=0)
+
+            indexes.append(np.where(iz, this_Y * self._nX + this_X, 0))
+            weights.append(np.where(iz, weight, 0.0))
+
+        indexes = np.array(indexes)
+        weights = np.array(weights)
+
+        # Keep only the positions with at least one pixel in the map
+
+        inside = np.flatnonzero(np.any(weights > 0, axis=0))
+
+        return inside, indexes[:, inside], weights[:, inside]
+
+    def _get_pixel_lookup(self, x, y):
+
+        key = array_fingerprint(np.asarray(x), np.asarray(y))
+
+        try:
+
+            lookup = self._pixel_lookups[key]
+
+        except KeyError:
+
+            lookup = self._compute_pixel_lookup(x, y)
+
+            self._pixel_lookups[key] = lookup
+
+            if len(self._pixel_lookups) > self._N_CACHED_LOOKUPS:
+
+                self._pixel_lookups.popitem(last=False)
+
+        else:
+
+            self._pixel_lookups.move_to_end(key)
+
+        return lookup
     
     def evaluate(self, x, y, K, hash):
         
         if self._map is None:
             
             self.load_file(self._fitsfile)
-          
-        # We assume x and y are R.A. and Dec
-        coord = SkyCoord(ra=x, dec=y, frame=self._frame, unit="deg")
-        
-        #transform input coordinates to pixel coordinates; 
-        #SkyCoord takes care of necessary coordinate frame transformations.
-        Xpix, Ypix = coord.to_pixel(self._wcs)
-        
-        Xpix = np.atleast_1d(Xpix.astype(int))
-        Ypix = np.atleast_1d(Ypix.astype(int))
-        
-        # find pixels that are in the template ROI, otherwise return zero
-        #iz = np.where((Xpix<self._nX) & (Xpix>=0) & (Ypix<self._nY) & (Ypix>=0))[0]
-        iz = (Xpix<self._nX) & (Xpix>=0) & (Ypix<self._nY) & (Ypix>=0)
-        out = np.zeros_like(Xpix).astype(float)
-        out[iz] = self._map[Ypix[iz], Xpix[iz]]
+
+        # The conversion to pixel coordinates is slow, so it is done only once for each set of input coordinates,
+        # which are usually the same at each evaluation
+
+        inside, indexes, weights = self._get_pixel_lookup(x, y)
+
+        flat_map = self._map.reshape(-1)
+
+        out = np.zeros(np.size(x))
+
+        if weights is None:
+
+            out[inside] = flat_map[indexes]
+
+        else:
+
+            out[inside] = np.sum(flat_map[indexes] * weights, axis=0)
         
         return np.multiply(K,out)
 
@@ -723,10 +898,11 @@ class SpatialTemplate_2D(Function2D, metaclass=FunctionMeta):
             self.load_file(self._fitsfile)
           
         #We use the max/min RA/Dec of the image corners to define the boundaries.
-        #Use the 'outside' of the pixel corners, i.e. from pixel 0 to nX in 0-indexed accounting.
+        #Use the 'outside' of the pixel corners, i.e. from pixel -0.5 to nX-0.5 in 0-indexed accounting (the centers
+        #of the pixels are at integer coordinates).
     
-        Xcorners = np.array( [0, 0,        self._nX, self._nX] )
-        Ycorners = np.array( [0, self._nY, 0,        self._nY] )
+        Xcorners = np.array( [-0.5, -0.5,          self._nX - 0.5, self._nX - 0.5] )
+        Ycorners = np.array( [-0.5, self._nY - 0.5, -0.5,          self._nY - 0.5] )
         
         corners = SkyCoord.from_pixel( Xcorners, Ycorners, wcs=self._wcs, origin = 0).transform_to(self._frame)  
      
@@ -814,8 +990,6 @@ class Power_law_on_sphere(Function2D, metaclass=FunctionMeta):
 
         lon, lat = x,y
 
-        angsep = angular_distance(lon0, lat0, lon, lat)
-
         if maxr <= minr:
             norm = np.power(np.pi / 180., 2.+index) * np.pi * maxr**2 * minr**index
         elif self.index.value == -2.:
@@ -823,6 +997,15 @@ class Power_law_on_sphere(Function2D, metaclass=FunctionMeta):
         else:
             norm = np.power(minr * np.pi / 180., 2.+index) * np.pi + 2. * np.pi / (2.+index) * (np.power(maxr * np.pi / 180., index+2.) - np.power(minr * np.pi / 180., index+2.))
 
+        if can_use_kernels(lon, lat, maxr, minr, norm):
+
+            vectors = get_pixel_coordinates(lon, lat).unit_vectors
+
+            return nb_func.power_law_on_sphere_eval(vectors, unit_vector(lon0, lat0), index, maxr, minr,
+                                                    norm).reshape(np.shape(lon))
+
+        angsep = angular_distance_from_center(lon0, lat0, lon, lat)
+
         value = np.less_equal(angsep,maxr) * np.power(np.pi / 180., index) * np.power(np.add(np.multiply(angsep, np.greater(angsep, minr)), np.multiply(minr, np.less_equal(angsep, minr))), index)
 
         return value / norm
@@ -1,16 +1,23 @@
 from __future__ import division
 
-import hashlib
+import collections
 
 import astropy.units as u
 import numpy as np
 from astropy.coordinates import ICRS, BaseCoordinateFrame, SkyCoord
-from astropy.io import fits
 from past.utils import old_div
 from scipy.interpolate import RegularGridInterpolator
 
+import astromodels.functions.numba_functions as nb_func
+from astromodels.core.memoization import array_fingerprint
 from astromodels.functions.function import Function3D, FunctionMeta
-from astromodels.utils.angular_distance import angular_distance_fast
+from astromodels.functions.numba_functions import can_use_kernels
+from astromodels.utils.angular_distance import angular_distance_from_center, get_pixel_coordinates, unit_vector
+from astromodels.utils.cached_files import (get_array_fingerprint, load_cached_array, load_cached_metadata,
+                                            open_fits_data)
+from astromodels.utils.logging import setup_logger
+
+log = setup_logger(__name__)
 
 
 class Continuous_injection_diffusion_ellipse(Function3D, metaclass=FunctionMeta):
@@ -146,11 +153,19 @@ class Continuous_injection_diffusion_ellipse(Function3D, metaclass=FunctionMeta)
             rdiff_a = np.array([(rdiff0 * np.power(old_div(e_energy_piv2, e_piv_piv2), x)).value for x in (delta - 1.) / 2. * np.sqrt(b * b / 8. / np.pi * 0.624 + 0.26 * np.power(1. + 0.0107 * e_piv_piv2, -1.5)) /
                                 np.sqrt(b * b / 8. / np.pi * 0.624 + 0.26 * np.power(1. + 0.0107 * e_energy_piv2, -1.5))]) * rdiff0.unit
 
+        if can_use_kernels(lon, lat, rdiff_a):
+
+            vectors = get_pixel_coordinates(lon, lat).unit_vectors
+
+            return nb_func.diffusion_ellipse_eval(vectors, unit_vector(lon0, lat0), np.ravel(lon).astype(float),
+                                                  np.ravel(lat).astype(float), lon0, lat0,
+                                                  np.ravel(rdiff_a).astype(float), incl, elongation)
+
         rdiff_b = rdiff_a * elongation
 
         pi = np.pi
 
-        angsep = angular_distance_fast(lon, lat, lon0, lat0)
+        angsep = angular_distance_from_center(lon0, lat0, lon, lat)
         ang = np.arctan2(lat - lat0, (lon - lon0) *
                          np.cos(lat0 * np.pi / 180.))
 
@@ -331,7 +346,13 @@ class Continuous_injection_diffusion(Function3D, metaclass=FunctionMeta):
 
         rdiff = np.minimum(rdiff_c, rdiff_i)
 
-        angsep = angular_distance_fast(lon, lat, lon0, lat0)
+        if can_use_kernels(lon, lat, rdiff):
+
+            vectors = get_pixel_coordinates(lon, lat).unit_vectors
+
+            return nb_func.diffusion_eval(vectors, unit_vector(lon0, lat0), np.ravel(rdiff).astype(float))
+
+        angsep = angular_distance_from_center(lon0, lat0, lon, lat)
 
         pi = np.pi
 
@@ -501,7 +522,13 @@ class Continuous_injection_diffusion_legacy(Function3D, metaclass=FunctionMeta):
             rdiff = np.array([(rdiff0 * np.power(old_div(e_energy_piv2, e_piv_piv2), x)).value for x in (delta - 1.) / 2. * np.sqrt(1. + uratio * np.power(1. + 0.0107 * e_piv_piv2, -1.5)) /
                               np.sqrt(1. + uratio * np.power(1. + 0.0107 * e_energy_piv2, -1.5))]) * rdiff0.unit
 
-        angsep = angular_distance_fast(lon, lat, lon0, lat0)
+        if can_use_kernels(lon, lat, rdiff):
+
+            vectors = get_pixel_coordinates(lon, lat).unit_vectors
+
+            return nb_func.diffusion_eval(vectors, unit_vector(lon0, lat0), np.ravel(rdiff).astype(float))
+
+        angsep = angular_distance_from_center(lon0, lat0, lon, lat)
 
         pi = np.pi
 
@@ -556,7 +583,7 @@ class Continuous_injection_diffusion_legacy(Function3D, metaclass=FunctionMeta):
         return np.ones_like(z)
 
 
-class GalPropTemplate_3D(Function3D):
+class GalPropTemplate_3D(Function3D, metaclass=FunctionMeta):
     r"""
         description :
 
@@ -582,7 +609,10 @@ class GalPropTemplate_3D(Function3D):
 
     """
 
-    __metaclass__ = FunctionMeta
+    _shared_attributes = ("_map", "_L", "_B", "_E", "_F")
+
+    # Number of grids (coordinates and energies) for which the interpolated map is kept
+    _N_CACHED_MAPS = 4
 
     def _set_units(self, x_unit, y_unit, z_unit, w_unit):
 
@@ -593,7 +623,13 @@ class GalPropTemplate_3D(Function3D):
         self._frame = ICRS()
         self._map = None
         self._fitsfile = None
-        self._interpmap = None
+        self._interpolation = "numba"
+
+        # The scipy interpolator is built only if the 'scipy' interpolation is used
+        self._F = None
+
+        # Interpolated maps by fingerprint of the input coordinates and energies
+        self._interpolated_maps = collections.OrderedDict()
 
     def set_frame(self, new_frame):
         """
@@ -606,6 +642,37 @@ class GalPropTemplate_3D(Function3D):
 
         self._frame = new_frame
 
+        self._interpolated_maps.clear()
+
+        self._mark_state_changed()
+
+    @property
+    def interpolation(self):
+        """
+        The implementation of the (trilinear) interpolation of the map: 'numba' or 'scipy'
+        """
+
+        return self._interpolation
+
+    def set_interpolation(self, method):
+        """
+        Set the implementation of the (trilinear) interpolation of the map
+
+        :param method: 'numba' (default, a compiled kernel exploiting the regular grid of the map) or 'scipy'
+        (RegularGridInterpolator)
+        :return: (none)
+        """
+
+        if method not in ("numba", "scipy"):
+
+            log.error("Interpolation method must be 'numba' or 'scipy', got %s" % method)
+
+            raise AssertionError()
+
+        self._interpolation = method
+
+        self._interpolated_maps.clear()
+
     def load_file(self, fitsfile, phi1, phi2, theta1, theta2, galactic=False, ihdu=0):
 
         if fitsfile is None:
@@ -620,37 +687,39 @@ class GalPropTemplate_3D(Function3D):
         self.decmin = t1
         self.decmax = t2
 
-        with fits.open(self._fitsfile) as f:
-
-            self._delLon = f[ihdu].header['CDELT1']
-            self._delLat = f[ihdu].header['CDELT2']
-            self._delEn = f[ihdu].header['CDELT3']
-            self._refLon = f[ihdu].header['CRVAL1']
-            self._refLat = f[ihdu].header['CRVAL2']
-            self._refEn = f[ihdu].header['CRVAL3']  # values in log10
-            self._map = f[ihdu].data
-            self._nl = f[ihdu].header['NAXIS1']  # longitude
-            self._nb = f[ihdu].header['NAXIS2']  # latitude
-            self._ne = f[ihdu].header['NAXIS3']  # energy
-
-            # Create the function for the interpolation
-            self._L = np.linspace(
-                self._refLon, self._refLon+(self._nl-1)*self._delLon, self._nl)
-            self._B = np.linspace(
-                self._refLat, self._refLat+(self._nb-1)*self._delLat, self._nb)
-            self._E = np.linspace(
-                self._refEn, self._refEn+(self._ne-1)*self._delEn, self._ne)
-            for i in range(len(self._E)):
-                # Map units in Mev / cm^2 s sr, changing to 1 / MeV cm^2 s sr
-                self._map[i] = self._map[i] / \
-                    (np.power(10, self._E[i])*np.power(10, self._E[i]))
-                self._map[i] = (np.fliplr(self._map[i]))
-            self._F = RegularGridInterpolator(
-                (self._E, self._B, self._L), self._map, bounds_error=False)
+        header, data = open_fits_data(self._fitsfile, ihdu)
+
+        self._delLon = header['CDELT1']
+        self._delLat = header['CDELT2']
+        self._delEn = header['CDELT3']
+        self._refLon = header['CRVAL1']
+        self._refLat = header['CRVAL2']
+        self._refEn = header['CRVAL3']  # values in log10
+        self._nl = header['NAXIS1']  # longitude
+        self._nb = header['NAXIS2']  # latitude
+        self._ne = header['NAXIS3']  # energy
+
+        # Create the function for the interpolation
+        self._L = np.linspace(
+            self._refLon, self._refLon+(self._nl-1)*self._delLon, self._nl)
+        self._B = np.linspace(
+            self._refLat, self._refLat+(self._nb-1)*self._delLat, self._nb)
+        self._E = np.linspace(
+            self._refEn, self._refEn+(self._ne-1)*self._delEn, self._ne)
+
+        # The preprocessed map is computed only the first time the file is used, then it is memory-mapped read-only
+        # from the cache, so that all the instances (and processes) using the same file share it
+        self._map = load_cached_array(self._fitsfile, "galprop_%i" % ihdu,
+                                      lambda: _preprocess_galprop_map(data, self._E))
 
-            h = hashlib.sha224()
-            h.update(self._map)
-            self.hash = int(h.hexdigest(), 16)
+        self._F = None
+
+        metadata = load_cached_metadata(self._fitsfile, "galprop_%i" % ihdu,
+                                        lambda: {"hash": get_array_fingerprint(self._map)})
+
+        self.hash = metadata["hash"]
+
+        self._interpolated_maps.clear()
 
     def to_dict(self, minimal=False):
 
@@ -679,46 +748,82 @@ class GalPropTemplate_3D(Function3D):
             self.load_file(self._fitsfile, self.ramin, self.ramax,
                            self.decmin, self.decmax, False, ihdu=0)
 
-        # Interpolated values can be cached since we are fitting the constant K
-        if self._interpmap is None:
-
-            # We assume x and y are R.A. and Dec
-            _coord = SkyCoord(ra=x, dec=y, frame=self._frame, unit="deg")
-            b = _coord.transform_to('galactic').b.value
-            l = _coord.transform_to('galactic').l.value
-            lon = l
-            lat = b
-
-            # transform energy from keV to MeV. Galprop Model starts at 100 MeV
-            energy = np.log10(z)-np.log10((u.MeV.to('keV')/u.keV).value)
-
-            if lon.size != lat.size:
-                raise AttributeError("Lon and Lat should be the same size")
-            f = np.zeros([lon.size, energy.size])
-            E0 = self._refEn
-            Ef = self._refEn + (self._ne-1)*self._delEn
-
-            # fix longitude
-            shift = np.where(lon > 180.)
-            lon[shift] = 180 - lon[shift]
-
-            for i in range(energy.size):
-                e = np.repeat(energy[i], len(lon))
-                try:
-                    f[:, i] = self._F(zip(e, lat, lon))
-                except ValueError:
-                    pass
-            bad_idx = np.isnan(f)
-            f[bad_idx] = 0
-            bad_idx = np.isinf(f)
-            f[bad_idx] = 0
-            assert np.all(np.isfinite(f)), "some interpolated values are wrong"
-            self._interpmap = f
+        # Interpolated values can be cached since we are fitting the constant K. They are kept for the last few
+        # grids, so that the same template can be used with different datasets
+        key = array_fingerprint(np.asarray(x), np.asarray(y), np.asarray(z))
+
+        try:
+
+            interpolated_map = self._interpolated_maps[key]
+
+        except KeyError:
+
+            interpolated_map = self._interpolate(x, y, z)
+
+            self._interpolated_maps[key] = interpolated_map
+
+            if len(self._interpolated_maps) > self._N_CACHED_MAPS:
+
+                self._interpolated_maps.popitem(last=False)
+
+        else:
+
+            self._interpolated_maps.move_to_end(key)
 
         # (1000 is to change from MeV to KeV)
-        A = np.multiply(K, self._interpmap/1000.)
+        A = np.multiply(K, interpolated_map/1000.)
         return A
 
+    def _interpolate(self, x, y, z):
+
+        # We assume x and y are R.A. and Dec
+        _coord = SkyCoord(ra=x, dec=y, frame=self._frame, unit="deg").transform_to('galactic')
+
+        lon = np.atleast_1d(_coord.l.value)
+        lat = np.atleast_1d(_coord.b.value)
+
+        if lon.size != lat.size:
+            raise AttributeError("Lon and Lat should be the same size")
+
+        # transform energy from keV to MeV. Galprop Model starts at 100 MeV
+        energy = np.atleast_1d(np.log10(z)-np.log10((u.MeV.to('keV')/u.keV).value)).astype(float)
+
+        # fix longitude
+        lon = np.where(lon > 180., 180 - lon, lon)
+
+        if self._interpolation == "numba":
+
+            f = nb_func.trilinear_eval(self._map, np.array([self._refEn, self._refLat, self._refLon]),
+                                       np.array([self._delEn, self._delLat, self._delLon]),
+                                       energy, lat, lon)
+
+        else:
+
+            # One interpolation for all the combinations of positions and energies
+
+            points = np.empty((lon.size, energy.size, 3))
+
+            points[..., 0] = energy[np.newaxis, :]
+            points[..., 1] = lat[:, np.newaxis]
+            points[..., 2] = lon[:, np.newaxis]
+
+            f = self._get_scipy_interpolator()(points)
+
+        f[~np.isfinite(f)] = 0
+
+        return f
+
+    def _get_scipy_interpolator(self):
+
+        # Building the interpolator takes time and memory, so it is done only the first time it is needed
+
+        if self._F is None:
+
+            self._F = RegularGridInterpolator(
+                (self._E, self._B, self._L), self._map, bounds_error=False)
+
+        return self._F
+
     def define_region(self, a, b, c, d, galactic=False):
         if galactic:
             lmin = a
@@ -747,3 +852,12 @@ class GalPropTemplate_3D(Function3D):
         min_latitude = self.decmin
         max_latitude = self.decmax
         return (min_longitude, max_longitude), (min_latitude, max_latitude)
+
+
+def _preprocess_galprop_map(data, log_energies):
+
+    # Map units in MeV / cm^2 s sr, changing to 1 / MeV cm^2 s sr, and flip the longitude axis
+
+    energies = np.power(10, log_energies)
+
+    return np.flip(np.asarray(data, dtype=float) / (energies * energies)[:, np.newaxis, np.newaxis], axis=2)
@@ -1,9 +1,124 @@
 import ctypes
+import functools
 import math
+import types
 
+import astropy.units as u
 import numba as nb
 import numpy as np
 
+from astromodels.utils.configuration import get_numba_policy
+
+class NumbaKernel(object):
+    """
+    A function compiled with numba according to the current execution policy (parallel or serial, fastmath or
+    strict IEEE math, see astromodels.utils.configuration.set_numba_policy). Each variant is compiled the first time
+    it is needed, and cached on disk. Use the kernel decorator to create instances.
+
+    :param py_func: the python function
+    :param parallelizable: whether the function has loops which can run in parallel (with numba.prange) or array
+    expressions. Functions working on scalars always run serially
+    """
+
+    def __init__(self, py_func, parallelizable=True):
+
+        self._py_func = py_func
+        self._parallelizable = parallelizable
+        self._variants = {}
+
+        functools.update_wrapper(self, py_func)
+
+    def get_variant(self, parallel, fastmath):
+        """
+        Returns the compiled function for the given policy
+
+        :param parallel: whether to run in parallel
+        :param fastmath: whether to allow fast math
+        :return: a numba dispatcher
+        """
+
+        key = (bool(parallel) and self._parallelizable, bool(fastmath))
+
+        try:
+
+            return self._variants[key]
+
+        except KeyError:
+
+            pass
+
+        # The cache of numba is indexed by the qualified name of the function, not by the compilation options, so
+        # each variant needs a copy of the function with its own name
+
+        py_func = types.FunctionType(self._py_func.__code__, self._py_func.__globals__, self._py_func.__name__,
+                                     self._py_func.__defaults__, self._py_func.__closure__)
+
+        py_func.__qualname__ = "%s_%s_%s" % (self._py_func.__qualname__, "parallel" if key[0] else "serial",
+                                             "fastmath" if key[1] else "strict")
+        py_func.__module__ = self._py_func.__module__
+
+        variant = nb.njit(parallel=key[0], fastmath=key[1], cache=True, nogil=True)(py_func)
+
+        self._variants[key] = variant
+
+        return variant
+
+    def __call__(self, *args):
+
+        policy = get_numba_policy()
+
+        parallel = policy["parallel"] and self._parallelizable
+
+        variant = self.get_variant(parallel, policy["fastmath"])
+
+        if not parallel or policy["n_threads"] is None:
+
+            return variant(*args)
+
+        # The number of threads is changed only for this call, so that the one set by the user (with
+        # numba.set_num_threads) is preserved
+
+        old_n_threads = nb.get_num_threads()
+
+        nb.set_num_threads(min(policy["n_threads"], nb.config.NUMBA_NUM_THREADS))
+
+        try:
+
+            return variant(*args)
+
+        finally:
+
+            nb.set_num_threads(old_n_threads)
+
+
+def kernel(py_func=None, parallelizable=True):
+    """
+    Decorator compiling a function with numba according to the execution policy of astromodels (see NumbaKernel).
+    It can be used as @kernel, or as @kernel(parallelizable=False) for functions of scalars.
+    """
+
+    if py_func is None:
+
+        return functools.partial(kernel, parallelizable=parallelizable)
+
+    return NumbaKernel(py_func, parallelizable)
+
+
+def _set_threading_layer():
+
+    # The threading layer of numba is changed only if one was chosen explicitly (with the environment variable
+    # ASTROMODELS_NUMBA_THREADING_LAYER here, or later with set_numba_policy)
+
+    threading_layer = get_numba_policy()["threading_layer"]
+
+    if threading_layer is not None:
+
+        nb.config.THREADING_LAYER = threading_layer
+
+
+_set_threading_layer()
+
+
 # from numba.extending import get_cython_function_address
 
 # addr1 = get_cython_function_address(
@@ -27,7 +142,7 @@ import numpy as np
 #     return gamma_fn(x)
 
 
-@nb.njit(fastmath=True, cache=True)
+@kernel
 def plaw_eval(x, K, index, piv):
 
     out = np.power(x / piv, index)
@@ -35,7 +150,7 @@ def plaw_eval(x, K, index, piv):
     return K * out
 
 
-@nb.njit(fastmath=True, cache=True)
+@kernel(parallelizable=False)
 def plaw_flux_norm(index, a, b):
     """
     energy flux power law
@@ -53,13 +168,13 @@ def plaw_flux_norm(index, a, b):
     return intflux
 
 
-@nb.njit(fastmath=True, cache=True)
+@kernel
 def cplaw_eval(x, K, xc, index, piv):
 
     n = x.shape[0]
     out = np.empty(n)
 
-    for i in range(n):
+    for i in nb.prange(n):
         # Compute it in logarithm to avoid roundoff errors, then raise it
         log_v = index * np.log(x[i] / piv) - (x[i] / xc)
         out[i] = K * np.exp(log_v)
@@ -67,13 +182,13 @@ def cplaw_eval(x, K, xc, index, piv):
     return out
 
 
-@nb.njit(fastmath=True, cache=True)
+@kernel
 def cplaw_inverse_eval(x, K, b, index, piv):
 
     n = x.shape[0]
     out = np.empty(n)
 
-    for i in range(n):
+    for i in nb.prange(n):
         # Compute it in logarithm to avoid roundoff errors, then raise it
         log_v = index * np.log(x[i] / piv) - x[i] * b
         out[i] = K * np.exp(log_v)
@@ -81,13 +196,13 @@ def cplaw_inverse_eval(x, K, b, index, piv):
     return out
 
 
-@nb.njit(fastmath=True, cache=True)
+@kernel
 def super_cplaw_eval(x, K, piv, index, xc, gamma):
 
     n = x.shape[0]
     out = np.empty(n)
 
-    for i in range(n):
+    for i in nb.prange(n):
 
         log_v = index * np.log(x[i] / piv) - gamma*(x[i] / xc)
 
@@ -96,7 +211,7 @@ def super_cplaw_eval(x, K, piv, index, xc, gamma):
     return out
 
 
-@nb.njit(fastmath=True, cache=True)
+@kernel
 def band_eval(x, K, alpha, beta, E0, piv):
 
     n = x.shape[0]
@@ -107,7 +222,7 @@ def band_eval(x, K, alpha, beta, E0, piv):
     factor_ab = np.exp(beta - alpha) * \
         math.pow(break_point / piv, alpha - beta)
 
-    for idx in range(n):
+    for idx in nb.prange(n):
 
         if x[idx] < break_point:
             out[idx] = K * math.pow(x[idx] / piv, alpha) * np.exp(-x[idx] / E0)
@@ -119,7 +234,7 @@ def band_eval(x, K, alpha, beta, E0, piv):
     return out
 
 
-@nb.njit(fastmath=True, cache=True)
+@kernel
 def bplaw_eval(x, K, xb, alpha, beta, piv):
 
     n = x.shape[0]
@@ -127,7 +242,7 @@ def bplaw_eval(x, K, xb, alpha, beta, piv):
 
     factor = math.pow(xb / piv, alpha - beta)
 
-    for idx in range(n):
+    for idx in nb.prange(n):
 
         if x[idx] < xb:
 
@@ -139,7 +254,7 @@ def bplaw_eval(x, K, xb, alpha, beta, piv):
     return out
 
 
-@nb.njit(fastmath=True, cache=True)
+@kernel
 def sbplaw_eval(x, K, alpha, be, bs, beta, piv):
 
     n = x.shape[0]
@@ -166,7 +281,7 @@ def sbplaw_eval(x, K, alpha, be, bs, beta, piv):
 
     ten_pcosh_piv = math.pow(10., pcosh_piv)
 
-    for idx in range(n):
+    for idx in nb.prange(n):
 
         arg = np.log10(x[idx] / be) / bs
 
@@ -188,20 +303,20 @@ def sbplaw_eval(x, K, alpha, be, bs, beta, piv):
     return out
 
 
-@nb.njit(fastmath=True, cache=True)
+@kernel
 def bb_eval(x, K, kT):
 
     n = x.shape[0]
     out = np.empty(n)
 
-    for idx in range(n):
+    for idx in nb.prange(n):
 
         arg = x[idx]/kT
         out[idx] = K * x[idx] * x[idx] / np.expm1(arg)
 
     return out
 
-# @nb.njit(fastmath=True, cache=True)
+# @nb.njit(fastmath=True, cache=True, nogil=True)
 # def bbrad_eval(x, K, kT):
 
 #     n = x.shape[0]
@@ -218,7 +333,7 @@ def bb_eval(x, K, kT):
 # band calderone
 
 
-@nb.njit(fastmath=True, cache=True)
+@kernel(parallelizable=False)
 def ggrb_int_pl(a, b, Ec, Emin, Emax):
 
     pre = math.pow(a - b, a - b) * math.exp(b - a) / math.pow(Ec, b)
@@ -233,7 +348,7 @@ def ggrb_int_pl(a, b, Ec, Emin, Emax):
         return pre * math.log(Emax/Emin)
 
 
-# @nb.njit(fastmath=True, cache=True)
+# @nb.njit(fastmath=True, cache=True, nogil=True)
 # def ggrb_int_cpl(a, Ec, Emin, Emax):
 
 #     # Gammaincc does not support quantities
@@ -241,3 +356,360 @@ def ggrb_int_pl(a, b, Ec, Emin, Emax):
 #     i2 = vec_gammaincc(2 + a, Emax/Ec) * vec_gamma(2 + a)
 
 #     return -Ec * Ec * (i2 - i1)
+
+
+# Spatial shapes. The positions are given as unit vectors (see astromodels.utils.angular_distance.PixelCoordinates),
+# so that the angular distance, the profile and the normalization are computed in one pass over the pixels
+
+
+def can_use_kernels(*values):
+    """
+    Returns True if the compiled kernels can be used for these inputs (i.e., none of them has units)
+    """
+
+    return not any(isinstance(value, u.Quantity) for value in values)
+
+
+@nb.njit(inline="always")
+def _angular_distance(vectors, i, center):
+
+    # Distance in degrees between the i-th position and the center. As in PixelCoordinates, the length of the
+    # chord is used close to the center and to its antipode, where the arccos loses precision
+
+    cos_d = vectors[i, 0] * center[0] + vectors[i, 1] * center[1] + vectors[i, 2] * center[2]
+
+    if cos_d > 0.99:
+
+        chord = math.sqrt((vectors[i, 0] - center[0]) ** 2 + (vectors[i, 1] - center[1]) ** 2 +
+                          (vectors[i, 2] - center[2]) ** 2)
+
+        return math.degrees(2.0 * math.asin(min(0.5 * chord, 1.0)))
+
+    elif cos_d < -0.99:
+
+        chord = math.sqrt((vectors[i, 0] + center[0]) ** 2 + (vectors[i, 1] + center[1]) ** 2 +
+                          (vectors[i, 2] + center[2]) ** 2)
+
+        return 180.0 - math.degrees(2.0 * math.asin(min(0.5 * chord, 1.0)))
+
+    else:
+
+        return math.degrees(math.acos(cos_d))
+
+
+@kernel
+def gaussian_on_sphere_eval(vectors, center, sigma):
+
+    n = vectors.shape[0]
+    out = np.empty(n)
+
+    s2 = sigma * sigma
+
+    norm = (180.0 / math.pi) ** 2 / (2.0 * math.pi * s2)
+
+    for i in nb.prange(n):
+
+        angsep = _angular_distance(vectors, i, center)
+
+        out[i] = norm * math.exp(-0.5 * angsep * angsep / s2)
+
+    return out
+
+
+@kernel
+def asymm_gaussian_on_sphere_eval(lon, lat, lon0, lat0, a, b, A, B, C):
+
+    # Signed distances along the parallel and along the meridian of the center
+
+    n = lon.shape[0]
+    out = np.empty(n)
+
+    norm = (180.0 / math.pi) ** 2 / (2.0 * math.pi * a * b)
+
+    cos_lat0 = math.cos(math.radians(lat0))
+
+    for i in nb.prange(n):
+
+        dlon = lon[i] - lon0
+
+        dX = math.degrees(2.0 * math.asin(min(abs(cos_lat0 * math.sin(math.radians(dlon) / 2.0)), 1.0)))
+
+        if (dlon < 0 or dlon > 180) and (dlon > -180 or dlon < -360):
+
+            dX = -dX
+
+        dY = lat[i] - lat0
+
+        out[i] = norm * math.exp(-A * dX * dX + 2.0 * B * dX * dY - C * dY * dY)
+
+    return out
+
+
+@kernel
+def disk_on_sphere_eval(vectors, center, radius):
+
+    n = vectors.shape[0]
+    out = np.empty(n)
+
+    norm = (180.0 / math.pi) ** 2 / (math.pi * radius * radius)
+
+    for i in nb.prange(n):
+
+        if _angular_distance(vectors, i, center) <= radius:
+
+            out[i] = norm
+
+        else:
+
+            out[i] = 0.0
+
+    return out
+
+
+@kernel
+def ellipse_on_sphere_eval(vectors, focus1, focus2, a, b):
+
+    n = vectors.shape[0]
+    out = np.empty(n)
+
+    norm = (180.0 / math.pi) ** 2 / (math.pi * a * b)
+
+    for i in nb.prange(n):
+
+        if _angular_distance(vectors, i, focus1) + _angular_distance(vectors, i, focus2) <= 2 * a:
+
+            out[i] = norm
+
+        else:
+
+            out[i] = 0.0
+
+    return out
+
+
+@kernel
+def power_law_on_sphere_eval(vectors, center, index, maxr, minr, norm):
+
+    n = vectors.shape[0]
+    out = np.empty(n)
+
+    factor = math.pow(math.pi / 180.0, index) / norm
+
+    for i in nb.prange(n):
+
+        angsep = _angular_distance(vectors, i, center)
+
+        if angsep <= maxr:
+
+            out[i] = factor * math.pow(max(angsep, minr), index)
+
+        else:
+
+            out[i] = 0.0
+
+    return out
+
+
+@kernel
+def diffusion_eval(vectors, center, rdiff):
+
+    n = vectors.shape[0]
+    m = rdiff.shape[0]
+    out = np.empty((n, m))
+
+    norm = (180.0 / math.pi) ** 2 * 1.2154 / (math.pi * math.sqrt(math.pi))
+
+    for i in nb.prange(n):
+
+        angsep = _angular_distance(vectors, i, center)
+
+        for j in range(m):
+
+            r = rdiff[j]
+
+            out[i, j] = norm / (r * (angsep + 0.06 * r)) * math.exp(-angsep * angsep / (r * r))
+
+    return out
+
+
+@kernel
+def diffusion_ellipse_eval(vectors, center, lon, lat, lon0, lat0, rdiff_a, incl, elongation):
+
+    n = vectors.shape[0]
+    m = rdiff_a.shape[0]
+    out = np.empty((n, m))
+
+    norm = (180.0 / math.pi) ** 2 * 1.22 / (math.pi * math.sqrt(math.pi) * math.sqrt(elongation))
+
+    cos_lat0 = math.cos(math.radians(lat0))
+
+    for i in nb.prange(n):
+
+        angsep = _angular_distance(vectors, i, center)
+
+        ang = math.atan2(lat[i] - lat0, (lon[i] - lon0) * cos_lat0)
+
+        theta = math.atan2(math.sin(ang - math.radians(incl)) / elongation, math.cos(ang - math.radians(incl)))
+
+        cos2_theta = math.cos(theta) ** 2
+        sin2_theta = math.sin(theta) ** 2
+
+        for j in range(m):
+
+            r_a = rdiff_a[j]
+            r_b = r_a * elongation
+
+            r = math.sqrt(r_a * r_a * cos2_theta + r_b * r_b * sin2_theta)
+
+            out[i, j] = norm / (r_a * (angsep + 0.06 * r)) * math.exp(-angsep * angsep / (r * r))
+
+    return out
+
+
+@nb.njit(inline="always")
+def _grid_position(x, x0, dx, n):
+
+    # Index of the cell of a regular grid containing x, and position within the cell. The index is -1 outside
+    # of the grid (the last node belongs to the last cell)
+
+    t = (x - x0) / dx
+
+    if not (t >= 0.0 and t <= n - 1):
+
+        return -1, 0.0
+
+    i = min(int(t), n - 2)
+
+    return i, t - i
+
+
+@kernel
+def trilinear_eval(values, origins, steps, z, y, x):
+
+    # Trilinear interpolation on a regular grid values[k, j, i] (with origins and steps along each axis), for
+    # all the combinations of the points (y, x) and of z. Points outside of the grid get 0
+
+    n = y.shape[0]
+    m = z.shape[0]
+    out = np.zeros((n, m))
+
+    nz, ny, nx = values.shape
+
+    cells_z = np.empty(m, dtype=np.int64)
+    positions_z = np.empty(m)
+
+    for j in range(m):
+
+        cells_z[j], positions_z[j] = _grid_position(z[j], origins[0], steps[0], nz)
+
+    for i in nb.prange(n):
+
+        jy, ty = _grid_position(y[i], origins[1], steps[1], ny)
+        ix, tx = _grid_position(x[i], origins[2], steps[2], nx)
+
+        if jy < 0 or ix < 0:
+
+            continue
+
+        for j in range(m):
+
+            k = cells_z[j]
+            tz = positions_z[j]
+
+            if k < 0:
+
+                continue
+
+            result = 0.0
+
+            for dk in range(2):
+
+                wz = tz if dk == 1 else 1.0 - tz
+
+                for dj in range(2):
+
+                    wy = ty if dj == 1 else 1.0 - ty
+
+                    for di in range(2):
+
+                        wx = tx if di == 1 else 1.0 - tx
+
+                        result += wz * wy * wx * values[k + dk, jy + dj, ix + di]
+
+            out[i, j] = result
+
+    return out
+
+
+@kernel
+def ebl_optical_depth_eval(table, energy_cells, energy_weights, z_nodes, z):
+
+    # Bilinear interpolation of a table of optical depths table[j, k] (energy j, redshift k nodes) at the
+    # redshift z, for energies already located in the table (cell and weight along the energy axis). Redshifts
+    # outside of the table are clamped to its edges
+
+    n_z = z_nodes.shape[0]
+
+    if z <= z_nodes[0]:
+
+        k = 0
+        tz = 0.0
+
+    elif z >= z_nodes[n_z - 1]:
+
+        k = n_z - 2
+        tz = 1.0
+
+    else:
+
+        k = np.searchsorted(z_nodes, z, side="right") - 1
+        tz = (z - z_nodes[k]) / (z_nodes[k + 1] - z_nodes[k])
+
+    n = energy_cells.shape[0]
+    out = np.empty(n)
+
+    for i in nb.prange(n):
+
+        j = energy_cells[i]
+        te = energy_weights[i]
+
+        low = table[j, k] * (1.0 - te) + table[j + 1, k] * te
+        high = table[j, k + 1] * (1.0 - te) + table[j + 1, k + 1] * te
+
+        out[i] = low * (1.0 - tz) + high * tz
+
+    return out
+
+
+@kernel
+def dm_spectrum_eval(mass_nodes, x_nodes, table, mass, xm):
+
+    # Bilinear interpolation of a table of spectra table[j, k] (mass j, x = log10(E / mass) k nodes) at the mass
+    # and at all the xm, with linear extrapolation outside of the table. The spectrum is 0 above the mass (xm > 0)
+
+    n_mass = mass_nodes.shape[0]
+    n_x = x_nodes.shape[0]
+
+    j = min(max(np.searchsorted(mass_nodes, mass) - 1, 0), n_mass - 2)
+    tm = (mass - mass_nodes[j]) / (mass_nodes[j + 1] - mass_nodes[j])
+
+    n = xm.shape[0]
+    out = np.empty(n)
+
+    for i in nb.prange(n):
+
+        if xm[i] > 0:
+
+            out[i] = 0.0
+
+            continue
+
+        k = min(max(np.searchsorted(x_nodes, xm[i]) - 1, 0), n_x - 2)
+        tx = (xm[i] - x_nodes[k]) / (x_nodes[k + 1] - x_nodes[k])
+
+        low = table[j, k] * (1.0 - tx) + table[j, k + 1] * tx
+        high = table[j + 1, k] * (1.0 - tx) + table[j + 1, k + 1] * tx
+
+        out[i] = low * (1.0 - tm) + high * tm
+
+    return out
@@ -1,10 +1,14 @@
 from __future__ import division
 
 import collections
+import itertools
+import json
 import os
 import re
 import warnings
+import weakref
 from builtins import object, range, str
+from pathlib import Path
 
 import astropy.io.fits as fits
 import astropy.units as u
@@ -13,11 +17,13 @@ import pandas as pd
 import scipy.interpolate
 from future.utils import with_metaclass
 from pandas import HDFStore
-from pandas.api.types import infer_dtype
 from past.utils import old_div
 
+from astromodels.core.evaluation_grid import get_grid_data
+from astromodels.core.memoization import array_fingerprint
 from astromodels.core.parameter import Parameter
 from astromodels.functions.function import Function1D, FunctionMeta
+from astromodels.utils.cached_files import _write_atomically, get_file_key, load_cached_array
 from astromodels.utils.configuration import get_user_data_path
 from astromodels.utils.logging import setup_logger
 
@@ -34,6 +40,7 @@ __all__ = [
     "MissingDataFile",
     "TemplateModelFactory",
     "TemplateModel",
+    "convert_hdf_template",
 ]
 
 
@@ -52,42 +59,139 @@ class MissingDataFile(RuntimeError):
 # This dictionary will keep track of the new classes already created in the current session
 _classes_cache = {}
 
+# Templates are stored in the user data directory as a contiguous array of the differential fluxes, with shape
+# (n_1, ..., n_d, n_energies) for d parameters, in a .npy file which is memory-mapped when the template is loaded,
+# and a .json file with the same name containing the description, the interpolation settings, the grids of the
+# parameters and the energies. Templates created by older versions in HDF5 files (.h5) are converted on first use
 
-# currently python2 lacks support for the faster interpolations
-# thus we need to use some work arounds to keep the code compatible
-# with the different versions. This means template models are slower
-# in python2
+_TEMPLATE_FORMAT_VERSION = 1
 
-try:
+# Templates currently loaded in this process, by file version and interpolation space. They are shared by all the
+# TemplateModel instances (and their clones) using them, and released when none of them is left
 
-    from interpolation import interp
-    from interpolation.splines import eval_linear
+_templates = weakref.WeakValueDictionary()
 
-    class GridInterpolate(object):
-        def __init__(self, grid, values):
-            self._grid = grid
-            self._values = np.ascontiguousarray(values)
 
-        def __call__(self, v):
+def _get_template_paths(model_name):
 
-            return eval_linear(self._grid, self._values, v)
+    data_dir_path = get_user_data_path()
 
-    class UnivariateSpline(object):
-        def __init__(self, x, y):
+    base_path = os.path.abspath(os.path.join(data_dir_path, model_name))
 
-            self._x = x
-            self._y = y
+    return "%s.npy" % base_path, "%s.json" % base_path, "%s.h5" % base_path
 
-        def __call__(self, v):
 
-            return interp(self._x, self._y, v)
+def _write_template(model_name, data, parameters_grids, energies, metadata):
 
+    data_file, metadata_file, _ = _get_template_paths(model_name)
 
-except:
+    content = dict(metadata)
 
-    from scipy.interpolate import \
-        InterpolatedUnivariateSpline as UnivariateSpline
-    from scipy.interpolate import RegularGridInterpolator as GridInterpolate
+    content["format_version"] = _TEMPLATE_FORMAT_VERSION
+    content["parameters"] = [[name, np.asarray(grid, dtype=float).tolist()] for name, grid in parameters_grids.items()]
+    content["energies"] = np.asarray(energies, dtype=float).tolist()
+
+    data = np.ascontiguousarray(data, dtype=np.float64)
+
+    _write_atomically(Path(data_file), lambda f: np.save(f, data))
+
+    _write_atomically(Path(metadata_file), lambda f: f.write(json.dumps(content).encode("utf-8")))
+
+
+def convert_hdf_template(model_name, overwrite=False):
+    """
+    Converts a template saved in HDF5 format (.h5) in the user data directory by previous versions of astromodels to
+    the current format. This is done automatically the first time an HDF5 template is used.
+
+    :param model_name: the name of the template
+    :param overwrite: whether to overwrite the template in the current format if it already exists (default: False)
+    :return: the path of the converted template
+    """
+
+    data_file, _, hdf_file = _get_template_paths(model_name)
+
+    if not os.path.exists(hdf_file):
+
+        raise MissingDataFile("The data file %s does not exists." % hdf_file)
+
+    if os.path.exists(data_file) and not overwrite:
+
+        log.error("The template %s already exists in the current format" % data_file)
+
+        raise IOError()
+
+    with HDFStore(hdf_file) as store:
+
+        data_frame = store["data_frame"]
+
+        parameters_grids = collections.OrderedDict()
+
+        processed_parameters = 0
+
+        for key in list(store.keys()):
+
+            match = re.search("p_([0-9]+)_(.+)", key)
+
+            if match is None:
+
+                continue
+
+            else:
+
+                tokens = match.groups()
+
+                this_parameter_number = int(tokens[0])
+                this_parameter_name = str(tokens[1])
+
+                assert (
+                    this_parameter_number == processed_parameters
+                ), "Parameters out of order!"
+
+                parameters_grids[this_parameter_name] = np.array(store[key], dtype=float)
+
+                processed_parameters += 1
+
+        energies = np.array(store["energies"], dtype=float)
+
+        metadata = store.get_storer("data_frame").attrs.metadata
+
+    # The rows of the data frame follow the product of the grids, so the templates just need a reshape
+
+    data_shape = [grid.shape[0] for grid in parameters_grids.values()]
+
+    data = np.array(data_frame[list(energies)].values, dtype=float).reshape(*(data_shape + [energies.shape[0]]))
+
+    log.info("Converting the template %s to %s" % (hdf_file, data_file))
+
+    _write_template(
+        model_name,
+        data,
+        parameters_grids,
+        energies,
+        {
+            "description": metadata["description"],
+            "name": metadata["name"],
+            "interpolation_degree": int(metadata["interpolation_degree"]),
+            "spline_smoothing_factor": int(metadata["spline_smoothing_factor"]),
+        },
+    )
+
+    return data_file
+
+
+def _load_template(data_file, log_interp):
+
+    key = (get_file_key(data_file), bool(log_interp))
+
+    template = _templates.get(key)
+
+    if template is None:
+
+        template = _TemplateData(data_file, log_interp)
+
+        _templates[key] = template
+
+    return template
 
 
 class TemplateModelFactory(object):
@@ -282,17 +386,6 @@ class TemplateModelFactory(object):
 
             raise ValuesNotInGrid()
 
-    @staticmethod
-    def _clean_cols_for_hdf(data):
-
-        types = data.apply(lambda x: infer_dtype(x.values))
-
-        for col in types.index:
-
-            data[col] = pd.to_numeric(data[col])
-
-        return data
-
     def save_data(self, overwrite=False):
 
         # First make sure that the whole data matrix has been filled
@@ -309,24 +402,27 @@ class TemplateModelFactory(object):
 
         # Sanitize the data file
 
-        filename_sanitized = os.path.abspath(
-            os.path.join(data_dir_path, "%s.h5" % self._name)
-        )
+        filename_sanitized, metadata_file_name, hdf_file_name = _get_template_paths(self._name)
 
-        # Check that it does not exists
-        if os.path.exists(filename_sanitized):
+        # Check that it does not exists (also in the format of previous versions)
+
+        for existing_file_name in (filename_sanitized, metadata_file_name, hdf_file_name):
+
+            if not os.path.exists(existing_file_name):
+
+                continue
 
             if overwrite:
 
                 try:
 
-                    os.remove(filename_sanitized)
+                    os.remove(existing_file_name)
 
                 except:
 
                     log.error(
                         "The file %s already exists and cannot be removed (maybe you do not have "
-                        "permissions to do so?). " % filename_sanitized
+                        "permissions to do so?). " % existing_file_name
                     )
 
                     raise IOError()
@@ -335,34 +431,32 @@ class TemplateModelFactory(object):
 
                 log.error(
                     "The file %s already exists! You cannot call two different "
-                    "template models with the same name" % filename_sanitized
+                    "template models with the same name" % existing_file_name
                 )
 
                 raise IOError()
 
-        # Open the HDF5 file and write objects
-
-        with HDFStore(filename_sanitized) as store:
+        # The rows of the data frame follow the product of the grids, so the templates are stored as an array
+        # with one axis per parameter, and the energies as last axis
 
-            # The _clean_cols_for_hdf is needed because for some reasons the format of some columns
-            # is not accepted by .to_hdf otherwise
+        data_shape = [grid.shape[0] for grid in self._parameters_grids.values()]
 
-            self._clean_cols_for_hdf(self._data_frame).to_hdf(store, "data_frame")
+        data = np.array(self._data_frame.values, dtype=float).reshape(
+            *(data_shape + [self._energies.shape[0]])
+        )
 
-            store.get_storer("data_frame").attrs.metadata = {
+        _write_template(
+            self._name,
+            data,
+            self._parameters_grids,
+            self._energies,
+            {
                 "description": self._description,
                 "name": self._name,
                 "interpolation_degree": int(self._interpolation_degree),
                 "spline_smoothing_factor": self._spline_smoothing_factor,
-            }
-
-            for i, parameter_name in enumerate(self._parameters_grids.keys()):
-
-                store["p_%i_%s" % (i, parameter_name)] = pd.Series(
-                    self._parameters_grids[parameter_name]
-                )
-
-            store["energies"] = pd.Series(self._energies)
+            },
+        )
 
 
 # This adds a method to a class at runtime
@@ -377,24 +471,222 @@ def add_method(self, method, name=None):
     setattr(self.__class__, name, method)
 
 
-class RectBivariateSplineWrapper(object):
+class _LinearTemplateInterpolator(object):
     """
-    Wrapper around RectBivariateSpline, which supplies a __call__ method which accept the same
-    syntax as the other interpolation methods
+    Multi-linear interpolation of the templates on the grid of the parameters (with linear extrapolation), for all
+    the tabulated energies at once: the cell and the weights of its corners are computed once for the requested point,
+    then the spectra of the corners are blended with a single matrix product
+
+    :param grids: the grids of the parameters
+    :param data: the (log of the) templates, with shape (n_1, ..., n_d, n_energies)
+    """
+
+    def __init__(self, grids, data):
+
+        self._grids = [np.array(grid, dtype=float) for grid in grids]
+
+        shape = data.shape[:-1]
+
+        self._table = np.ascontiguousarray(data.reshape(-1, data.shape[-1]), dtype=float)
+
+        # Index in the flattened table of the 2^d corners of a cell, relative to its lowest corner
+
+        self._corners = np.array(list(itertools.product((0, 1), repeat=len(shape))), dtype=np.int64)
+
+        self._strides = np.array([int(np.prod(shape[i + 1:])) for i in range(len(shape))], dtype=np.int64)
+
+        self._corner_offsets = self._corners.dot(self._strides)
+
+    def __call__(self, point):
+
+        point = np.asarray(point, dtype=float)
+
+        cells = np.empty(len(self._grids), dtype=np.int64)
+        fractions = np.empty(len(self._grids))
+
+        for i, grid in enumerate(self._grids):
+
+            cells[i] = min(max(np.searchsorted(grid, point[i], side="right") - 1, 0), grid.shape[0] - 2)
+
+            fractions[i] = (point[i] - grid[cells[i]]) / (grid[cells[i] + 1] - grid[cells[i]])
 
+        weights = np.prod(np.where(self._corners == 1, fractions, 1.0 - fractions), axis=1)
+
+        return weights.dot(self._table[cells.dot(self._strides) + self._corner_offsets])
+
+
+class _SplineTemplateInterpolator(object):
+    """
+    Interpolation of the templates with a bivariate spline on the grid of two parameters, for all the tabulated
+    energies at once. When the splines of all the energies have the same knots (always the case for interpolating
+    splines, i.e. without smoothing) the spline basis is evaluated once at the requested point, and the spectrum is
+    a product with the matrix of the coefficients of all the splines. Otherwise each spline is evaluated in turn.
+
+    :param x: the grid of the first parameter
+    :param y: the grid of the second parameter
+    :param data: the (log of the) templates, with shape (n_x, n_y, n_energies)
+    :param degree: the degree of the splines
+    :param smoothing: the smoothing factor of the splines
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, x, y, data, degree, smoothing):
+
+        splines = [
+            scipy.interpolate.RectBivariateSpline(x, y, data[:, :, i], kx=degree, ky=degree, s=smoothing)
+            for i in range(data.shape[-1])
+        ]
+
+        tx, ty = splines[0].get_knots()
+
+        if all(
+            np.array_equal(tx, spline.get_knots()[0]) and np.array_equal(ty, spline.get_knots()[1])
+            for spline in splines
+        ):
+
+            n_x = tx.shape[0] - degree - 1
+            n_y = ty.shape[0] - degree - 1
+
+            # Coefficients c[i, j, energy] of the B-splines Bx_i(x) By_j(y)
+
+            self._coefficients = np.ascontiguousarray(
+                np.array([spline.get_coeffs() for spline in splines]).T.reshape(n_x, n_y * data.shape[-1]))
+
+            self._n_y = n_y
+
+            self._bases = (scipy.interpolate.BSpline(tx, np.eye(n_x), degree),
+                           scipy.interpolate.BSpline(ty, np.eye(n_y), degree))
+
+            # The splines are constant outside of the knots
 
-        # We can use interp2, which features spline interpolation instead of linear interpolation
+            self._bounds = ((tx[degree], tx[-degree - 1]), (ty[degree], ty[-degree - 1]))
 
-        self._interpolator = scipy.interpolate.RectBivariateSpline(*args, **kwargs)
+            self._splines = None
 
-    def __call__(self, x):
+        else:
+
+            self._splines = splines
+
+    def __call__(self, point):
+
+        if self._splines is not None:
+
+            return np.array([spline(point[0], point[1])[0][0] for spline in self._splines])
+
+        bx = self._bases[0](np.clip(point[0], *self._bounds[0]))
+        by = self._bases[1](np.clip(point[1], *self._bounds[1]))
+
+        return by.dot(bx.dot(self._coefficients).reshape(self._n_y, -1))
 
-        res = self._interpolator(*x)
 
-        return res[0][0]
+def _make_interpolator(parameters_grids, values, interpolation_degree, spline_smoothing_factor):
+
+    grids = list(parameters_grids.values())
+
+    if len(grids) == 2:
+
+        x, y = grids
+
+        # Make sure that the requested polynomial degree is less than the number of data sets in
+        # both directions
+
+        msg = (
+            "You cannot use an interpolation degree of %s if you don't provide at least %s points "
+            "in the %s direction. Increase the number of templates or decrease the interpolation "
+            "degree."
+        )
+
+        if len(x) <= interpolation_degree:
+
+            log.error(
+                msg
+                % (
+                    interpolation_degree,
+                    interpolation_degree + 1,
+                    "x",
+                )
+            )
+
+            raise RuntimeError()
+
+        if len(y) <= interpolation_degree:
+
+            log.error(
+                msg
+                % (
+                    interpolation_degree,
+                    interpolation_degree + 1,
+                    "y",
+                )
+            )
+
+            raise RuntimeError()
+
+        return _SplineTemplateInterpolator(x, y, values, interpolation_degree, spline_smoothing_factor)
+
+    else:
+
+        # In more than 2d we can only use linear interpolation
+
+        return _LinearTemplateInterpolator(grids, values)
+
+
+class _TemplateData(object):
+    """
+    A template loaded from the user data directory: metadata, grids of the parameters, energies, the memory-mapped
+    array of the differential fluxes and the interpolator. Instances are shared by all the TemplateModel instances
+    of the process using the same file (see _load_template), and are pickled as a reference to the file
+
+    :param data_file: path of the .npy file of the template
+    :param log_interp: whether to interpolate the logarithm of the fluxes
+    """
+
+    def __init__(self, data_file, log_interp):
+
+        self.data_file = data_file
+
+        self.is_log10 = bool(log_interp)
+
+        with open("%s.json" % os.path.splitext(data_file)[0]) as f:
+
+            metadata = json.load(f)
+
+        self.name = metadata["name"]
+        self.description = metadata["description"]
+        self.interpolation_degree = metadata["interpolation_degree"]
+        self.spline_smoothing_factor = metadata["spline_smoothing_factor"]
+
+        self.parameters_grids = collections.OrderedDict(
+            (name, np.array(grid, dtype=float)) for name, grid in metadata["parameters"]
+        )
+
+        self.energies = np.array(metadata["energies"], dtype=float)
+
+        for array in [self.energies] + list(self.parameters_grids.values()):
+
+            array.flags.writeable = False
+
+        self.data = np.load(data_file, mmap_mode="r")
+
+        # NOTE: we interpolate on the logarithm
+        # unless specified. The logarithm of the fluxes is computed once and memory-mapped as well
+
+        if self.is_log10:
+
+            values = load_cached_array(data_file, "log10", lambda: np.log10(self.data))
+
+        else:
+
+            # work in linear space
+
+            values = self.data
+
+        self.interpolator = _make_interpolator(
+            self.parameters_grids, values, self.interpolation_degree, self.spline_smoothing_factor
+        )
+
+    def __reduce__(self):
+
+        return _load_template, (self.data_file, self.is_log10)
 
 
 class TemplateModel(with_metaclass(FunctionMeta, Function1D)):
@@ -416,80 +708,46 @@ class TemplateModel(with_metaclass(FunctionMeta, Function1D)):
             min : 1e-5
     """
 
+    _shared_attributes = ("_template",)
+
+    # Number of input grids for which the position among the tabulated energies is kept
+    _N_CACHED_GRIDS = 4
+
     def _custom_init_(self, model_name, other_name=None, log_interp=True):
         """
         Custom initialization for this model
 
-        :param model_name: the name of the model, corresponding to the root of the .h5 file in the data directory
+        :param model_name: the name of the model, corresponding to the root of the template files in the data directory
         :param other_name: (optional) the name to be used as name of the model when used in astromodels. If None
         (default), use the same name as model_name
         :return: none
         """
 
-        # Get the data directory
-
-        data_dir_path = get_user_data_path()
-
-        # Sanitize the data file
+        # Get the data file
 
-        filename_sanitized = os.path.abspath(
-            os.path.join(data_dir_path, "%s.h5" % model_name)
-        )
+        filename_sanitized, _, hdf_file_name = _get_template_paths(model_name)
 
         if not os.path.exists(filename_sanitized):
 
-            raise MissingDataFile(
-                "The data file %s does not exists. Did you use the "
-                "TemplateFactory?" % (filename_sanitized)
-            )
-
-        # Open the template definition and read from it
-
-        self._data_file = filename_sanitized
-
-        with HDFStore(filename_sanitized) as store:
-
-            self._data_frame = store["data_frame"]
-
-            self._parameters_grids = collections.OrderedDict()
-
-            processed_parameters = 0
-
-            for key in list(store.keys()):
-
-                match = re.search("p_([0-9]+)_(.+)", key)
-
-                if match is None:
+            if not os.path.exists(hdf_file_name):
 
-                    continue
-
-                else:
-
-                    tokens = match.groups()
-
-                    this_parameter_number = int(tokens[0])
-                    this_parameter_name = str(tokens[1])
-
-                    assert (
-                        this_parameter_number == processed_parameters
-                    ), "Parameters out of order!"
-
-                    self._parameters_grids[this_parameter_name] = store[key]
-
-                    processed_parameters += 1
+                raise MissingDataFile(
+                    "The data file %s does not exists. Did you use the "
+                    "TemplateFactory?" % (filename_sanitized)
+                )
 
-            self._energies = np.array(store["energies"])
+            # Template saved by a previous version
 
-            # Now get the metadata
+            convert_hdf_template(model_name)
 
-            metadata = store.get_storer("data_frame").attrs.metadata
+        # Open the template definition and read from it (only once per process)
 
-            description = metadata["description"]
-            name = metadata["name"]
+        self._data_file = filename_sanitized
 
-            self._interpolation_degree = metadata["interpolation_degree"]
+        self._template = _load_template(filename_sanitized, log_interp)
 
-            self._spline_smoothing_factor = metadata["spline_smoothing_factor"]
+        description = self._template.description
+        name = self._template.name
 
         # Make the dictionary of parameters
 
@@ -506,13 +764,11 @@ class TemplateModel(with_metaclass(FunctionMeta, Function1D)):
         parameters["K"] = Parameter("K", 1.0)
         parameters["scale"] = Parameter("scale", 1.0)
 
-        for parameter_name in list(self._parameters_grids.keys()):
-
-            grid = self._parameters_grids[parameter_name]
+        for parameter_name, grid in self._template.parameters_grids.items():
 
             parameters[parameter_name] = Parameter(
                 parameter_name,
-                grid.median(),
+                np.median(grid),
                 min_value=grid.min(),
                 max_value=grid.max(),
             )
@@ -527,99 +783,56 @@ class TemplateModel(with_metaclass(FunctionMeta, Function1D)):
                 other_name, function_definition, parameters
             )
 
-        # Finally prepare the interpolators
-
-        self._prepare_interpolators(log_interp)
-
-    def _prepare_interpolators(self, log_interp):
-
-        # Figure out the shape of the data matrices
-        data_shape = [x.shape[0] for x in list(self._parameters_grids.values())]
+        self._energy_lookups = collections.OrderedDict()
 
-        self._interpolators = []
+    def _locate_energies(self, energies, scale):
 
-        for energy in self._energies:
+        # Cell of each energy among the tabulated energies (scaled), and position within it. Energies outside of
+        # the templates are clamped. This is computed only once for each input grid and scale
 
-            # Make interpolator for this energy
-            # NOTE: we interpolate on the logarithm
-            # unless specified
+        if not isinstance(energies, np.ndarray):
 
-            if log_interp:
+            energies = np.asarray(energies, dtype=float)
 
-                this_data = np.array(
-                    np.log10(self._data_frame[energy].values).reshape(*data_shape),
-                    dtype=float,
-                )
+        key = array_fingerprint(energies) + (float(scale),)
 
-                self._is_log10 = True
+        try:
 
-            else:
+            lookup = self._energy_lookups[key]
 
-                # work in linear space
-                this_data = np.array(
-                    self._data_frame[energy].values.reshape(*data_shape), dtype=float
-                )
-
-                self._is_log10 = False
+        except KeyError:
 
-            if len(list(self._parameters_grids.values())) == 2:
+            if self._template.is_log10:
 
-                x, y = list(self._parameters_grids.values())
+                # On the energies of an EvaluationGrid the logarithm is computed only once
 
-                # Make sure that the requested polynomial degree is less than the number of data sets in
-                # both directions
+                nodes = np.log10(self._template.energies * scale)
+                positions = get_grid_data(energies, ("log10",), lambda: np.log10(energies))
 
-                msg = (
-                    "You cannot use an interpolation degree of %s if you don't provide at least %s points "
-                    "in the %s direction. Increase the number of templates or decrease the interpolation "
-                    "degree."
-                )
+            else:
 
-                if len(x) <= self._interpolation_degree:
+                nodes = self._template.energies * scale
+                positions = energies
 
-                    log.error(
-                        msg
-                        % (
-                            self._interpolation_degree,
-                            self._interpolation_degree + 1,
-                            "x",
-                        )
-                    )
+            positions = np.clip(positions, nodes[0], nodes[-1])
 
-                    raise RuntimeError()
+            cells = np.clip(np.searchsorted(nodes, positions, side="right") - 1, 0, nodes.shape[0] - 2)
 
-                if len(y) <= self._interpolation_degree:
+            weights = (positions - nodes[cells]) / (nodes[cells + 1] - nodes[cells])
 
-                    log.error(
-                        msg
-                        % (
-                            self._interpolation_degree,
-                            self._interpolation_degree + 1,
-                            "y",
-                        )
-                    )
+            lookup = (cells, weights)
 
-                    raise RuntimeError()
+            self._energy_lookups[key] = lookup
 
-                this_interpolator = RectBivariateSplineWrapper(
-                    x,
-                    y,
-                    this_data,
-                    kx=self._interpolation_degree,
-                    ky=self._interpolation_degree,
-                    s=self._spline_smoothing_factor,
-                )
+            if len(self._energy_lookups) > self._N_CACHED_GRIDS:
 
-            else:
+                self._energy_lookups.popitem(last=False)
 
-                # In more than 2d we can only use linear interpolation
+        else:
 
-                this_interpolator = GridInterpolate(
-                    tuple([np.array(x) for x in list(self._parameters_grids.values())]),
-                    this_data,
-                )
+            self._energy_lookups.move_to_end(key)
 
-            self._interpolators.append(this_interpolator)
+        return lookup
 
     def _set_units(self, x_unit, y_unit):
 
@@ -650,42 +863,23 @@ class TemplateModel(with_metaclass(FunctionMeta, Function1D)):
 
             scale = scale.to(old_div(1, u.keV)).value
 
-        if self._is_log10:
-
-            log_energies = np.log10(energies)
-
-        else:
-
-            log_energies = energies
-
-        e_tilde = self._energies * scale
-
-        # Gather all interpolations for these parameters' values at all defined energies
+        # Interpolate the templates at these parameters' values at all defined energies at once
         # (these are the logarithm of the values)
         # note that if these are not logged, then the name is superflous
 
-        log_interpolations = np.array(
-            [
-                self._interpolators[i](np.atleast_1d(parameters_values))
-                for i in range(self._energies.shape[0])
-            ]
-        )
+        log_interpolations = self._template.interpolator(np.atleast_1d(parameters_values))
 
         # Now interpolate the interpolations to get the flux at the requested energies
 
         # NOTE: the variable "interpolations" contains already the log10 of the values,
 
-        if self._is_log10:
+        cells, weights = self._locate_energies(energies, scale)
 
-            interpolator = UnivariateSpline(np.log10(e_tilde), log_interpolations)
-
-            values = np.power(10, interpolator(log_energies))
-
-        else:
+        values = log_interpolations[cells] * (1.0 - weights) + log_interpolations[cells + 1] * weights
 
-            interpolator = UnivariateSpline(e_tilde, log_interpolations)
+        if self._template.is_log10:
 
-            values = interpolator(log_energies)
+            values = np.power(10, values)
 
         # The division by scale results from the differential:
         # E = e * scale
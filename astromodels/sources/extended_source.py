@@ -3,13 +3,67 @@ import collections
 import astropy.units as u
 import numpy as np
 
+from astromodels.core.evaluation_engine import get_memory_budget
+from astromodels.core.evaluation_grid import EvaluationGrid, GridArray
+from astromodels.core.memoization import EvaluationCache, is_incremental_evaluation_active, array_fingerprint
 from astromodels.core.spectral_component import SpectralComponent
 from astromodels.core.tree import Node
 from astromodels.core.units import get_units
 from astromodels.functions import Constant
 from astromodels.sources.source import Source, EXTENDED_SOURCE
+from astromodels.utils import healpix
 from astromodels.utils.pretty_list import dict_to_list
 
+# Number of HEALPix geometries (pixels and coordinates) kept by each source (see ExtendedSource.to_healpix)
+_N_HEALPIX_GEOMETRIES = 4
+
+
+def _input_type(x):
+
+    # Arrays of an EvaluationGrid can be mixed with normal arrays
+
+    return np.ndarray if type(x) is GridArray else type(x)
+
+
+def _combine(brightness, differential_flux, out=None):
+
+    # Product of the brightness and of the spectrum (an outer product for 2D shapes), computed directly in the
+    # output without intermediate copies
+
+    return np.multiply(brightness, differential_flux[np.newaxis, :], out=out)
+
+
+def _compute_healpix_geometry(nside, nest, oversampling, boundaries):
+
+    (ra_min, ra_max), (dec_min, dec_max) = boundaries
+
+    # Sub-pixels can be within the boundaries even if the center of their pixel is not
+    margin = 0.0 if oversampling == 1 else 1.5 * healpix.nside2resolution(nside)
+
+    pixels = healpix.query_box(nside, (ra_min, ra_max), (dec_min, dec_max), margin=margin, nest=nest)
+
+    if oversampling == 1:
+
+        lon, lat = healpix.pix2ang(nside, pixels, nest=nest)
+
+    else:
+
+        # In the NESTED scheme the sub-pixels of pixel p at resolution nside * k are p * k**2 ... (p + 1) * k**2 - 1
+
+        parents = pixels if nest else healpix.ring2nest(nside, pixels)
+
+        n_sub = oversampling ** 2
+
+        sub_pixels = (parents[:, np.newaxis] * n_sub + np.arange(n_sub)[np.newaxis, :]).ravel()
+
+        lon, lat = healpix.pix2ang(nside * oversampling, sub_pixels, nest=True)
+
+    for array in (pixels, lon, lat):
+
+        array.flags.writeable = False
+
+    return pixels, lon, lat
+
 
 class ExtendedSource(Source, Node):
     def __init__(self,
@@ -103,6 +157,14 @@ class ExtendedSource(Source, Node):
 
         Source.__init__(self, components, EXTENDED_SOURCE)
 
+        # The spectrum and the brightness kept separately by the incremental evaluation, so that only the one
+        # which changed is re-computed
+        self._spectrum_cache: EvaluationCache = EvaluationCache()
+        self._brightness_cache: EvaluationCache = EvaluationCache()
+
+        # Pixels and coordinates of the last HEALPix maps (see to_healpix)
+        self._healpix_geometry = collections.OrderedDict()
+
         # A source is also a Node in the tree
 
         Node.__init__(self, source_name)
@@ -165,16 +227,116 @@ class ExtendedSource(Source, Node):
         return differential_flux
 
 
-    def __call__(self, lon, lat, energies):
+    def __call__(self, lon, lat=None, energies=None, out=None):
         """
         Returns brightness of source at the given position and energy
-        :param lon: longitude (array or float)
+        :param lon: longitude (array or float), or an EvaluationGrid with coordinates (then lat and energies are
+        not needed)
         :param lat: latitude (array or float)
         :param energies: energies (array or float)
-        :return: differential flux at given position and energy
+        :param out: optional array (for example a numpy.memmap) with shape (n_points, n_energies) where to write the
+        result. It is then filled block by block (see evaluate_in_chunks), without creating the whole result in
+        memory. With energies with units, the result is written in the units of out if it is a Quantity, and in
+        the current units (see get_units) otherwise
+        :return: differential flux at given position and energy (out, if provided, as a Quantity sharing its memory
+        if energies have units)
+        """
+
+        lon, lat, energies = self._prepare_input(lon, lat, energies)
+
+        if out is not None:
+
+            unit = None
+
+            for _, block in self._iter_blocks(lon, lat, energies, None, out):
+
+                unit = getattr(block, "unit", None)
+
+            if unit is not None and not isinstance(out, u.Quantity):
+
+                return u.Quantity(out, unit, copy=False)
+
+            return out
+
+        if is_incremental_evaluation_active() and not isinstance(energies, u.Quantity):
+
+            return self._evaluate_incrementally(lon, lat, energies)
+
+        return self._evaluate(lon, lat, energies)
+
+    def _evaluate_incrementally(self, lon, lat, energies):
+
+        # Return the result computed earlier for this grid, if nothing changed since then. Otherwise, re-use
+        # the spectrum if only the morphology changed, or the brightness if only the spectrum changed
+
+        spatial_key = array_fingerprint(lon, lat)
+        spectral_key = array_fingerprint(energies)
+
+        grid_key = spatial_key + spectral_key
+
+        spatial_state = self._spatial_shape.state_version
+        spectral_state = self._get_spectral_state()
+
+        state = (spatial_state, spectral_state)
+
+        result = self._evaluation_cache.get(grid_key, state)
+
+        if result is not None:
+
+            return result
+
+        differential_flux = self._spectrum_cache.get(spectral_key, spectral_state)
+
+        if differential_flux is None:
+
+            differential_flux = self._spectrum_cache.store(spectral_key, spectral_state,
+                                                           np.atleast_1d(self._get_differential_flux(energies)))
+
+        # The brightness of 3D shapes depends also on energy
+
+        brightness_key = spatial_key if self._spatial_shape.n_dim == 2 else grid_key
+
+        brightness = self._brightness_cache.get(brightness_key, spatial_state)
+
+        if brightness is None:
+
+            brightness = self._brightness_cache.store(brightness_key, spatial_state,
+                                                      self._get_brightness(lon, lat, energies))
+
+        return self._evaluation_cache.store(grid_key, state, np.squeeze(_combine(brightness, differential_flux)))
+
+    def evaluate_in_chunks(self, lon, lat=None, energies=None, max_memory=None):
         """
+        Evaluates the source block by block of sky positions, so that the memory used for the results at any time
+        is limited. This is a generator, yielding tuples (slice, block) where block is the result (with shape
+        (n_points_in_block, n_energies)) for the positions lon[slice], lat[slice]. For example::
+
+            for this_slice, block in source.evaluate_in_chunks(ra, dec, energies):
+
+                counts[this_slice] = (block * exposure[this_slice]).sum(axis=1)
+
+        :param lon: longitudes (array), or an EvaluationGrid with coordinates (then lat and energies are not needed)
+        :param lat: latitudes (array)
+        :param energies: energies (array, with or without units; with units, the blocks are Quantity instances)
+        :param max_memory: maximum size of a block, in bytes (default: see get_memory_budget in
+        astromodels.core.evaluation_engine)
+        :return: generator of (slice, block)
+        """
+
+        lon, lat, energies = self._prepare_input(lon, lat, energies)
+
+        return self._iter_blocks(lon, lat, energies, max_memory, None)
+
+    def _prepare_input(self, lon, lat, energies):
 
-        assert type(lat) == type(lon) and type(lon) == type(energies), "Type mismatch in input of call"
+        if isinstance(lon, EvaluationGrid):
+
+            assert lon.has_coordinates, "The evaluation grid %s has no coordinates" % lon.name
+
+            lon, lat, energies = lon.ra, lon.dec, lon.energies
+
+        assert _input_type(lat) == _input_type(lon) and _input_type(lon) == _input_type(energies), \
+            "Type mismatch in input of call"
 
         if not isinstance(lat, np.ndarray):
 
@@ -182,6 +344,10 @@ class ExtendedSource(Source, Node):
             lon = np.array(lon, ndmin=1)
             energies = np.array(energies, ndmin=1)
 
+        return lon, lat, energies
+
+    def _get_differential_flux(self, energies):
+
         # Get the differential flux from the spectral components
 
         results = [component.shape(energies) for component in list(self.components.values())]
@@ -193,33 +359,117 @@ class ExtendedSource(Source, Node):
             # We need to sum like this (slower) because using np.sum will not preserve the units
             # (thanks astropy.units)
 
-            differential_flux = sum(results)
+            return sum(results)
 
         else:
 
             # Fast version without units, where x is supposed to be in the same units as currently defined in
             # units.get_units()
 
-            differential_flux = np.sum(results, 0)
+            return np.sum(results, 0)
 
-        # Get brightness from spatial model
+    def _get_brightness(self, lon, lat, energies):
+
+        # Brightness with shape (n_points, 1) for 2D shapes (the spectrum is the same everywhere), or
+        # (n_points, n_energies) for 3D shapes
 
         if self._spatial_shape.n_dim == 2:
 
-            brightness = self._spatial_shape(lon, lat)
+            return np.reshape(self._spatial_shape(lon, lat), (lat.shape[0], 1))
 
-            # In this case the spectrum is the same everywhere
-            n_points = lat.shape[0]
-            n_energies = differential_flux.shape[0]
+        else:
 
-            # The following is a little obscure, but it is 6x faster than doing a for loop
+            return np.reshape(self._spatial_shape(lon, lat, energies), (lat.shape[0], energies.shape[0]))
 
-            cube = np.repeat(differential_flux, n_points).reshape(n_energies, n_points).T
-            result = (cube.T * brightness).T
+    def _evaluate_block(self, lon, lat, energies, differential_flux, out=None):
+
+        return _combine(self._get_brightness(lon, lat, energies), differential_flux, out=out)
+
+    def _iter_blocks(self, lon, lat, energies, max_memory, out):
+
+        unit = None
+
+        if isinstance(energies, u.Quantity):
+
+            # The blocks are computed without units, in the current units (the brightness is always a differential
+            # flux per unit solid angle), and the units are applied to them
+
+            current_u = get_units()
+
+            unit = (current_u.energy * current_u.area * current_u.time * current_u.angle ** 2) ** (-1)
+
+            energies = energies.to_value(current_u.energy)
+            lon = u.Quantity(lon, current_u.angle).value
+            lat = u.Quantity(lat, current_u.angle).value
+
+            if isinstance(out, u.Quantity):
+
+                # Written directly in the units of the output
+
+                scale = unit.to(out.unit)
+
+                for this_slice, block in self._iter_blocks(lon, lat, energies, max_memory, out.value):
+
+                    if scale != 1:
+
+                        block *= scale
+
+                    yield this_slice, out[this_slice]
+
+                return
+
+        differential_flux = np.atleast_1d(self._get_differential_flux(energies))
+
+        n_points = lat.shape[0]
+        n_energies = energies.shape[0]
+
+        if out is not None and out.shape != (n_points, n_energies):
+
+            raise ValueError("The output array must have shape (%i, %i)" % (n_points, n_energies))
+
+        if max_memory is None:
+
+            max_memory = get_memory_budget()
+
+        # 3D shapes need a temporary array of the same size of the block
+        bytes_per_point = n_energies * np.dtype(float).itemsize * (1 if self._spatial_shape.n_dim == 2 else 2)
+
+        points_per_block = max(1, int(max_memory // bytes_per_point))
+
+        for start in range(0, n_points, points_per_block):
+
+            this_slice = slice(start, min(start + points_per_block, n_points))
+
+            block = self._evaluate_block(lon[this_slice], lat[this_slice], energies, differential_flux,
+                                         out=None if out is None else out[this_slice])
+
+            if unit is not None:
+
+                block = u.Quantity(block, unit, copy=False)
+
+            yield this_slice, block
+
+    def _evaluate(self, lon, lat, energies):
+
+        differential_flux = np.atleast_1d(self._get_differential_flux(energies))
+
+        if isinstance(energies, u.Quantity):
+
+            # Slow version with units
+
+            if self._spatial_shape.n_dim == 2:
+
+                brightness = np.atleast_1d(self._spatial_shape(lon, lat))
+
+                result = brightness[:, np.newaxis] * differential_flux[np.newaxis, :]
+
+            else:
+
+                result = self._spatial_shape(lon, lat, energies) * differential_flux
 
         else:
 
-            result = self._spatial_shape(lon, lat, energies) * differential_flux
+            result = self._evaluate_block(lon, lat, energies, differential_flux)
 
         # Do not clip the output, otherwise it will not be possible to use ext. sources
         # with negative fluxes
@@ -329,3 +579,72 @@ class ExtendedSource(Source, Node):
         :return: a tuple of tuples ((min. lon, max. lon), (min lat, max lat))
         """
         return self._spatial_shape.get_boundaries()
+
+    def to_healpix(self, nside, energies, nest=False, oversampling=1, sparse=False):
+        """
+        Evaluates the source on a HEALPix map in equatorial (J2000) coordinates. Only the pixels within the
+        boundaries of the source (see get_boundaries) are evaluated, so the cost is proportional to the size of the
+        source and not to the size of the map.
+
+        :param nside: nside of the map (a power of 2)
+        :param energies: energies (array or float, without units)
+        :param nest: True for the NESTED scheme, False (default) for the RING scheme
+        :param oversampling: number of sub-pixels per side of each pixel (a power of 2, default: 1). The value in a
+        pixel is the average over its oversampling**2 sub-pixels, instead of the value at its center
+        :param sparse: if True, return only the evaluated pixels as a tuple (pixels, values), with values having
+        shape (n_pixels, n_energies). Otherwise (default) return the whole map with shape (12 * nside**2, n_energies)
+        :return: the map
+        """
+
+        energies = np.array(energies, dtype=float, ndmin=1)
+
+        pixels, lon, lat = self._get_healpix_geometry(nside, nest, oversampling)
+
+        values = np.zeros((pixels.shape[0], energies.shape[0]))
+
+        if pixels.shape[0] > 0:
+
+            sub_values = np.reshape(self(lon, lat, energies), (pixels.shape[0], oversampling ** 2, energies.shape[0]))
+
+            np.mean(sub_values, axis=1, out=values)
+
+        if sparse:
+
+            return pixels, values
+
+        healpix_map = np.zeros((healpix.nside2npix(nside), energies.shape[0]))
+
+        healpix_map[pixels] = values
+
+        return healpix_map
+
+    def _get_healpix_geometry(self, nside, nest, oversampling):
+
+        # Pixels which can be non-zero, and coordinates of their centers (or of the centers of their sub-pixels).
+        # They depend only on the boundaries of the source, so they are kept for the last few maps
+
+        if oversampling < 1 or (oversampling & (oversampling - 1)) != 0:
+
+            raise ValueError("The oversampling must be a power of 2")
+
+        boundaries = self.get_boundaries()
+
+        key = (nside, nest, oversampling, tuple(tuple(float(x) for x in b) for b in boundaries))
+
+        try:
+
+            geometry = self._healpix_geometry[key]
+
+        except KeyError:
+
+            geometry = self._healpix_geometry[key] = _compute_healpix_geometry(nside, nest, oversampling, boundaries)
+
+            while len(self._healpix_geometry) > _N_HEALPIX_GEOMETRIES:
+
+                self._healpix_geometry.popitem(last=False)
+
+        else:
+
+            self._healpix_geometry.move_to_end(key)
+
+        return geometry
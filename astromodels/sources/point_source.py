@@ -1,6 +1,7 @@
 from __future__ import division
 from astromodels.core.parameter import Parameter
 from astromodels.functions.function import Function1D
+from astromodels.functions.numba_functions import kernel
 from past.utils import old_div
 import collections
 
@@ -8,16 +9,17 @@ from typing import Dict, List, Optional, Union, Any
 
 import astropy.units as u
 import numpy
-import numba as nb
-import scipy.integrate
 
+from astromodels.core.evaluation_grid import EvaluationGrid
 from astromodels.core.sky_direction import SkyDirection
 from astromodels.core.spectral_component import SpectralComponent
 from astromodels.core.tree import Node
 from astromodels.core.units import get_units
 from astromodels.sources.source import Source, POINT_SOURCE
 from astromodels.utils.pretty_list import dict_to_list
-from astromodels.core.memoization import use_astromodels_memoization
+from astromodels.core.memoization import (use_astromodels_memoization, use_incremental_evaluation,
+                                          is_incremental_evaluation_active, array_fingerprint)
+from astromodels.utils.integration import integrate_vectorized
 from astromodels.utils.logging import setup_logger
 
 
@@ -29,6 +31,30 @@ __all__ = ["PointSource"]
 log = setup_logger(__name__)
 
 
+def _get_row_values(variable, variables):
+
+    # Values of a parameter (or of an independent variable) for all the values of the independent variables, or
+    # None if it does not depend on them
+
+    for independent_variable, values in variables:
+
+        if variable is independent_variable:
+
+            return values
+
+    if isinstance(variable, Parameter) and variable.has_auxiliary_variable():
+
+        auxiliary_variable, law = variable.auxiliary_variable
+
+        auxiliary_values = _get_row_values(auxiliary_variable, variables)
+
+        if auxiliary_values is not None:
+
+            return law(auxiliary_values)
+
+    return None
+
+
 class PointSource(Source, Node):
     """
     A point source. You can instance this class in many ways.
@@ -169,6 +195,10 @@ class PointSource(Source, Node):
 
     def __call__(self, x, tag=None):
 
+        if isinstance(x, EvaluationGrid):
+
+            x = x.energies
+
         if tag is None:
 
             # No integration nor time-varying or whatever-varying
@@ -189,15 +219,29 @@ class PointSource(Source, Node):
                 # Fast version without units, where x is supposed to be in the same units as currently defined in
                 # units.get_units()
 
-                results = numpy.array([component.shape(x) for component in list(self.components.values())])
+                if is_incremental_evaluation_active():
+
+                    # Return the result computed earlier for this grid, if nothing changed since then
+
+                    grid_key = array_fingerprint(numpy.asanyarray(x))
+                    state = self._get_spectral_state()
+
+                    result = self._evaluation_cache.get(grid_key, state)
+
+                    if result is None:
+
+                        result = self._evaluation_cache.store(grid_key, state, self._fast_call(x))
+
+                    return result
 
-                return _sum(results)
+                return self._fast_call(x)
 
         else:
 
-            # Time-varying or energy-varying or whatever-varying
+            # Time-varying or energy-varying or whatever-varying. An optional fourth element of the tag selects
+            # the integration method (see integrate_vectorized)
 
-            integration_variable, a, b = tag
+            integration_variable, a, b = tag[:3]
 
             if b is None:
 
@@ -214,29 +258,85 @@ class PointSource(Source, Node):
 
             else:
 
-                # Integrate between a and b
+                # Integrate between a and b, for all the energies at once
 
-                integrals = numpy.zeros(len(x))
+                method = tag[3] if len(tag) > 3 else "gauss_kronrod"
 
-                # TODO: implement an integration scheme avoiding the for loop
+                # Suspend memoization because the memoization gets confused when integrating (and so would
+                # the incremental evaluation, which would fill its cache with a result for each node)
+                with use_astromodels_memoization(False), use_incremental_evaluation(False):
 
-                # Suspend memoization because the memoization gets confused when integrating
-                with use_astromodels_memoization(False):
+                    def integrand(y):
+
+                        integration_variable.value = y
 
-                    reentrant_call = self.__call__
+                        return numpy.array(self.__call__(x, tag=None), dtype=float, ndmin=1)
 
-                    for i, e in enumerate(x):
+                    integrals = integrate_vectorized(integrand, a, b, epsrel=1e-5, method=method)
 
-                        def integral(y):
+                return old_div(integrals, (b - a))
 
-                            integration_variable.value = y
+    def evaluate_grid(self, energies, variables) -> numpy.ndarray:
+        """
+        Evaluates the source on a grid of values of one or more independent variables (such as time) and of
+        energies, at once. The parameters linked (even indirectly) to the independent variables are computed for
+        all the values at once through their laws, then the spectral shapes are evaluated for all the values of the
+        parameters together when possible (see Function1D.evaluate_rows). The independent variables are not changed.
 
-                            return reentrant_call(e, tag=None)
+        Example::
 
-                        # Now integrate
-                        integrals[i] = scipy.integrate.quad(integral, a, b, epsrel=1e-5)[0]
+            >>> cube = src.evaluate_grid(energies, {time: times})
 
-                return old_div(integrals, (b - a))
+        :param energies: 1d array of energies (without units, or an EvaluationGrid)
+        :param variables: a dictionary with independent variables as keys, and 1d arrays of values as items (all
+        with the same length)
+        :return: an array with shape (n_values, n_energies)
+        """
+
+        if isinstance(energies, EvaluationGrid):
+
+            energies = energies.energies
+
+        if isinstance(energies, u.Quantity):
+
+            log.error("evaluate_grid does not support energies with units")
+
+            raise AssertionError()
+
+        energies = numpy.array(energies, dtype=float, ndmin=1)
+
+        variables = [(variable, numpy.array(values, dtype=float, ndmin=1)) for variable, values in variables.items()]
+
+        n_rows = variables[0][1].shape[0]
+
+        if any(values.shape != (n_rows,) for _, values in variables):
+
+            log.error("The values of the independent variables must be 1d arrays with the same length")
+
+            raise AssertionError()
+
+        row_values = {}
+
+        for component in self._components.values():
+
+            for parameter in component.shape.parameters.values():
+
+                values = _get_row_values(parameter, variables)
+
+                if values is not None:
+
+                    row_values[id(parameter)] = numpy.broadcast_to(values, (n_rows,))
+
+        results = [component.shape.evaluate_rows(energies, row_values, n_rows)
+                   for component in self._components.values()]
+
+        return numpy.sum(results, axis=0)
+
+    def _fast_call(self, x):
+
+        results = numpy.array([component.shape(x) for component in list(self.components.values())])
+
+        return _sum(results)
 
     def has_free_parameters(self) -> bool:
         """
@@ -337,7 +437,7 @@ class PointSource(Source, Node):
 
 
 
-@nb.njit(fastmath=True)
+@kernel
 def _sum(x):
     return numpy.sum(x, axis=0)
     
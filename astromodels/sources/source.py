@@ -4,6 +4,7 @@ __author__ = 'giacomov'
 
 from typing import Dict, Optional, List, Any
 
+from astromodels.core.memoization import EvaluationCache
 from astromodels.core.parameter import Parameter
 
 import collections
@@ -37,6 +38,18 @@ class Source(object):
             # Store the type string
             self._src_type: str = str(src_type)
 
+        # Results kept by the incremental evaluation (see use_incremental_evaluation)
+        self._evaluation_cache: EvaluationCache = EvaluationCache()
+
+    def _get_spectral_state(self) -> tuple:
+        """
+        Returns a token which changes whenever the spectrum of this source might have changed
+
+        :return: a tuple
+        """
+
+        return tuple(component.shape.state_version for component in self._components.values())
+
     def has_free_parameters(self):
 
         raise NotImplementedError("You need to override this")
@@ -36,11 +36,11 @@ def test_function_values_have_not_changed():
 
             continue
 
-    #        if key.find("Synchrotron")==0:
+        if key.find("Synchrotron")==0:
 
-            # Naima Synchtron function should have its own test
+            # The Synchrotron function needs a particle distribution, it has its own test
 
-    #            continue
+            continue
 
         if this_function._n_dim == 1:
 
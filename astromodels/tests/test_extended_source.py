@@ -1,10 +1,14 @@
 from __future__ import print_function
 
+import os
+
 import astropy.io.fits as fits
 import astropy.units as u
 import numpy as np
 import pytest
 
+from astromodels.core.evaluation_engine import set_memory_budget
+from astromodels.core.memoization import use_incremental_evaluation
 from astromodels.core.model import Model
 from astromodels.core.model_parser import clone_model
 from astromodels.core.spectral_component import SpectralComponent
@@ -12,6 +16,7 @@ from astromodels.functions import *
 from astromodels.functions import Log_parabola, Powerlaw
 from astromodels.functions.function import _known_functions
 from astromodels.sources.extended_source import ExtendedSource
+from astromodels.utils.healpix import nside2npix, pix2ang, query_box, ring2nest
 
 __author__ = 'henrikef'
 
@@ -248,3 +253,215 @@ def test_free_param():
     for i, param in enumerate(parameters):
         param.free = True
         assert len(source.free_parameters) == i+1
+
+
+def test_call_in_chunks():
+
+    ra, dec = (125.6, -75.3)
+
+    energies = np.logspace(0, 3, 20)
+
+    lon = ra + np.random.uniform(-2, 2, 1000)
+    lat = dec + np.random.uniform(-2, 2, 1000)
+
+    shape_2d = Gaussian_on_sphere(lon0=ra, lat0=dec, sigma=0.5)
+
+    shape_3d = Continuous_injection_diffusion(lon0=ra, lat0=dec)
+
+    for shape in [shape_2d, shape_3d]:
+
+        source = ExtendedSource("test_source", shape, Powerlaw())
+
+        expected = source(lon, lat, energies)
+
+        # Blocks of 128 points for 2D shapes, and of 64 points for 3D shapes (which need a temporary array)
+        blocks = list(source.evaluate_in_chunks(lon, lat, energies, max_memory=64 * 20 * 8 * 2))
+
+        assert len(blocks) == (8 if shape is shape_2d else 16)
+
+        assert np.allclose(np.concatenate([block for _, block in blocks]), expected)
+
+        assert all(np.allclose(block, expected[this_slice]) for this_slice, block in blocks)
+
+        # Output on a memory map, with a small memory budget
+        set_memory_budget(1000)
+
+        out = np.memmap("__test_cube.dat", dtype=float, mode="w+", shape=(1000, 20))
+
+        try:
+
+            assert source(lon, lat, energies, out=out) is out
+
+            assert np.allclose(out, expected)
+
+        finally:
+
+            set_memory_budget(256 * 1024 ** 2)
+
+            del out
+
+            os.remove("__test_cube.dat")
+
+        with pytest.raises(ValueError):
+
+            source(lon, lat, energies, out=np.zeros((10, 20)))
+
+        # Energies and coordinates with units
+        expected = source(lon * u.deg, lat * u.deg, energies * u.keV)
+
+        blocks = list(source.evaluate_in_chunks(lon * u.deg, lat * u.deg, energies * u.MeV / 1000,
+                                                max_memory=64 * 20 * 8 * 2))
+
+        assert all(np.allclose(block, expected[this_slice], rtol=1e-10) for this_slice, block in blocks)
+
+        out = np.zeros((1000, 20))
+
+        result = source(lon * u.deg, lat * u.deg, energies * u.keV, out=out)
+
+        assert np.shares_memory(result, out)
+        assert np.allclose(result, expected, rtol=1e-10)
+
+        # With a Quantity the result is written in its units
+        out = np.zeros((1000, 20)) / (u.MeV * u.m ** 2 * u.s * u.sr)
+
+        assert source(lon * u.deg, lat * u.deg, energies * u.keV, out=out) is out
+        assert np.allclose(out, expected, rtol=1e-10)
+
+
+def test_separable_caching(monkeypatch):
+
+    calls = {"spatial": 0, "spectral": 0}
+
+    def _counting(kind, method):
+
+        def wrapper(self, *args):
+
+            calls[kind] += 1
+
+            return method(self, *args)
+
+        return wrapper
+
+    monkeypatch.setattr(Gaussian_on_sphere, "evaluate", _counting("spatial", Gaussian_on_sphere.evaluate))
+    monkeypatch.setattr(Powerlaw, "evaluate", _counting("spectral", Powerlaw.evaluate))
+
+    shape = Gaussian_on_sphere(lon0=10.0, lat0=20.0, sigma=0.5)
+    spectrum = Powerlaw()
+
+    source = ExtendedSource("test_source", shape, spectrum)
+
+    lon = np.random.uniform(9, 11, 100)
+    lat = np.random.uniform(19, 21, 100)
+    energies = np.logspace(0, 3, 20)
+
+    with use_incremental_evaluation(True):
+
+        res = source(lon, lat, energies)
+
+        assert calls == {"spatial": 1, "spectral": 1}
+
+        # Only the spectrum changed
+        spectrum.index.value = -1.5
+
+        res = source(lon, lat, energies)
+
+        assert calls == {"spatial": 1, "spectral": 2}
+        assert np.allclose(res, source._evaluate(lon, lat, energies))
+
+        # Only the morphology changed
+        shape.sigma.value = 0.3
+
+        calls.update(spatial=0, spectral=0)
+
+        res = source(lon, lat, energies)
+
+        assert calls == {"spatial": 1, "spectral": 0}
+        assert np.allclose(res, shape(lon, lat)[:, np.newaxis] * spectrum(energies)[np.newaxis, :])
+
+        # A different grid of energies re-uses the brightness
+        calls.update(spatial=0, spectral=0)
+
+        source(lon, lat, energies[:10])
+
+        assert calls == {"spatial": 0, "spectral": 1}
+
+
+def test_to_healpix():
+
+    nside = 64
+    npix = nside2npix(nside)
+
+    energies = np.array([1.0, 10.0, 100.0])
+
+    # A disk crossing R.A. = 0
+    shape = Disk_on_sphere(lon0=359.0, lat0=30.0, radius=3.0)
+    shape.radius.max_value = 5.0
+
+    source = ExtendedSource("test_source", shape, Powerlaw())
+
+    healpix_map = source.to_healpix(nside, energies)
+
+    assert healpix_map.shape == (npix, 3)
+
+    # Same as evaluating the source on the centers of all the pixels
+    for nest in [False, True]:
+
+        lon, lat = pix2ang(nside, np.arange(npix), nest=nest)
+
+        assert np.allclose(source.to_healpix(nside, energies, nest=nest), source(lon, lat, energies))
+
+    pixels, values = source.to_healpix(nside, energies, sparse=True)
+
+    assert pixels.shape[0] < npix / 50
+    assert np.all(healpix_map[pixels] == values)
+    assert np.all(np.delete(healpix_map, pixels, axis=0) == 0)
+
+    # The geometry is re-used until the boundaries change
+    assert source.to_healpix(nside, energies, sparse=True)[0] is pixels
+
+    shape.lon0.value = 10.0
+
+    assert source.to_healpix(nside, energies, sparse=True)[0] is not pixels
+
+    # With oversampling the integral over the sky is more accurate
+    pixel_area = 4 * np.pi / npix
+
+    shape.radius.value = 1.0
+
+    spectrum = source.spectrum.main.shape(energies)
+
+    integral = source.to_healpix(nside, energies).sum(axis=0) * pixel_area / spectrum
+    integral_oversampled = source.to_healpix(nside, energies, oversampling=8).sum(axis=0) * pixel_area / spectrum
+
+    assert np.all(np.abs(integral_oversampled - 1) < np.abs(integral - 1))
+    assert np.allclose(integral_oversampled, 1.0, rtol=0.02)
+
+    with pytest.raises(ValueError):
+
+        source.to_healpix(nside, energies, oversampling=3)
+
+
+def test_query_box():
+
+    nside = 32
+
+    lon, lat = pix2ang(nside, np.arange(nside2npix(nside)))
+
+    # Boxes within a ring, crossing longitude 0, aligned with the pixel centers, and around the poles
+    for lon_range, lat_range in [((10.0, 25.0), (-20.0, 10.0)), ((350.0, 5.0), (40.0, 60.0)),
+                                 ((-45.0, 45.0), (-30.0, 30.0)), ((100.0, 460.0), (80.0, 90.0)),
+                                 ((0.0, 0.0), (-90.0, 90.0))]:
+
+        inside = ((lon - lon_range[0]) % 360.0 <= (lon_range[1] - lon_range[0]) % 360.0)
+
+        if lon_range[1] - lon_range[0] >= 360.0:
+
+            inside[:] = True
+
+        inside &= (lat >= lat_range[0]) & (lat <= lat_range[1])
+
+        pixels = np.flatnonzero(inside)
+
+        assert np.array_equal(query_box(nside, lon_range, lat_range), pixels)
+
+        assert np.array_equal(query_box(nside, lon_range, lat_range, nest=True), np.sort(ring2nest(nside, pixels)))
@@ -1,19 +1,33 @@
 from __future__ import division, print_function
 
+import hashlib
+import mmap
 import os
 import pickle
+import subprocess
+import sys
 from builtins import object
 
 import astropy.units as u
 import numpy as np
 import pytest
+from astropy.coordinates import SkyCoord
 from astropy.io import fits
 from future.utils import with_metaclass
 
 from astromodels.functions import (Continuous_injection_diffusion,
-                                   Gaussian_on_sphere, Line, Powerlaw,
-                                   SpatialTemplate_2D)
+                                   Cutoff_powerlaw, Disk_on_sphere,
+                                   Gaussian_on_sphere, Line, PhAbs, Powerlaw,
+                                   SpatialTemplate_2D, Synchrotron, TbAbs)
 from astromodels.functions import function as function_module
+from astromodels.functions.dark_matter import dm_models
+from astromodels.functions import functions_2D, functions_3D, has_atomdb, has_ebltable
+from astromodels.functions.functions_1D import absorption as absorption_module
+from astromodels.functions.functions_1D import synchrotron as synchrotron_module
+from astromodels.utils import angular_distance as angular_distance_module
+from astromodels.utils import cached_files
+from astromodels.utils.configuration import get_numba_policy, numba_policy, set_numba_policy
+from astromodels.functions import numba_functions
 from astromodels.functions.function import (DesignViolation, Function1D,
                                             Function2D,
                                             FunctionDefinitionError,
@@ -21,6 +35,14 @@ from astromodels.functions.function import (DesignViolation, Function1D,
                                             UnknownParameter, get_function,
                                             get_function_class, list_functions)
 
+if has_ebltable:
+
+    from astromodels.functions import EBLattenuation
+
+if has_atomdb:
+
+    from astromodels.functions import APEC, VAPEC
+
 __author__ = 'giacomov'
 
 
@@ -851,6 +873,748 @@ def test_function3D():
                     (u.keV * u.s * u.deg**2 * u.cm**2))
 
 
+def test_pixel_coordinates():
+
+    np.random.seed(1234)
+
+    lon = np.random.uniform(0, 360, 1000)
+    lat = np.degrees(np.arcsin(np.random.uniform(-1, 1, 1000)))
+
+    # Include points very close to the center and to its antipode
+    lon[:3] = [120.0, 120.0 + 1e-7, 300.0]
+    lat[:3] = [-30.0, -30.0, 30.0]
+
+    pixel_coordinates = angular_distance_module.PixelCoordinates(lon, lat)
+
+    expected = angular_distance_module.angular_distance(120.0, -30.0, lon, lat)
+
+    assert np.allclose(pixel_coordinates.angular_distance(120.0, -30.0), expected, rtol=1e-9, atol=1e-10)
+    assert np.isclose(pixel_coordinates.angular_distance(120.0, -30.0)[1], expected[1], rtol=1e-6)
+    assert np.isclose(pixel_coordinates.angular_distance(120.0, -30.0)[2], 180.0)
+
+    # Instances are reused for the same positions
+
+    assert angular_distance_module.get_pixel_coordinates(lon, lat) is \
+        angular_distance_module.get_pixel_coordinates(lon.copy(), lat.copy())
+
+    # The shapes give the same results as with the direct computation of the distances
+
+    gaussian = Gaussian_on_sphere(lon0=120.0, lat0=-30.0, sigma=20.0)
+
+    reference = (180 / np.pi) ** 2 / (2 * np.pi * 400.0) * np.exp(-0.5 * expected ** 2 / 400.0)
+
+    assert np.allclose(gaussian(lon, lat), reference, rtol=1e-9)
+
+    disk = Disk_on_sphere(lon0=120.0, lat0=-30.0, radius=20.0)
+
+    assert np.all((disk(lon, lat) > 0) == (expected <= 20.0))
+
+
+def test_spatial_kernels(monkeypatch):
+
+    np.random.seed(1234)
+
+    lon = np.random.uniform(100, 140, 2000)
+    lat = np.random.uniform(-50, -10, 2000)
+
+    energies = np.logspace(0, 9, 7)
+
+    shapes_2D = [functions_2D.Gaussian_on_sphere(lon0=120.0, lat0=-30.0, sigma=3.0),
+                 functions_2D.Asymm_Gaussian_on_sphere(lon0=120.0, lat0=-30.0, a=4.0, e=0.8, theta=30.0),
+                 functions_2D.Disk_on_sphere(lon0=120.0, lat0=-30.0, radius=5.0),
+                 functions_2D.Ellipse_on_sphere(lon0=120.0, lat0=-30.0, a=5.0, e=0.7, theta=30.0),
+                 functions_2D.Power_law_on_sphere(lon0=120.0, lat0=-30.0, index=-1.5, maxr=8.0, minr=0.5)]
+
+    shapes_3D = [functions_3D.Continuous_injection_diffusion(lon0=120.0, lat0=-30.0),
+                 functions_3D.Continuous_injection_diffusion_ellipse(lon0=120.0, lat0=-30.0, incl=30.0,
+                                                                     elongation=1.5),
+                 functions_3D.Continuous_injection_diffusion_legacy(lon0=120.0, lat0=-30.0)]
+
+    compiled = [shape(lon, lat) for shape in shapes_2D] + [shape(lon, lat, energies) for shape in shapes_3D]
+
+    # Compare with the numpy implementations
+
+    monkeypatch.setattr(functions_2D, "can_use_kernels", lambda *values: False)
+    monkeypatch.setattr(functions_3D, "can_use_kernels", lambda *values: False)
+
+    reference = [shape.evaluate(lon, lat, *[p.value for p in shape.parameters.values()]) for shape in shapes_2D] + \
+                [shape.evaluate(lon, lat, energies, *[p.value for p in shape.parameters.values()])
+                 for shape in shapes_3D]
+
+    for shape, this_compiled, this_reference in zip(shapes_2D + shapes_3D, compiled, reference):
+
+        assert this_compiled.shape == this_reference.shape, shape.name
+
+        assert np.allclose(this_compiled, this_reference, rtol=1e-8, atol=0), shape.name
+
+        assert np.any(this_reference > 0), shape.name
+
+
+def test_spatial_template_2D_lookup():
+
+    cards = {
+        "SIMPLE": "T",
+        "BITPIX": -64,
+        "NAXIS": 2,
+        "NAXIS1": 50,
+        "NAXIS2": 40,
+        "CUNIT1": 'deg',
+        "CRVAL1": 10.0,
+        "CRPIX1": 1,
+        "CDELT1": 0.1,
+        "CUNIT2": 'deg',
+        "CRVAL2": 0.0,
+        "CRPIX2": 1,
+        "CDELT2": 0.1,
+        "CTYPE1": 'RA---CAR',
+        "CTYPE2": 'DEC--CAR'}
+
+    # A map linear in both pixel coordinates, so that the bilinear interpolation is exact inside the map
+
+    Y, X = np.mgrid[0:40, 0:50]
+
+    data = 1.0 + X + 2.0 * Y
+
+    hdu = fits.PrimaryHDU(data=data, header=fits.Header(cards))
+    hdu.writeto("test_lookup.fits", overwrite=True)
+
+    shape = SpatialTemplate_2D()
+    shape.load_file("test_lookup.fits")
+
+    ra = np.array([10.0, 10.55, 12.3, 14.2, 30.0])
+    dec = np.array([0.0, 0.25, 1.15, 3.45, 1.0])
+
+    nearest = shape(ra, dec)
+
+    # The pixel lookup is computed only once for the same coordinates
+
+    assert len(shape._pixel_lookups) == 1
+
+    assert np.all(shape(ra.copy(), dec.copy()) == nearest)
+
+    assert len(shape._pixel_lookups) == 1
+
+    assert nearest[-1] == 0
+
+    assert nearest[0] == 1.0
+
+    shape.set_interpolation("bilinear")
+
+    assert len(shape._pixel_lookups) == 0
+
+    bilinear = shape(ra, dec)
+
+    x_pix = (ra - 10.0) / 0.1
+    y_pix = dec / 0.1
+
+    assert np.allclose(bilinear[:-1], 1.0 + x_pix[:-1] + 2.0 * y_pix[:-1], rtol=1e-6)
+
+    assert bilinear[-1] == 0
+
+    shape.K = 2.0
+
+    assert np.allclose(shape(ra, dec), 2 * bilinear)
+
+    with pytest.raises(AssertionError):
+
+        shape.set_interpolation("cubic")
+
+    assert shape.to_dict()["extra_setup"]["_interpolation"] == "bilinear"
+
+    # The two methods agree at the centers of the pixels, and the nearest pixel is used up to half a pixel away
+    # from the center
+
+    shape.K = 1.0
+
+    i_x = np.array([0, 3, 17, 49, 25])
+    i_y = np.array([0, 8, 21, 39, 39])
+
+    ra_centers = 10.0 + 0.1 * i_x
+    dec_centers = 0.1 * i_y
+
+    bilinear = shape(ra_centers, dec_centers)
+
+    shape.set_interpolation("nearest")
+
+    assert np.allclose(shape(ra_centers, dec_centers), bilinear)
+
+    assert np.allclose(bilinear, data[i_y, i_x])
+
+    assert np.all(shape(ra_centers + 0.04, dec_centers) == data[i_y, i_x])
+
+    assert np.all(shape(ra_centers[1:] - 0.04, dec_centers[1:] - 0.04) == data[i_y[1:], i_x[1:]])
+
+    assert shape(10.0 - 0.04, 0.0) == data[0, 0]
+
+    os.remove("test_lookup.fits")
+
+
+def test_memory_mapped_templates():
+
+    cards = {
+        "SIMPLE": "T",
+        "BITPIX": -64,
+        "NAXIS": 2,
+        "NAXIS1": 30,
+        "NAXIS2": 20,
+        "CUNIT1": 'deg',
+        "CRVAL1": 10.0,
+        "CRPIX1": 1,
+        "CDELT1": 0.1,
+        "CUNIT2": 'deg',
+        "CRVAL2": 0.0,
+        "CRPIX2": 1,
+        "CDELT2": 0.1,
+        "CTYPE1": 'RA---CAR',
+        "CTYPE2": 'DEC--CAR'}
+
+    data = np.random.uniform(0, 1, (20, 30))
+
+    hdu = fits.PrimaryHDU(data=data, header=fits.Header(cards))
+    hdu.writeto("test_memmap.fits", overwrite=True)
+
+    shape1 = SpatialTemplate_2D()
+    shape1.load_file("test_memmap.fits")
+
+    # The map is read-only and memory-mapped
+
+    assert not shape1._map.flags.writeable
+    base = shape1._map
+
+    while not isinstance(base, mmap.mmap):
+
+        base = base.base
+
+        assert base is not None
+    assert np.all(shape1._map == data)
+
+    # The hash is computed as before, and cached
+
+    h = hashlib.sha224()
+    h.update(np.ascontiguousarray(shape1._map))
+    h.update(repr(shape1._wcs).encode('utf-8'))
+
+    assert shape1.hash.value == float(int(h.hexdigest(), 16))
+
+    shape2 = SpatialTemplate_2D()
+    shape2.load_file("test_memmap.fits")
+
+    assert shape2.hash.value == shape1.hash.value
+
+    # Derived arrays are computed only once
+
+    n_calls = []
+
+    def factory():
+
+        n_calls.append(1)
+
+        return data * 2
+
+    array1 = cached_files.load_cached_array("test_memmap.fits", "test", factory)
+    array2 = cached_files.load_cached_array("test_memmap.fits", "test", factory)
+
+    assert len(n_calls) == 1
+    assert isinstance(array2, np.memmap) and not array2.flags.writeable
+    assert np.all(array1 == data * 2)
+
+    # A modified file gets new derived data
+
+    mtime = os.stat("test_memmap.fits").st_mtime_ns
+
+    hdu = fits.PrimaryHDU(data=data + 1, header=fits.Header(cards))
+    hdu.writeto("test_memmap.fits", overwrite=True)
+    os.utime("test_memmap.fits", ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+
+    assert np.all(cached_files.load_cached_array("test_memmap.fits", "test", factory) == data * 2)
+    assert len(n_calls) == 2
+
+    os.remove("test_memmap.fits")
+
+
+def test_galprop_template_3D():
+
+    cards = {
+        "SIMPLE": "T",
+        "BITPIX": -64,
+        "NAXIS": 3,
+        "NAXIS1": 41,
+        "NAXIS2": 21,
+        "NAXIS3": 5,
+        "CDELT1": 0.5,
+        "CRVAL1": -10.0,
+        "CDELT2": 0.5,
+        "CRVAL2": -5.0,
+        "CDELT3": 0.5,
+        "CRVAL3": 2.0}
+
+    E, B, L = np.meshgrid(2.0 + 0.5 * np.arange(5), -5.0 + 0.5 * np.arange(21), -10.0 + 0.5 * np.arange(41),
+                          indexing="ij")
+
+    # A map which is linear in the coordinates after the preprocessing (units and flip of the longitude axis)
+
+    expected_map = 1.0 + 0.1 * L + 0.2 * B + E
+
+    data = np.flip(expected_map, axis=2) * np.power(10, E) ** 2
+
+    hdu = fits.PrimaryHDU(data=data, header=fits.Header(cards))
+    hdu.writeto("test_galprop.fits", overwrite=True)
+
+    shape = functions_3D.GalPropTemplate_3D()
+    shape.load_file("test_galprop.fits", -10, 10, -5, 5, galactic=True)
+
+    assert np.allclose(shape._map, expected_map)
+
+    # Positions on the galactic plane close to the galactic center, and energies (keV) within the map
+
+    l = np.array([1.2, 9.5, 3.3, 7.9, 30.0])
+    b = np.array([0.3, -1.1, 2.2, -4.0, 0.0])
+
+    coord = SkyCoord(l=l, b=b, frame="galactic", unit="deg").transform_to("icrs")
+
+    ra = coord.ra.value
+    dec = coord.dec.value
+
+    energies = np.array([200e3, 1e6, 5e6])
+
+    values = shape(ra, dec, energies)
+
+    assert values.shape == (5, 3)
+
+    lon = np.where(l > 180, 180 - l, l)
+
+    expected = (1.0 + 0.1 * lon[:, np.newaxis] + 0.2 * b[:, np.newaxis] + np.log10(energies / 1e3)) / 1000.
+
+    assert np.allclose(values[:-1], expected[:-1], rtol=1e-6)
+
+    # Outside of the map
+
+    assert np.all(values[-1] == 0)
+
+    # The interpolated maps are cached by grid, so different grids give different (correct) results
+
+    assert np.allclose(shape(ra[:2], dec[:2], energies[:1]), expected[:2, :1], rtol=1e-6)
+
+    assert len(shape._interpolated_maps) == 2
+
+    assert np.allclose(shape(ra, dec, energies), values)
+
+    assert len(shape._interpolated_maps) == 2
+
+    # The scipy interpolator is built only when it is used
+
+    assert shape._F is None
+
+    shape.set_interpolation("scipy")
+
+    assert np.allclose(shape(ra, dec, energies), values, rtol=1e-10)
+
+    assert shape._F is not None
+
+    with pytest.raises(AssertionError):
+
+        shape.set_interpolation("cubic")
+
+    os.remove("test_galprop.fits")
+
+
+def test_numba_policy():
+
+    x = np.logspace(0, 3, 1000)
+
+    policy = get_numba_policy()
+
+    assert set(policy.keys()) == {"parallel", "fastmath", "n_threads", "threading_layer"}
+
+    pl = Powerlaw(K=2.0, index=-2.3)
+
+    reference = pl(x)
+
+    # Strict math, only within the context
+
+    with numba_policy(fastmath=False):
+
+        assert get_numba_policy()["fastmath"] is False
+
+        strict = pl(x)
+
+    assert get_numba_policy() == policy
+
+    assert (policy["parallel"], False) in numba_functions.plaw_eval._variants
+
+    assert np.allclose(strict, reference, rtol=1e-12)
+
+    # Parallel kernels give the same results as the serial ones
+
+    gaussian = Gaussian_on_sphere(lon0=10.0, lat0=20.0, sigma=2.0)
+
+    lon = np.random.uniform(5, 15, 5000)
+    lat = np.random.uniform(15, 25, 5000)
+
+    serial = gaussian(lon, lat)
+
+    with numba_policy(parallel=True, n_threads=1):
+
+        parallel = gaussian(lon, lat)
+
+    assert (True, policy["fastmath"]) in numba_functions.gaussian_on_sphere_eval._variants
+
+    assert np.allclose(parallel, serial, rtol=1e-12)
+
+    # Functions of scalars are never compiled in parallel
+
+    with numba_policy(parallel=True):
+
+        numba_functions.plaw_flux_norm(-2.3, 1.0, 10.0)
+
+    assert (True, policy["fastmath"]) not in numba_functions.plaw_flux_norm._variants
+
+    # Global changes
+
+    try:
+
+        set_numba_policy(fastmath=False)
+
+        assert get_numba_policy()["fastmath"] is False
+
+    finally:
+
+        set_numba_policy(fastmath=policy["fastmath"])
+
+    with pytest.raises(ValueError):
+
+        set_numba_policy(n_threads=0)
+
+
+_thread_count_script = """
+import numba as nb
+import numpy as np
+
+from astromodels.functions import Gaussian_on_sphere
+from astromodels.utils.configuration import numba_policy
+
+# Importing astromodels does not change the threading layer of numba
+
+assert nb.config.THREADING_LAYER == "default"
+
+f = Gaussian_on_sphere()
+x = np.linspace(0, 10, 100)
+y = np.linspace(0, 10, 100)
+
+# The number of threads chosen by the user is preserved
+
+nb.set_num_threads(3)
+
+set_values = []
+
+set_num_threads = nb.set_num_threads
+
+def _recording(n):
+
+    set_values.append(n)
+
+    set_num_threads(n)
+
+nb.set_num_threads = _recording
+
+with numba_policy(parallel=True):
+
+    f(x, y)
+
+    assert nb.get_num_threads() == 3
+
+assert set_values == []
+
+# ... and the number of threads of the policy is used only during the execution of the kernels
+
+with numba_policy(parallel=True, n_threads=2):
+
+    f(x, y)
+
+    assert nb.get_num_threads() == 3
+
+assert set_values == [2, 3]
+
+assert nb.get_num_threads() == 3
+"""
+
+
+def test_numba_policy_thread_count():
+
+    # numba fixes the maximum number of threads at import, so the test runs in a separate process
+
+    env = dict(os.environ, NUMBA_NUM_THREADS="4")
+
+    env.pop("ASTROMODELS_DEBUG", None)
+
+    result = subprocess.run([sys.executable, "-c", _thread_count_script], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    assert result.returncode == 0, result.stdout.decode()
+
+
+def test_absorption_cross_section_cache():
+
+    # Cross section tables are read once per process and shared by all the instances
+
+    tbabs1 = TbAbs()
+    tbabs2 = TbAbs()
+
+    assert tbabs1.xsect_val is tbabs2.xsect_val
+
+    assert not tbabs1.xsect_val.flags.writeable
+
+    x = np.logspace(-1, 1, 100)
+
+    tbabs1.redshift.value = 0.5
+
+    expected = np.exp(-tbabs1.NH.value * np.interp(x * 1.5, tbabs1.xsect_ene, tbabs1.xsect_val))
+
+    assert np.allclose(tbabs1(x), expected)
+
+    # The cross section is interpolated once per energy grid and redshift, for all the instances
+
+    absorption_module._xsect_cache.clear()
+
+    tbabs2.redshift.value = 0.5
+
+    tbabs1.NH.value = 2.0
+    tbabs1(x)
+
+    tbabs2.NH.value = 3.0
+    tbabs2(x.copy())
+
+    assert len(absorption_module._xsect_cache) == 1
+
+    tbabs2.redshift.value = 0.1
+    tbabs2(x)
+
+    PhAbs()(x)
+
+    assert len(absorption_module._xsect_cache) == 3
+
+    # An unknown table falls back to the default one
+
+    phabs = PhAbs()
+
+    phabs.init_xsect("WILM")
+
+    assert phabs._abund_table == "AG89"
+
+
+def test_dark_matter_tables():
+
+    from scipy.interpolate import RegularGridInterpolator
+
+    from astromodels.utils.data_files import _get_data_file_path
+
+    dm_fit1 = dm_models.DMFitFunction()
+    dm_fit2 = dm_models.DMFitFunction()
+
+    # The tables are read once and shared by all the instances
+
+    assert dm_fit1._dn is dm_fit2._dn
+
+    assert not dm_fit1._dn.flags.writeable
+
+    dn = np.loadtxt(_get_data_file_path("dark_matter/gammamc_dif.dat")).reshape((12, 24, 250))
+
+    assert np.all(dm_fit1._dn == dn)
+
+    # ... and by the clones and the unpickled copies
+
+    from astromodels import Model, PointSource, clone_model
+
+    dm_model = Model(PointSource("dm", ra=1.0, dec=2.0, spectral_shape=dm_fit1))
+
+    for shared_assets in (True, False):
+
+        dm_clone = clone_model(dm_model, share_assets=shared_assets).dm.spectrum.main.shape
+
+        assert dm_clone._dn is dm_fit1._dn
+
+    assert pickle.loads(pickle.dumps(dm_fit1))._dn is dm_fit1._dn
+
+    # Interpolation at the current channel and mass (with extrapolation outside of the table)
+
+    x = np.logspace(3, 8, 300)
+
+    for channel, mass in ((4, 37.0), (2, 1.5), (12, 2e4)):
+
+        dm_fit1.channel.value = channel
+        dm_fit1.mass.value = mass
+
+        interpolator = RegularGridInterpolator([dm_fit1._mass, dm_fit1._x],
+                                               dn[dm_models._channel_index_mapping[channel]],
+                                               bounds_error=False, fill_value=None)
+
+        xm = np.log10(x * 1e-6 / mass)
+
+        expected = interpolator((mass, xm))
+        expected[xm > 0] = 0
+
+        expected *= 1.0 / (8.0 * np.pi) / mass ** 2 * dm_fit1.sigmav.value * dm_fit1.J.value / x
+
+        assert np.allclose(dm_fit1(x), expected, rtol=1e-10)
+
+    dm_spectra = dm_models.DMSpectra()
+
+    assert dm_spectra._dn.shape == (12, 24 + 23, 250)
+
+    assert np.all(dm_spectra._dn[:, :24] == dn)
+
+    assert pickle.loads(pickle.dumps(dm_spectra))._dn is dm_spectra._dn
+
+
+def test_synchrotron():
+
+    # The tabulated kernel reproduces the analytic approximation
+
+    x = np.logspace(-10, 2.8, 1000)
+
+    assert np.allclose(synchrotron_module.synchrotron_kernel(x), synchrotron_module._akp10_kernel(x), rtol=1e-6)
+
+    assert synchrotron_module.synchrotron_kernel(np.array([1e4]))[0] == 0
+
+    # An exponentially cut-off power law of electrons (1e36 / eV at 1 TeV, index 2.1, cutoff 10 TeV)
+
+    electrons = Cutoff_powerlaw()
+
+    for parameter in electrons.parameters.values():
+
+        parameter.bounds = (None, None)
+
+    electrons.K.value = 1e39
+    electrons.piv.value = 1e9
+    electrons.index.value = -2.1
+    electrons.xc.value = 1e10
+
+    synchrotron = Synchrotron()
+
+    with pytest.raises(AssertionError):
+
+        synchrotron(1.0)
+
+    synchrotron.particle_distribution = electrons
+    synchrotron.B.value = 1e-4
+
+    # Reference computed with naima (0.10.4) for the same model, with nEed=4000 so that its integration error is
+    # negligible. With the default 10 points per decade, the difference is below 1e-3 (naima itself differs from
+    # its converged result by up to 16% with nEed=10)
+
+    energies = np.array([1e-5, 1e-3, 1e-1, 1.0, 10.0, 100.0])
+
+    naima_fluxes = np.array([7.41842043e+10, 5.46304000e+07, 2.44511094e+04, 2.48858966e+02, 6.62455952e-01,
+                             9.66171680e-05])
+
+    assert np.allclose(synchrotron(energies), naima_fluxes, rtol=1e-3)
+
+    synchrotron.set_units(u.keV, 1 / (u.keV * u.cm ** 2 * u.s))
+
+    assert np.allclose(synchrotron(energies * u.MeV / 1000).to_value(1 / (u.keV * u.cm ** 2 * u.s)), naima_fluxes,
+                       rtol=1e-3)
+
+    # The kernel matrix does not change with the particle distribution
+
+    kernel_matrix = synchrotron._kernel_matrix[1]
+
+    electrons.index.value = -2.2
+
+    assert not np.allclose(synchrotron(energies), naima_fluxes, rtol=1e-3)
+
+    assert synchrotron._kernel_matrix[1] is kernel_matrix
+
+    synchrotron.B.value = 2e-4
+
+    synchrotron(energies)
+
+    assert synchrotron._kernel_matrix[1] is not kernel_matrix
+
+
+@pytest.mark.skipif(not has_ebltable, reason="ebltable is not available")
+def test_ebl_attenuation():
+
+    import ebltable.tau_from_model as ebltau
+
+    ebl = EBLattenuation()
+
+    # Energies (keV) beyond both edges of the table, and redshifts beyond its end
+
+    x = np.logspace(4, 12, 500)
+
+    for model in ("dominguez", "finke"):
+
+        ebl.set_ebl_model(model)
+
+        reference = ebltau.OptDepth.readmodel(model=model)
+
+        for redshift in (0.0, 0.1, 0.337, 1.0, 5.0):
+
+            ebl.redshift.value = redshift
+
+            assert np.allclose(ebl(x), np.exp(-reference.opt_depth(redshift, x / 1e9)), rtol=1e-10, atol=1e-14)
+
+    # The position of the energies in the table is computed once per grid, the optical depth once per redshift
+
+    assert len(ebl._energy_lookups) == 1
+
+    tau = ebl._get_optical_depth(x, 5.0)
+
+    ebl.attenuation.value = 0.5
+
+    ebl(x)
+
+    assert ebl._get_optical_depth(x, 5.0) is tau
+
+    ebl(x[::2])
+
+    assert len(ebl._energy_lookups) == 2
+
+
+@pytest.mark.skipif(not has_atomdb, reason="pyatomdb is not available")
+def test_apec_tabulation():
+
+    x = np.geomspace(0.3, 10.0, 200)
+
+    for function, abundance in ((APEC(), "abund"), (VAPEC(), "O")):
+
+        function.init_session()
+
+        function.kT.value = 2.3
+
+        getattr(function, abundance).value = 0.4
+
+        exact = function(x)
+
+        # The response is set again only for other energies
+
+        response_key = function._response_key
+
+        function.kT.value = 2.4
+
+        function(x)
+
+        assert function._response_key == response_key
+
+        function.tabulate(x, temperatures=np.geomspace(1.0, 5.0, 200), n_workers=2, wait=True)
+
+        function.kT.value = 2.3
+
+        assert np.allclose(function(x), exact, rtol=1e-3)
+
+        # Abundances not used in the table
+
+        getattr(function, abundance).value = 2.0
+
+        tabulated = function(x)
+
+        function.clear_table()
+
+        assert np.allclose(function(x), tabulated, rtol=1e-3)
+
+        function.clean()
+
+
 def test_spatial_template_2D():
 
     # make the fits files with templates to test.
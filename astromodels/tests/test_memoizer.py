@@ -1,5 +1,9 @@
 from builtins import zip
+from astromodels.core import memoization
+from astromodels.core.evaluation_grid import EvaluationGrid
+from astromodels.core.memoization import array_fingerprint
 from astromodels.functions import Powerlaw
+from astromodels.utils.cached_files import get_array_fingerprint
 import numpy as np
 
 
@@ -18,3 +22,51 @@ def test_memoizer():
         po(1.0)
 
 
+
+
+def test_array_fingerprint(monkeypatch):
+
+    a = np.linspace(1, 10, 1000)
+
+    b = a.copy()
+    b[500] += 1e-12
+
+    assert array_fingerprint(a) == array_fingerprint(a.copy())
+    assert array_fingerprint(a) != array_fingerprint(b)
+    assert array_fingerprint(a) != array_fingerprint(a.reshape(10, 100))
+
+    # The content of writeable arrays (and of read-only views of them) can change, so their fingerprint is computed
+    # at every call
+    view = a[:]
+    view.flags.writeable = False
+
+    fingerprint = array_fingerprint(view)
+
+    a[0] = 0.0
+
+    assert array_fingerprint(view) != fingerprint
+
+    # For arrays which cannot change it is computed only once
+    calls = []
+
+    def _counting(*args):
+
+        calls.append(1)
+
+        return get_array_fingerprint(*args)
+
+    monkeypatch.setattr(memoization, "get_array_fingerprint", _counting)
+
+    c = np.linspace(1, 10, 1000).copy()
+    c.flags.writeable = False
+
+    assert array_fingerprint(c) == array_fingerprint(c) == array_fingerprint(b.copy() * 0 + c)
+
+    assert len(calls) == 2
+
+    grid = EvaluationGrid("test", c)
+
+    calls.clear()
+
+    assert array_fingerprint(grid.energies) == array_fingerprint(c)
+    assert len(calls) == 0
@@ -11,13 +11,20 @@ __author__ = "giacomov"
 import copy
 
 import numpy as np
+import scipy.integrate
 
 from astromodels import u
+from astromodels.core.evaluation_engine import EvaluationEngine
+from astromodels.core.memoization import use_incremental_evaluation
 from astromodels.core.model import (CannotWriteModel, DuplicatedNode, Model,
                                     ModelFileExists)
+from astromodels.core.model_hdf5 import ModelHDF5Error, load_model_dict
 from astromodels.core.model_parser import *
+from astromodels.core import spatial_index as spatial_index_module
+from astromodels.core.my_yaml import my_yaml
 from astromodels.core.parameter import IndependentVariable, Parameter
-from astromodels.functions import (Gaussian_on_sphere, Line, Powerlaw,
+from astromodels.functions import (Cutoff_powerlaw, Exponential_cutoff,
+                                   Gaussian_on_sphere, Line, Powerlaw, TbAbs,
                                    Uniform_prior)
 from astromodels.functions.functions_1D.functions import _ComplexTestFunction
 from astromodels.sources.extended_source import ExtendedSource
@@ -844,6 +851,52 @@ def test_3ML_interface():
         m.particle_sources.values())[0].name
 
 
+def test_evaluation_engine():
+
+    mg = ModelGetter()
+    m = mg.model
+
+    energies = np.logspace(1, 2, 50)
+    ra = np.random.uniform(0, 1.0, 30)
+    dec = np.random.uniform(0.0, 1.0, 30)
+
+    expected_pts = np.array([m.get_point_source_fluxes(i, energies)
+                             for i in range(m.get_number_of_point_sources())])
+
+    expected_ext = [m.get_extended_source_fluxes(i, ra, dec, energies)
+                    for i in range(m.get_number_of_extended_sources())]
+
+    for engine in [EvaluationEngine(),
+                   EvaluationEngine("thread", n_workers=2, chunk_size=7),
+                   EvaluationEngine("process", n_workers=2, chunk_size=20)]:
+
+        m.evaluation_engine = engine
+
+        fluxes = m.get_all_point_source_fluxes(energies)
+
+        assert fluxes.shape == (m.get_number_of_point_sources(), energies.shape[0])
+
+        # Results must be identical to the serial evaluation
+        assert np.all(fluxes == expected_pts)
+
+        ext_fluxes = m.get_all_extended_source_fluxes(ra, dec, energies)
+
+        for this_flux, this_expected in zip(ext_fluxes, expected_ext):
+
+            assert np.all(this_flux == this_expected)
+
+        assert np.allclose(m.get_total_flux(energies), expected_pts.sum(axis=0))
+
+    # The model must still be picklable with a pool attached
+    _ = copy.deepcopy(m)
+
+    m.evaluation_engine.shutdown()
+
+    with pytest.raises(ValueError):
+
+        EvaluationEngine("gpu")
+
+
 def test_clone_model():
 
     mg = ModelGetter()
@@ -894,6 +947,61 @@ def test_clone_model():
     _ = clone_model(m1)
 
 
+def test_clone_model_sharing_assets():
+
+    mg = ModelGetter()
+    m1 = mg.model
+
+    absorbed = PointSource("absorbed", ra=1.0, dec=2.0, spectral_shape=TbAbs() * Powerlaw())
+    m1.add_source(absorbed)
+
+    time = IndependentVariable("time", 1.0, u.s)
+    m1.add_independent_variable(time)
+
+    m1.link(m1.one.spectrum.main.Powerlaw.K, time, Line())
+    m1.link(m1.two.spectrum.main.shape.index, m1.one.spectrum.main.Powerlaw.index)
+
+    m1.one.spectrum.main.Powerlaw.index.add_callback(lambda parameter: None)
+
+    m2 = clone_model(m1)
+
+    assert m2.to_dict_with_types() == m1.to_dict_with_types()
+    assert m2.to_dict_with_types() == clone_model(m1, share_assets=False).to_dict_with_types()
+
+    # The cross sections are shared, everything else is copied
+    tbabs1 = m1.absorbed.spectrum.main.shape.functions[0]
+    tbabs2 = m2.absorbed.spectrum.main.shape.functions[0]
+
+    assert tbabs2 is not tbabs1
+    assert tbabs2.xsect_val is tbabs1.xsect_val
+    assert m2.absorbed.spectrum.main.shape.NH_1 is not m1.absorbed.spectrum.main.shape.NH_1
+
+    # Callbacks are not cloned, like when saving and loading
+    assert len(m2.one.spectrum.main.Powerlaw.index.get_callbacks()) == 0
+    assert len(m1.one.spectrum.main.Powerlaw.index.get_callbacks()) == 1
+
+    # Links point to the objects of the clone
+    assert m2.one.spectrum.main.Powerlaw.K.auxiliary_variable[0] is m2.time
+
+    m2.time.value = 3.0
+
+    assert m2.one.spectrum.main.Powerlaw.K.value == 3.0
+    assert m1.one.spectrum.main.Powerlaw.K.value == 1.0
+
+    m2.one.spectrum.main.Powerlaw.index.value = -1.7
+
+    assert m2.two.spectrum.main.shape.index.value == -1.7
+    assert m1.two.spectrum.main.shape.index.value == -2.0
+
+    energies = np.logspace(0, 2, 20)
+
+    m2.absorbed.spectrum.main.shape.NH_1.value = 10.0
+
+    assert np.allclose(m2.get_point_source_fluxes(3, energies),
+                       tbabs2(energies) * m2.absorbed.spectrum.main.shape.functions[1](energies))
+    assert not np.allclose(m2.get_point_source_fluxes(3, energies), m1.get_point_source_fluxes(3, energies))
+
+
 def test_model_parser():
 
     mg = ModelGetter()
@@ -994,6 +1102,469 @@ def test_time_domain_integration():
 
     assert np.allclose(expected_results, results)
 
+    results = m.get_point_source_fluxes(0, energies, tag=(time, 0, 10, "gauss_legendre"))
+
+    assert np.allclose(expected_results, results)
+
+    # A law which is not a polynomial, different for each energy, compared with the integration of each energy
+    # with scipy
+    m.unlink(po.K)
+
+    m.link(po.index, time, Exponential_cutoff(K=1.0, xc=3.0))
+
+    results = m.get_point_source_fluxes(0, energies, tag=(time, 0.5, 4.0))
+
+    expected_results = []
+
+    for e in energies:
+
+        def integrand(t):
+
+            time.value = t
+
+            return src(e)
+
+        expected_results.append(scipy.integrate.quad(integrand, 0.5, 4.0)[0] / 3.5)
+
+    assert np.allclose(results, expected_results, rtol=1e-5)
+
+
+def test_evaluate_grid():
+
+    shape = Powerlaw() + Cutoff_powerlaw()
+
+    src = PointSource("test", ra=0.0, dec=0.0, spectral_shape=shape)
+
+    m = Model(src)
+
+    time = IndependentVariable("time", 0.0, u.s)
+
+    m.add_independent_variable(time)
+
+    # Powerlaw (evaluated for all the times at once) and cutoff power law (evaluated time by time)
+    m.link(shape.index_1, time, Line(a=-2.0, b=0.1))
+    m.link(shape.K_2, time, Exponential_cutoff(K=1.0, xc=5.0))
+
+    # A parameter linked to another parameter which depends on time
+    m.link(shape.xc_2, shape.index_1, Line(a=100.0, b=-10.0))
+
+    energies = np.logspace(0, 3, 50)
+    times = np.array([0.0, 1.0, 2.5, 2.5, 7.0])
+
+    cube = m.get_point_source_fluxes_grid(0, energies, {time: times})
+
+    assert cube.shape == (5, 50)
+
+    time.value = 3.0
+
+    for i, t in enumerate(times):
+
+        assert np.allclose(cube[i], src.evaluate_grid(energies, {time: [t]})[0])
+
+    assert time.value == 3.0
+
+    for i, t in enumerate(times):
+
+        time.value = t
+
+        assert np.allclose(cube[i], src(energies))
+
+    # Composition and unary operators
+    shape = Powerlaw().of(Line()) * (-Powerlaw())
+
+    m = Model(PointSource("test", ra=0.0, dec=0.0, spectral_shape=shape))
+    m.add_independent_variable(time)
+    m.link(shape.a_2, time, Line(a=1.0, b=0.5))
+    m.link(shape.index_3, time, Line(a=-1.0, b=-0.1))
+
+    cube = m.get_point_source_fluxes_grid(0, energies, {time: times})
+
+    for i, t in enumerate(times):
+
+        time.value = t
+
+        assert np.allclose(cube[i], m.test(energies))
+
+
+def test_incremental_evaluation():
+
+    mg = ModelGetter()
+    m = mg.model
+
+    energies = np.logspace(1, 2, 20)
+    other_energies = np.logspace(1, 3, 30)
+
+    ra = np.random.uniform(0, 1.0, 10)
+    dec = np.random.uniform(0.0, 1.0, 10)
+
+    time = IndependentVariable("time", 1.0, u.s)
+    m.add_independent_variable(time)
+
+    law = Line()
+    m.link(m.one.spectrum.main.Powerlaw.K, time, law)
+
+    pts = m.one
+    ext = m.ext_one
+
+    with use_incremental_evaluation(True):
+
+        res1 = m.get_point_source_fluxes(0, energies)
+
+        # Nothing changed: the very same (read-only) array is returned
+        assert m.get_point_source_fluxes(0, energies) is res1
+        assert not res1.flags.writeable
+
+        # A different grid is cached separately
+        res_other = m.get_point_source_fluxes(0, other_energies)
+
+        assert np.allclose(res_other, pts._fast_call(other_energies))
+        assert m.get_point_source_fluxes(0, energies) is res1
+
+        # Changing the independent variable changes the value of K through the link
+        time.value = 2.0
+
+        res2 = m.get_point_source_fluxes(0, energies)
+
+        assert res2 is not res1
+        assert np.allclose(res2, pts._fast_call(energies))
+
+        # Changing a parameter of the law must also trigger a new evaluation
+        law.b.value = 3.0
+
+        res3 = m.get_point_source_fluxes(0, energies)
+
+        assert np.allclose(res3, pts._fast_call(energies))
+        assert not np.allclose(res3, res2)
+
+        # Other sources are not affected
+        ext_res = m.get_extended_source_fluxes(0, ra, dec, energies)
+
+        assert m.get_extended_source_fluxes(0, ra, dec, energies) is ext_res
+
+        ext.spectrum.main.Powerlaw.index.value = -1.5
+
+        ext_res2 = m.get_extended_source_fluxes(0, ra, dec, energies)
+
+        assert ext_res2 is not ext_res
+        assert np.allclose(ext_res2, ext._evaluate(ra, dec, energies))
+
+        ext.Gaussian_on_sphere.sigma.value = 0.5
+
+        assert np.allclose(m.get_extended_source_fluxes(0, ra, dec, energies),
+                           ext._evaluate(ra, dec, energies))
+
+    # Outside of the context the cache is not used
+    assert m.get_point_source_fluxes(0, energies) is not m.get_point_source_fluxes(0, energies)
+
+
+def test_evaluation_grid():
+
+    mg = ModelGetter()
+    m = mg.model
+
+    absorbed = PointSource("absorbed", ra=1.0, dec=2.0, spectral_shape=TbAbs() * Powerlaw())
+    m.add_source(absorbed)
+
+    energies = np.logspace(0, 2, 50)
+
+    ra = np.random.uniform(0, 1.0, 10)
+    dec = np.random.uniform(0.0, 1.0, 10)
+
+    grid = m.register_grid("fit", energies, ra, dec)
+
+    assert m.get_grid("fit") is grid
+    assert list(m.evaluation_grids.keys()) == ["fit"]
+
+    # The arrays of the grid cannot be changed
+    assert not grid.energies.flags.writeable
+
+    with pytest.raises(ValueError):
+
+        grid.energies[0] = 1.0
+
+    n_pts = m.get_number_of_point_sources()
+
+    for i in range(n_pts):
+
+        assert np.allclose(m.get_point_source_fluxes(i, grid), m.get_point_source_fluxes(i, energies))
+
+    # The cross section has been interpolated once and attached to the grid
+    n_entries = grid.n_entries
+
+    assert n_entries > 0
+
+    absorbed.spectrum.main.shape.NH_1.value = 3.0
+
+    assert np.allclose(m.get_point_source_fluxes(n_pts - 1, grid), m.get_point_source_fluxes(n_pts - 1, energies))
+    assert grid.n_entries == n_entries
+
+    # A different redshift needs a different interpolation
+    absorbed.spectrum.main.shape.redshift_1.value = 0.5
+
+    assert np.allclose(m.get_point_source_fluxes(n_pts - 1, grid), m.get_point_source_fluxes(n_pts - 1, energies))
+    assert grid.n_entries == n_entries + 1
+
+    assert np.allclose(m.get_all_point_source_fluxes(grid), m.get_all_point_source_fluxes(energies))
+    assert np.allclose(m.get_total_flux(grid), m.get_total_flux(energies))
+
+    for i in range(m.get_number_of_extended_sources()):
+
+        assert np.allclose(m.get_extended_source_fluxes(i, grid), m.get_extended_source_fluxes(i, ra, dec, energies))
+
+    m.evaluation_engine = EvaluationEngine("serial", chunk_size=7)
+
+    for res1, res2 in zip(m.get_all_extended_source_fluxes(grid), m.get_all_extended_source_fluxes(ra, dec, energies)):
+
+        assert np.allclose(res1, res2)
+
+    assert np.allclose(m.get_all_point_source_fluxes(grid), m.get_all_point_source_fluxes(energies))
+
+    # Copies of a grid do not carry the precomputed data
+    grid2 = copy.deepcopy(grid)
+
+    assert grid2.n_entries == 0
+    assert grid2.energies.evaluation_grid is grid2
+    assert np.array_equal(grid2.ra, ra)
+
+    m.remove_grid("fit")
+
+    assert len(m.evaluation_grids) == 0
+
+    with pytest.raises(AssertionError):
+
+        m.get_grid("fit")
+
+    with pytest.raises(AssertionError):
+
+        m.register_grid("wrong", energies, ra)
+
+
+def _get_id_lists(indptr, ids):
+
+    return [list(ids[indptr[i]:indptr[i + 1]]) for i in range(len(indptr) - 1)]
+
+
+def test_spatial_index(monkeypatch):
+
+    def _make_source(name, lon0, lat0, sigma_max=2.0):
+
+        shape = Gaussian_on_sphere(lon0=lon0, lat0=lat0)
+        shape.sigma.max_value = sigma_max
+        shape.sigma.value = 1.0
+
+        return ExtendedSource(name, shape, Powerlaw())
+
+    # One of the sources crosses R.A. = 0
+    m = Model(_make_source("ext_a", 359.0, 10.0), _make_source("ext_b", 100.0, -30.0))
+
+    ra = np.array([1.0, 357.0, 354.0, -2.0, 100.0, 100.0, 200.0])
+    dec = np.array([10.0, 12.0, 10.0, 9.0, -30.0, 30.0, 0.0])
+
+    expected = np.array([True, True, False, True, True, False, False])
+
+    assert np.array_equal(m.is_inside_any_extended_source(ra, dec), expected)
+
+    for i in range(ra.shape[0]):
+
+        assert m.is_inside_any_extended_source(ra[i], dec[i]) == expected[i]
+
+    assert _get_id_lists(*m.get_extended_sources_at(ra, dec)) == [[0], [0], [], [0], [1], [], []]
+
+    index = m.spatial_index
+
+    assert m.spatial_index is index
+
+    # Moving a source, or changing its size, makes the index rebuild itself
+    m.ext_b.Gaussian_on_sphere.lat0.value = 30.0
+
+    assert m.spatial_index is not index
+    assert list(m.is_inside_any_extended_source(ra, dec)) == [True, True, False, True, False, True, False]
+
+    m.ext_b.Gaussian_on_sphere.sigma.max_value = 60.0
+
+    assert m.is_inside_any_extended_source(200.0, 0.0)
+
+    m.remove_source("ext_b")
+
+    assert m.spatial_index.n_sources == 1
+    assert _get_id_lists(*m.get_extended_sources_at(ra, dec)) == [[0], [0], [], [0], [], [], []]
+
+    # Same result as testing every point against every bounding box, also when the points are processed in
+    # several chunks
+    monkeypatch.setattr(spatial_index_module, "_N_POINTS_PER_CHUNK", 1000)
+
+    rng = np.random.default_rng(0)
+
+    sources = [_make_source("src_%i" % i, rng.uniform(0, 360), rng.uniform(-85, 85), rng.uniform(1, 20))
+               for i in range(40)]
+
+    m = Model(*sources)
+
+    ra = rng.uniform(-180, 360, 5000)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, 5000)))
+
+    expected = []
+
+    for this_ra, this_dec in zip(ra % 360.0, dec):
+
+        expected.append([])
+
+        for i, source in enumerate(sources):
+
+            (ra_min, ra_max), (dec_min, dec_max) = source.get_boundaries()
+
+            if ra_max - ra_min >= 360.0:
+
+                in_ra = True
+
+            elif ra_min % 360.0 <= ra_max % 360.0:
+
+                in_ra = ra_min % 360.0 <= this_ra <= ra_max % 360.0
+
+            else:
+
+                in_ra = this_ra >= ra_min % 360.0 or this_ra <= ra_max % 360.0
+
+            if in_ra and dec_min <= this_dec <= dec_max:
+
+                expected[-1].append(i)
+
+    indptr, ids = m.get_extended_sources_at(ra, dec)
+
+    assert _get_id_lists(indptr, ids) == expected
+
+    assert np.array_equal(m.is_inside_any_extended_source(ra, dec), [len(x) > 0 for x in expected])
+
+
+def test_binary_format(monkeypatch):
+
+    mg = ModelGetter()
+    m = mg.model
+
+    time = IndependentVariable("time", 1.0, u.s)
+    m.add_independent_variable(time)
+
+    m.link(m.one.spectrum.main.Powerlaw.K, time, Line())
+    m.link(m.two.spectrum.main.shape.index, m.one.spectrum.main.Powerlaw.index)
+
+    m.one.spectrum.main.Powerlaw.index.prior = Uniform_prior()
+    m.one.position.ra.free = True
+    m.ext_one.Gaussian_on_sphere.sigma.value = 0.123456789012345
+
+    yaml_file = "__test.yml"
+    binary_file = "__test_binary.h5"
+
+    m.save(yaml_file, overwrite=True)
+    m.save(binary_file, overwrite=True, binary=True)
+
+    with pytest.raises(ModelFileExists):
+
+        m.save(binary_file, binary=True)
+
+    with open(yaml_file) as f:
+
+        yaml_dict = my_yaml.load(f, Loader=my_yaml.FullLoader)
+
+    # Exactly the same content as the YAML representation
+    binary_dict = load_model_dict(binary_file)
+
+    assert binary_dict == yaml_dict
+    assert binary_dict == m.to_dict_with_types()
+
+    new_m = load_model(binary_file)
+
+    assert new_m.to_dict_with_types() == m.to_dict_with_types()
+    assert new_m.one.spectrum.main.Powerlaw.K.has_auxiliary_variable()
+    assert new_m.two.spectrum.main.shape.index.has_auxiliary_variable()
+
+    os.remove(yaml_file)
+    os.remove(binary_file)
+
+    # Errors of the format are not reported as errors of the file system
+
+    import h5py
+
+    with h5py.File(binary_file, "w") as f:
+
+        f.attrs["format"] = "something else"
+
+    with pytest.raises(ModelHDF5Error):
+
+        load_model(binary_file)
+
+    monkeypatch.setattr(Model, "to_dict_with_types", lambda self: {"unsupported": object()})
+
+    with pytest.raises(ModelHDF5Error):
+
+        m.save(binary_file, overwrite=True, binary=True)
+
+    os.remove(binary_file)
+
+
+def test_lazy_loading():
+
+    mg = ModelGetter()
+    m = mg.model
+
+    m.one.position.ra.value = 100.0
+    m.one.position.dec.value = 20.0
+    m.ext_one.Gaussian_on_sphere.lon0.value = 100.0
+    m.ext_one.Gaussian_on_sphere.lat0.value = 20.0
+
+    time = IndependentVariable("time", 1.0, u.s)
+    m.add_independent_variable(time)
+
+    m.link(m.two.spectrum.main.Powerlaw.index, m.part_one.spectrum.main.Powerlaw.index)
+
+    m.save("__test.yml", overwrite=True)
+
+    new_m = load_model("__test.yml", lazy=True)
+
+    assert len(new_m.pending_sources) == 8
+    assert "time" in new_m
+
+    # The saved model is the same (apart from the order), even if nothing has been built
+    assert dict(new_m.to_dict_with_types()) == dict(m.to_dict_with_types())
+    assert len(new_m.pending_sources) == 8
+
+    # Selection with a cone
+    assert sorted(new_m.materialize_sources(j2000_ra=101.0, j2000_dec=21.0, radius=5.0)) == ["ext_one", "one"]
+    assert len(new_m.pending_sources) == 6
+
+    # Access by attribute builds the source, and the sources it is linked to
+    assert new_m.two.spectrum.main.Powerlaw.index.has_auxiliary_variable()
+    assert "part_one" not in new_m.pending_sources
+
+    # Access by path
+    assert new_m["ext_two.Gaussian_on_sphere.sigma"].value == m.ext_two.Gaussian_on_sphere.sigma.value
+    assert "three.spectrum.main" in new_m
+    assert "four" not in new_m
+
+    with pytest.raises(AttributeError):
+
+        _ = new_m.four
+
+    new_m.remove_source("ext_three")
+
+    assert sorted(new_m.materialize_sources()) == ["part_two"]
+    assert len(new_m.pending_sources) == 0
+    assert len(new_m.sources) == 7
+    assert len(new_m.parameters) == len(m.parameters) - 6
+
+    # Queries about the whole model build all the remaining sources first
+    for query in [lambda x: x.get_number_of_point_sources(), lambda x: len(x.free_parameters),
+                  lambda x: list(x.get_total_flux([1.0, 10.0])), lambda x: x.get_number_of_extended_sources(),
+                  lambda x: list(x.point_sources), lambda x: x.spatial_index.n_sources,
+                  lambda x: x.is_inside_any_extended_source(100.0, 20.0)]:
+
+        lazy_m = load_model("__test.yml", lazy=True)
+
+        assert query(lazy_m) == query(m)
+
+        assert len(lazy_m.pending_sources) == 0
+
+    os.remove("__test.yml")
+
 
 def test_deepcopy():
 
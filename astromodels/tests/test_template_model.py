@@ -153,6 +153,9 @@ def test_input_output():
     assert clone.test.spectrum.main.shape.alpha.value == tm.alpha.value
     assert clone.test.spectrum.main.shape.beta.value == tm.beta.value
 
+    # The template is shared with the original
+    assert clone.test.spectrum.main.shape._template is tm._template
+
     xx = np.linspace(1, 10, 100)
 
     assert np.allclose(clone.test.spectrum.main.shape(xx), fake_model.test.spectrum.main.shape(xx))
@@ -192,6 +195,179 @@ def test_input_output():
 
     os.remove("__test.yml")
 
+def test_template_interpolation():
+
+    import scipy.interpolate
+
+    mo = get_comparison_function()
+
+    energies = np.logspace(1, 3, 30)
+
+    alpha_grid = np.linspace(-1.5, 1, 6)
+    beta_grid = np.linspace(-3.5, -1.6, 5)
+
+    fluxes = np.zeros((alpha_grid.shape[0], beta_grid.shape[0], energies.shape[0]))
+
+    for degree in (1, 3):
+
+        t = TemplateModelFactory('__test_interp', 'A test template', energies, ['alpha', 'beta'],
+                                 interpolation_degree=degree)
+
+        t.define_parameter_grid('alpha', alpha_grid)
+        t.define_parameter_grid('beta', beta_grid)
+
+        for i, a in enumerate(alpha_grid):
+
+            for j, b in enumerate(beta_grid):
+
+                mo.alpha = a
+                mo.beta = b
+
+                fluxes[i, j] = mo(energies)
+
+                t.add_interpolation_data(fluxes[i, j], alpha=a, beta=b)
+
+        t.save_data(overwrite=True)
+
+        tm = TemplateModel('__test_interp')
+
+        tm.alpha = 0.13
+        tm.beta = -2.71
+        tm.scale = 1.2
+
+        # Reference: a spline for each tabulated energy, then linear interpolation in log-log
+
+        log_spectrum = [scipy.interpolate.RectBivariateSpline(alpha_grid, beta_grid, np.log10(fluxes[:, :, k]),
+                                                              kx=degree, ky=degree)(0.13, -2.71)[0][0]
+                        for k in range(energies.shape[0])]
+
+        xx = np.logspace(0.5, 3.5, 100)
+
+        expected = 10 ** np.interp(np.log10(xx), np.log10(energies * 1.2), log_spectrum) / 1.2
+
+        assert np.allclose(tm(xx), expected, rtol=1e-10)
+
+        # Same energies, other parameters (the position among the tabulated energies is reused)
+
+        tm.alpha = -0.5
+
+        tm(xx)
+
+        assert len(tm._energy_lookups) == 1
+
+
+def test_template_storage():
+
+    import pandas as pd
+
+    from astromodels.functions import convert_hdf_template
+    from astromodels.utils.configuration import get_user_data_path
+
+    mo = get_comparison_function()
+
+    energies = np.logspace(1, 3, 20)
+
+    alpha_grid = np.linspace(-1.5, 1, 4)
+    beta_grid = np.linspace(-3.5, -1.6, 3)
+
+    fluxes = np.zeros((alpha_grid.shape[0], beta_grid.shape[0], energies.shape[0]))
+
+    for i, a in enumerate(alpha_grid):
+
+        for j, b in enumerate(beta_grid):
+
+            mo.alpha = a
+            mo.beta = b
+
+            fluxes[i, j] = mo(energies)
+
+    # A template in the HDF5 format of previous versions
+
+    base_path = os.path.join(get_user_data_path(), "__test_storage")
+
+    for extension in (".npy", ".json", ".h5"):
+
+        if os.path.exists(base_path + extension):
+
+            os.remove(base_path + extension)
+
+    multi_index = pd.MultiIndex.from_product([alpha_grid, beta_grid], names=["alpha", "beta"])
+
+    with pd.HDFStore(base_path + ".h5") as store:
+
+        pd.DataFrame(fluxes.reshape(-1, energies.shape[0]), index=multi_index, columns=energies).to_hdf(
+            store, "data_frame")
+
+        store.get_storer("data_frame").attrs.metadata = {
+            "description": "A test template",
+            "name": "__test_storage",
+            "interpolation_degree": 1,
+            "spline_smoothing_factor": 0,
+        }
+
+        store["p_0_alpha"] = pd.Series(alpha_grid)
+        store["p_1_beta"] = pd.Series(beta_grid)
+        store["energies"] = pd.Series(energies)
+
+    # It is converted on first use
+
+    tm1 = TemplateModel("__test_storage")
+
+    assert os.path.exists(base_path + ".npy") and os.path.exists(base_path + ".json")
+
+    with pytest.raises(IOError):
+
+        convert_hdf_template("__test_storage")
+
+    # The template is memory-mapped, and loaded only once per process
+
+    tm2 = TemplateModel("__test_storage")
+
+    assert tm1._template is tm2._template
+
+    assert isinstance(tm1._template.data, np.memmap)
+
+    assert np.all(tm1._template.data == fluxes)
+
+    tm1.alpha = alpha_grid[1]
+    tm1.beta = beta_grid[2]
+
+    assert np.allclose(tm1(energies), fluxes[1, 2])
+
+    # Pickles refer to the file
+
+    tm3 = pickle.loads(pickle.dumps(tm1))
+
+    assert tm3._template is tm1._template
+
+    assert np.allclose(tm3(energies), fluxes[1, 2])
+
+    # The factory writes the same format
+
+    t = TemplateModelFactory("__test_storage", "A test template", energies, ["alpha", "beta"])
+
+    t.define_parameter_grid("alpha", alpha_grid)
+    t.define_parameter_grid("beta", beta_grid)
+
+    for i, a in enumerate(alpha_grid):
+
+        for j, b in enumerate(beta_grid):
+
+            t.add_interpolation_data(fluxes[i, j] * 2, alpha=a, beta=b)
+
+    with pytest.raises(IOError):
+
+        t.save_data()
+
+    t.save_data(overwrite=True)
+
+    assert not os.path.exists(base_path + ".h5")
+
+    tm4 = TemplateModel("__test_storage")
+
+    assert np.all(tm4._template.data == fluxes * 2)
+
+
 def test_xspec_table_model():
 
     test_table = _get_data_file_path("tests/test_xspec_table_model.fits")
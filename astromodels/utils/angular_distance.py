@@ -1,6 +1,15 @@
 from __future__ import division
-from past.utils import old_div
+import collections
+
+import astropy.units as u
 import numpy as np
+from past.utils import old_div
+
+from astromodels.core.evaluation_grid import get_grid_data
+from astromodels.core.memoization import array_fingerprint
+from astromodels.utils.logging import setup_logger
+
+log = setup_logger(__name__)
 
 
 def angular_distance_fast(ra1, dec1, ra2, dec2):
@@ -83,3 +92,175 @@ def spherical_angle( ra0, dec0, ra1, dec1, ra2, dec2 ):
     denominator = np.atleast_1d( np.sin(a)*np.sin(b) )
     
     return np.where( denominator == 0 , np.zeros( len(denominator)), np.rad2deg( np.arccos( old_div(numerator,denominator))) )
+
+
+# Pixel sets smaller than this are not worth caching
+_MIN_CACHED_SIZE = 64
+
+# Maximum number of pixel sets kept in the cache (grids registered with an EvaluationGrid are cached by the grid)
+_MAX_CACHED_SETS = 8
+
+_pixel_coordinates_cache = collections.OrderedDict()
+
+# Beyond this value of the cosine (about 8 degrees from the center or from its antipode) the chord is used instead of
+# the arccos
+_COS_SMALL_ANGLE = 0.99
+
+
+class PixelCoordinates(object):
+    """
+    A fixed set of positions on the sphere (for example the pixels of a map), for which the unit vectors are
+    precomputed. Angular distances from any center can then be computed with a dot product, without evaluating
+    sines and cosines of the positions again. Use get_pixel_coordinates to reuse instances between calls.
+
+    :param lon: longitudes in degrees
+    :param lat: latitudes in degrees
+    """
+
+    def __init__(self, lon, lat):
+
+        lon = np.deg2rad(np.asarray(lon, dtype=float))
+        lat = np.deg2rad(np.asarray(lat, dtype=float))
+
+        if lon.shape != lat.shape:
+
+            log.error("lon and lat must have the same shape")
+
+            raise AssertionError()
+
+        self._shape = lon.shape
+
+        cos_lat = np.cos(lat)
+
+        self._vectors = np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1).reshape(-1, 3)
+
+        self._vectors.flags.writeable = False
+
+    @property
+    def shape(self):
+
+        return self._shape
+
+    @property
+    def unit_vectors(self):
+        """
+        The unit vectors of the positions (read-only), with shape (number of positions, 3)
+        """
+
+        return self._vectors
+
+    def angular_distance(self, lon0, lat0):
+        """
+        Returns the angular distance between each of the positions and the given center.
+
+        :param lon0: longitude of the center, in degrees
+        :param lat0: latitude of the center, in degrees
+        :return: angular distances in degrees (same shape as the positions)
+        """
+
+        center = unit_vector(lon0, lat0)
+
+        cos_distance = np.dot(self._vectors, center)
+
+        distance = np.arccos(np.clip(cos_distance, -1.0, 1.0))
+
+        # The arccos loses precision close to 0 and to 180 degrees. There we use instead the length of the chord
+        # between the two positions (or between one position and the antipode of the other)
+
+        close = np.abs(cos_distance) > _COS_SMALL_ANGLE
+
+        if np.any(close):
+
+            idx = np.flatnonzero(close)
+
+            vectors = self._vectors[idx]
+
+            this_cos = cos_distance[idx]
+
+            chord = np.linalg.norm(vectors - np.sign(this_cos)[:, np.newaxis] * center, axis=1)
+
+            small = 2.0 * np.arcsin(np.minimum(0.5 * chord, 1.0))
+
+            distance[idx] = np.where(this_cos > 0, small, np.pi - small)
+
+        return np.rad2deg(distance).reshape(self._shape)
+
+
+def unit_vector(lon, lat):
+    """
+    Returns the unit vector corresponding to the given position
+
+    :param lon: longitude in degrees
+    :param lat: latitude in degrees
+    :return: an array with 3 elements
+    """
+
+    lon = np.deg2rad(lon)
+    lat = np.deg2rad(lat)
+
+    return np.array([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def get_pixel_coordinates(lon, lat):
+    """
+    Returns a PixelCoordinates instance for the given positions. Instances are cached, so that calling this again
+    with the same positions (for example at each step of a fit) does not compute the unit vectors again.
+
+    :param lon: array of longitudes in degrees
+    :param lat: array of latitudes in degrees
+    :return: a PixelCoordinates instance
+    """
+
+    if np.size(lon) < _MIN_CACHED_SIZE:
+
+        return PixelCoordinates(lon, lat)
+
+    # Positions belonging to an EvaluationGrid are cached in the grid itself
+
+    if getattr(lon, "_grid", None) is not None and getattr(lat, "_grid", None) is lon._grid:
+
+        return get_grid_data(lon, ("pixel_coordinates",), lambda: PixelCoordinates(lon, lat))
+
+    key = array_fingerprint(np.asarray(lon), np.asarray(lat))
+
+    try:
+
+        pixel_coordinates = _pixel_coordinates_cache[key]
+
+    except KeyError:
+
+        pixel_coordinates = PixelCoordinates(lon, lat)
+
+        _pixel_coordinates_cache[key] = pixel_coordinates
+
+        if len(_pixel_coordinates_cache) > _MAX_CACHED_SETS:
+
+            _pixel_coordinates_cache.popitem(last=False)
+
+    else:
+
+        _pixel_coordinates_cache.move_to_end(key)
+
+    return pixel_coordinates
+
+
+def angular_distance_from_center(lon0, lat0, lon, lat):
+    """
+    Returns the angular distance between one center and a set of positions, like angular_distance. When the
+    positions are plain arrays and the center is a single point, the unit vectors of the positions are cached (see
+    get_pixel_coordinates), which makes repeated calls on the same positions much faster.
+
+    :param lon0: longitude of the center
+    :param lat0: latitude of the center
+    :param lon: array of longitudes
+    :param lat: array of latitudes
+    :return: angular distance(s) in degrees
+    """
+
+    if (isinstance(lon, np.ndarray) and not isinstance(lon, u.Quantity) and isinstance(lat, np.ndarray) and
+            not isinstance(lat, u.Quantity) and np.ndim(lon0) == 0 and np.ndim(lat0) == 0 and
+            not isinstance(lon0, u.Quantity) and not isinstance(lat0, u.Quantity) and lon.shape == lat.shape):
+
+        return get_pixel_coordinates(lon, lat).angular_distance(lon0, lat0)
+
+    return angular_distance(lon0, lat0, lon, lat)
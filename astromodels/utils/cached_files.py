@@ -0,0 +1,192 @@
+__author__ = "giacomov"
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, Tuple
+
+import numpy as np
+from astropy.io import fits
+
+from astromodels.utils.configuration import get_user_cache_path
+from astromodels.utils.logging import setup_logger
+
+log = setup_logger(__name__)
+
+# Large read-only inputs (template maps, tables...) are memory-mapped, so that all the processes on a node share
+# the same copy in the page cache. Data derived from a file (preprocessed arrays, fingerprints...) are computed
+# once and stored in the user cache directory, with a name depending on the path, size and modification time of the
+# file, so that they are automatically recomputed when the file changes
+
+_metadata_cache: Dict[str, Any] = {}
+
+
+def get_file_key(file_name, *extra) -> str:
+    """
+    Returns a key identifying the current version of a file (path, size and modification time), and optionally
+    some other parameters (for example the HDU or the kind of preprocessing)
+
+    :param file_name: path of the file
+    :param extra: other (string-convertible) parameters to include in the key
+    :return: a hexadecimal string
+    """
+
+    path = os.path.realpath(os.path.expandvars(os.path.expanduser(str(file_name))))
+
+    stat = os.stat(path)
+
+    h = hashlib.sha224()
+
+    h.update(repr((path, stat.st_size, stat.st_mtime_ns) + tuple(str(x) for x in extra)).encode("utf-8"))
+
+    return h.hexdigest()[:24]
+
+
+def _get_cache_file(file_name, tag, extension) -> Path:
+
+    key = get_file_key(file_name, tag)
+
+    return get_user_cache_path() / ("%s-%s.%s" % (Path(str(file_name)).stem, key, extension))
+
+
+def _write_atomically(path: Path, writer: Callable) -> None:
+
+    # Write to a temporary file and then rename it, so that other processes never see a partial file
+
+    temp_path = path.with_name("%s.%i.tmp" % (path.name, os.getpid()))
+
+    try:
+
+        with open(temp_path, "wb") as f:
+
+            writer(f)
+
+        os.replace(temp_path, path)
+
+    finally:
+
+        if temp_path.exists():
+
+            temp_path.unlink()
+
+
+def load_cached_array(file_name, tag: str, factory: Callable[[], np.ndarray]) -> np.ndarray:
+    """
+    Returns an array derived from a file, computing it with factory() and storing it in the cache directory the
+    first time. The array is memory-mapped read-only.
+
+    :param file_name: the file the array is derived from
+    :param tag: a string identifying the content of the array (it must change if the computation changes)
+    :param factory: a callable without arguments returning the array
+    :return: a read-only memory-mapped array
+    """
+
+    cache_file = _get_cache_file(file_name, tag, "npy")
+
+    if not cache_file.exists():
+
+        log.debug("Caching %s of %s in %s" % (tag, file_name, cache_file))
+
+        array = np.ascontiguousarray(factory())
+
+        _write_atomically(cache_file, lambda f: np.save(f, array))
+
+    return np.load(str(cache_file), mmap_mode="r")
+
+
+def load_cached_metadata(file_name, tag: str, factory: Callable[[], dict]) -> dict:
+    """
+    Returns a (small) dictionary derived from a file, like its fingerprint or its normalization, computing it with
+    factory() and storing it in the cache directory the first time.
+
+    :param file_name: the file the metadata are derived from
+    :param tag: a string identifying the content of the metadata
+    :param factory: a callable without arguments returning a dictionary which can be serialized in JSON
+    :return: a dictionary
+    """
+
+    cache_file = _get_cache_file(file_name, tag, "json")
+
+    try:
+
+        return _metadata_cache[str(cache_file)]
+
+    except KeyError:
+
+        pass
+
+    if cache_file.exists():
+
+        with open(cache_file) as f:
+
+            metadata = json.load(f)
+
+    else:
+
+        metadata = factory()
+
+        _write_atomically(cache_file, lambda f: f.write(json.dumps(metadata).encode("utf-8")))
+
+    _metadata_cache[str(cache_file)] = metadata
+
+    return metadata
+
+
+def open_fits_data(file_name, ihdu: int = 0) -> Tuple[fits.Header, np.ndarray]:
+    """
+    Returns the header and the data of an HDU of a FITS file. The data are memory-mapped when possible (i.e.,
+    when they do not need scaling) and are read-only in any case.
+
+    :param file_name: path of the FITS file
+    :param ihdu: index of the HDU
+    :return: (header, data)
+    """
+
+    with fits.open(file_name, memmap=True) as f:
+
+        header = f[ihdu].header.copy()
+
+        data = f[ihdu].data
+
+    data = data.view(np.ndarray)
+
+    data.flags.writeable = False
+
+    return header, data
+
+
+def get_array_fingerprint(array: np.ndarray, *extra) -> int:
+    """
+    Returns a hash of the content of an array (and optionally of other string-convertible objects), as an integer
+
+    :param array: the array
+    :param extra: other objects to include
+    :return: an integer
+    """
+
+    h = hashlib.sha224()
+
+    h.update(np.ascontiguousarray(array))
+
+    for x in extra:
+
+        h.update(str(x).encode("utf-8"))
+
+    return int(h.hexdigest(), 16)
+
+
+def clear_cache() -> None:
+    """
+    Remove all the files in the cache directory (they are re-created when needed)
+
+    :return: none
+    """
+
+    _metadata_cache.clear()
+
+    for path in get_user_cache_path().iterdir():
+
+        if path.suffix in (".npy", ".json"):
+
+            path.unlink()
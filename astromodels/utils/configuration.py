@@ -1,7 +1,11 @@
 # This file contains some defaults, like locations of files, which should not
 # change much but benefits anyway of being in one central location
 
+import contextlib
+import os
+import threading
 from pathlib import Path
+from typing import Optional
 
 
 def get_user_path():
@@ -27,3 +31,163 @@ def get_user_data_path():
 
     return user_data
 
+
+
+def get_user_cache_path():
+
+    user_cache = get_user_path() / "cache"
+
+    # Create it if doesn't exist
+    if not user_cache.exists():
+
+        user_cache.mkdir(parents=True)
+
+    return user_cache
+
+
+# Execution policy of the numba kernels of astromodels (see astromodels.functions.numba_functions.kernel). The
+# defaults can be changed with environment variables:
+#
+# ASTROMODELS_NUMBA_PARALLEL: "1" to run the kernels in parallel (default: "0")
+# ASTROMODELS_NUMBA_FASTMATH: "0" for strict IEEE math (default: "1", i.e., fastmath)
+# ASTROMODELS_NUMBA_THREADS: number of threads used by the parallel kernels (default: the number of threads of
+#                            numba, see numba.set_num_threads)
+# ASTROMODELS_NUMBA_THREADING_LAYER: threading layer of numba ("default", "safe", "threadsafe", "forksafe", "tbb",
+#                                    "omp" or "workqueue". Default: not changed)
+
+_TRUE_VALUES = ("1", "true", "yes", "on")
+_FALSE_VALUES = ("0", "false", "no", "off")
+
+
+def _get_bool_from_environment(name, default):
+
+    value = os.environ.get(name, None)
+
+    if value is None:
+
+        return default
+
+    if value.lower() in _TRUE_VALUES:
+
+        return True
+
+    elif value.lower() in _FALSE_VALUES:
+
+        return False
+
+    raise ValueError("Invalid value %s for the environment variable %s (use 0 or 1)" % (value, name))
+
+
+def _get_int_from_environment(name):
+
+    value = os.environ.get(name, None)
+
+    return None if value is None else int(value)
+
+
+_numba_policy = {
+    "parallel": _get_bool_from_environment("ASTROMODELS_NUMBA_PARALLEL", False),
+    "fastmath": _get_bool_from_environment("ASTROMODELS_NUMBA_FASTMATH", True),
+    "n_threads": _get_int_from_environment("ASTROMODELS_NUMBA_THREADS"),
+    "threading_layer": os.environ.get("ASTROMODELS_NUMBA_THREADING_LAYER", None),
+}
+
+# Overrides valid only for the current thread (for example, serial kernels in the workers of a pool)
+_thread_policy = threading.local()
+
+
+def get_numba_policy() -> dict:
+    """
+    Returns the current execution policy of the numba kernels, as a dictionary with the keys 'parallel' (bool),
+    'fastmath' (bool), 'n_threads' (int or None) and 'threading_layer' (str or None)
+
+    :return: a dictionary
+    """
+
+    policy = dict(_numba_policy)
+
+    policy.update(getattr(_thread_policy, "overrides", {}))
+
+    return policy
+
+
+def _check_numba_policy(parallel, fastmath, n_threads, threading_layer):
+
+    overrides = {}
+
+    if parallel is not None:
+
+        overrides["parallel"] = bool(parallel)
+
+    if fastmath is not None:
+
+        overrides["fastmath"] = bool(fastmath)
+
+    if n_threads is not None:
+
+        if int(n_threads) < 1:
+
+            raise ValueError("The number of threads must be positive")
+
+        overrides["n_threads"] = int(n_threads)
+
+    if threading_layer is not None:
+
+        overrides["threading_layer"] = str(threading_layer)
+
+    return overrides
+
+
+def set_numba_policy(parallel: Optional[bool] = None, fastmath: Optional[bool] = None,
+                     n_threads: Optional[int] = None, threading_layer: Optional[str] = None) -> None:
+    """
+    Set the execution policy of the numba kernels of astromodels. Arguments left to None are not changed. The
+    kernels are compiled (and cached on disk) separately for each combination of parallel and fastmath.
+
+    :param parallel: whether to run the kernels in parallel
+    :param fastmath: whether to allow fast (non IEEE-compliant) math
+    :param n_threads: number of threads used by the parallel kernels (the number of threads of numba is changed
+    only during their execution)
+    :param threading_layer: threading layer of numba (this changes numba.config.THREADING_LAYER). It can only be
+    changed before the first parallel kernel is executed
+    :return: none
+    """
+
+    _numba_policy.update(_check_numba_policy(parallel, fastmath, n_threads, threading_layer))
+
+    if threading_layer is not None:
+
+        import numba
+
+        numba.config.THREADING_LAYER = str(threading_layer)
+
+
+@contextlib.contextmanager
+def numba_policy(parallel: Optional[bool] = None, fastmath: Optional[bool] = None, n_threads: Optional[int] = None):
+    """
+    A context manager changing the execution policy of the numba kernels (see set_numba_policy) only for the
+    current thread, and only within the context. For example:
+
+    > with numba_policy(fastmath=False):
+    >     values = model.get_point_source_fluxes(0, energies)
+
+    :param parallel: whether to run the kernels in parallel
+    :param fastmath: whether to allow fast (non IEEE-compliant) math
+    :param n_threads: number of threads used by the parallel kernels
+    """
+
+    old_overrides = getattr(_thread_policy, "overrides", {})
+
+    new_overrides = dict(old_overrides)
+
+    new_overrides.update(_check_numba_policy(parallel, fastmath, n_threads, None))
+
+    _thread_policy.overrides = new_overrides
+
+    try:
+
+        yield
+
+    finally:
+
+        _thread_policy.overrides = old_overrides
@@ -0,0 +1,330 @@
+__author__ = "giacomov"
+
+import functools
+
+import numpy as np
+
+from astromodels.utils.logging import setup_logger
+
+log = setup_logger(__name__)
+
+# A minimal implementation of the HEALPix pixelization (Gorski et al. 2005, ApJ 622, 759), in the RING and in the
+# NESTED schemes, to evaluate models on HEALPix maps without external dependencies. Coordinates are longitude and
+# latitude in degrees.
+
+# Position of the 12 base pixels (faces), as ring and azimuth indexes of their southernmost corner
+_JRLL = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+_JPLL = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
+
+
+def _check_nside(nside):
+
+    nside = int(nside)
+
+    if nside < 1 or (nside & (nside - 1)) != 0 or nside > 2 ** 29:
+
+        log.error("nside must be a power of 2 (got %s)" % nside)
+
+        raise AssertionError()
+
+    return nside
+
+
+def nside2npix(nside: int) -> int:
+    """
+    Number of pixels of a map with the given nside
+
+    :param nside: the nside (a power of 2)
+    :return: 12 * nside ** 2
+    """
+
+    return 12 * _check_nside(nside) ** 2
+
+
+def nside2resolution(nside: int) -> float:
+    """
+    Approximate size of a pixel (square root of its area)
+
+    :param nside: the nside
+    :return: size in degrees
+    """
+
+    return np.rad2deg(np.sqrt(4 * np.pi / nside2npix(nside)))
+
+
+def _order(nside):
+
+    return int(nside).bit_length() - 1
+
+
+def _deinterleave(ipf, order):
+
+    ix = np.zeros_like(ipf)
+    iy = np.zeros_like(ipf)
+
+    for bit in range(order):
+
+        ix |= ((ipf >> (2 * bit)) & 1) << bit
+        iy |= ((ipf >> (2 * bit + 1)) & 1) << bit
+
+    return ix, iy
+
+
+def _interleave(ix, iy, order):
+
+    ipf = np.zeros_like(ix)
+
+    for bit in range(order):
+
+        ipf |= ((ix >> bit) & 1) << (2 * bit)
+        ipf |= ((iy >> bit) & 1) << (2 * bit + 1)
+
+    return ipf
+
+
+@functools.lru_cache(maxsize=32)
+def _get_rings(nside):
+
+    # Geometry of the 4 * nside - 1 iso-latitude rings: z = cos(colatitude), index of the first pixel (RING scheme),
+    # number of pixels and azimuth of the first pixel (in units of the azimuthal spacing)
+
+    npix = 12 * nside ** 2
+    ncap = 2 * nside * (nside - 1)
+
+    i = np.arange(1, 4 * nside, dtype=np.int64)
+
+    z = np.empty(i.shape[0])
+    start = np.empty(i.shape[0], dtype=np.int64)
+    n_pixels = np.empty(i.shape[0], dtype=np.int64)
+    shift = np.full(i.shape[0], 0.5)
+
+    north = i < nside
+    south = i > 3 * nside
+    equator = ~(north | south)
+
+    z[north] = 1.0 - i[north] ** 2 / (3.0 * nside ** 2)
+    start[north] = 2 * i[north] * (i[north] - 1)
+    n_pixels[north] = 4 * i[north]
+
+    z[equator] = 4.0 / 3.0 - 2.0 * i[equator] / (3.0 * nside)
+    start[equator] = ncap + (i[equator] - nside) * 4 * nside
+    n_pixels[equator] = 4 * nside
+    shift[equator] = np.where((i[equator] + nside) % 2 == 1, 1.0, 0.5)
+
+    ii = 4 * nside - i[south]
+
+    z[south] = -1.0 + ii ** 2 / (3.0 * nside ** 2)
+    start[south] = npix - 2 * ii * (ii + 1)
+    n_pixels[south] = 4 * ii
+
+    for array in (z, start, n_pixels, shift):
+
+        array.flags.writeable = False
+
+    return z, start, n_pixels, shift
+
+
+def _ring2ang(nside, pixels):
+
+    z, start, n_pixels, shift = _get_rings(nside)
+
+    ring = np.searchsorted(start, pixels, side="right") - 1
+
+    j = pixels - start[ring] + 1
+
+    phi = (j - shift[ring]) * 2 * np.pi / n_pixels[ring]
+
+    return np.rad2deg(phi), np.rad2deg(np.arcsin(z[ring]))
+
+
+def _nest2ang(nside, pixels):
+
+    face = pixels // (nside * nside)
+
+    ix, iy = _deinterleave(pixels % (nside * nside), _order(nside))
+
+    jr = _JRLL[face] * nside - ix - iy - 1
+
+    nr = np.full(pixels.shape[0], nside, dtype=np.int64)
+    z = (2 * nside - jr) * 2.0 / (3.0 * nside)
+    kshift = (jr - nside) & 1
+
+    north = jr < nside
+    south = jr > 3 * nside
+
+    nr[north] = jr[north]
+    z[north] = 1.0 - nr[north] ** 2 / (3.0 * nside ** 2)
+    kshift[north] = 0
+
+    nr[south] = 4 * nside - jr[south]
+    z[south] = -1.0 + nr[south] ** 2 / (3.0 * nside ** 2)
+    kshift[south] = 0
+
+    jp = (_JPLL[face] * nr + ix - iy + 1 + kshift) // 2
+
+    jp = np.where(jp > 4 * nr, jp - 4 * nr, jp)
+    jp = np.where(jp < 1, jp + 4 * nr, jp)
+
+    phi = (jp - (kshift + 1) * 0.5) * (np.pi / 2.0 / nr)
+
+    return np.rad2deg(phi), np.rad2deg(np.arcsin(z))
+
+
+def _ang2nest(nside, lon, lat):
+
+    z = np.sin(np.deg2rad(lat))
+    za = np.abs(z)
+
+    tt = (np.deg2rad(lon) % (2 * np.pi)) * 2.0 / np.pi
+
+    face = np.empty(z.shape[0], dtype=np.int64)
+    ix = np.empty(z.shape[0], dtype=np.int64)
+    iy = np.empty(z.shape[0], dtype=np.int64)
+
+    # Equatorial region
+
+    eq = za <= 2.0 / 3.0
+
+    temp1 = nside * (0.5 + tt[eq])
+    temp2 = nside * z[eq] * 0.75
+
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+
+    ifp = jp // nside
+    ifm = jm // nside
+
+    face[eq] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix[eq] = jm & (nside - 1)
+    iy[eq] = nside - (jp & (nside - 1)) - 1
+
+    # Polar caps
+
+    cap = ~eq
+
+    ntt = np.minimum(tt[cap].astype(np.int64), 3)
+    tp = tt[cap] - ntt
+    tmp = nside * np.sqrt(3 * (1 - za[cap]))
+
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1.0 - tp) * tmp).astype(np.int64), nside - 1)
+
+    north = z[cap] >= 0
+
+    face[cap] = np.where(north, ntt, ntt + 8)
+    ix[cap] = np.where(north, nside - jm - 1, jp)
+    iy[cap] = np.where(north, nside - jp - 1, jm)
+
+    return face * nside * nside + _interleave(ix, iy, _order(nside))
+
+
+def pix2ang(nside: int, pixels, nest: bool = False):
+    """
+    Returns the coordinates of the centers of the given pixels
+
+    :param nside: the nside of the map
+    :param pixels: indexes of the pixels
+    :param nest: True for the NESTED scheme, False (default) for the RING scheme
+    :return: (longitudes, latitudes) in degrees
+    """
+
+    nside = _check_nside(nside)
+
+    pixels = np.array(pixels, dtype=np.int64, ndmin=1)
+
+    if nest:
+
+        return _nest2ang(nside, pixels)
+
+    return _ring2ang(nside, pixels)
+
+
+def ring2nest(nside: int, pixels) -> np.ndarray:
+    """
+    Converts pixel indexes from the RING to the NESTED scheme
+
+    :param nside: the nside of the map
+    :param pixels: indexes in the RING scheme
+    :return: indexes in the NESTED scheme
+    """
+
+    lon, lat = pix2ang(nside, pixels, nest=False)
+
+    return _ang2nest(_check_nside(nside), lon, lat)
+
+
+def query_box(nside: int, lon_range, lat_range, margin: float = 0.0, nest: bool = False) -> np.ndarray:
+    """
+    Returns the pixels whose center is within a box in longitude and latitude, enlarged by margin degrees on all
+    sides. Longitude ranges with minimum larger than maximum cross longitude 0. Only the rings crossing the box
+    are looked at, and on each ring only the range of pixels within the longitude range, so the cost is
+    proportional to the size of the box.
+
+    :param nside: the nside of the map
+    :param lon_range: (minimum longitude, maximum longitude) in degrees
+    :param lat_range: (minimum latitude, maximum latitude) in degrees
+    :param margin: margin in degrees (default: 0)
+    :param nest: True for the NESTED scheme, False (default) for the RING scheme
+    :return: sorted array of pixel indexes
+    """
+
+    nside = _check_nside(nside)
+
+    z, start, n_pixels, shift = _get_rings(nside)
+
+    lat_min = lat_range[0] - margin
+    lat_max = lat_range[1] + margin
+
+    full_lon = lon_range[1] - lon_range[0] >= 360.0
+
+    lon_min = lon_range[0] % 360.0
+    lon_width = (lon_range[1] - lon_range[0]) % 360.0
+
+    ring_lat = np.rad2deg(np.arcsin(z))
+
+    selected = []
+
+    for ring in np.flatnonzero((ring_lat >= lat_min) & (ring_lat <= lat_max)):
+
+        # Maximum difference in longitude corresponding to the margin on this ring
+
+        max_lat = min(abs(ring_lat[ring]) + margin, 90.0)
+
+        cos_lat = np.cos(np.deg2rad(max_lat))
+
+        if full_lon or cos_lat <= 1e-8 or lon_width + 2 * margin / cos_lat >= 360.0:
+
+            selected.append(start[ring] + np.arange(n_pixels[ring]))
+
+            continue
+
+        lon_margin = margin / cos_lat
+
+        # The pixel j of the ring is at longitude (j + 1 - shift) * step, so the pixels within the longitude range
+        # are (modulo the number of pixels) those from first to last. One more pixel is looked at on each side, to
+        # be robust against round-off, and the exact condition is then applied
+
+        step = 360.0 / n_pixels[ring]
+
+        first = int(np.ceil((lon_min - lon_margin) / step - 1 + shift[ring])) - 1
+        last = int(np.floor((lon_min - lon_margin + lon_width + 2 * lon_margin) / step - 1 + shift[ring])) + 1
+
+        j = np.arange(first, min(last, first + n_pixels[ring] - 1) + 1) % n_pixels[ring]
+
+        lon = np.rad2deg((j + 1 - shift[ring]) * 2 * np.pi / n_pixels[ring])
+
+        distance = (lon - (lon_min - lon_margin)) % 360.0
+
+        selected.append(start[ring] + np.sort(j[distance <= lon_width + 2 * lon_margin]))
+
+    if not selected:
+
+        return np.zeros(0, dtype=np.int64)
+
+    pixels = np.concatenate(selected)
+
+    if nest:
+
+        return np.sort(_ang2nest(nside, *_ring2ang(nside, pixels)))
+
+    return pixels
@@ -0,0 +1,171 @@
+__author__ = "giacomov"
+
+import numpy as np
+
+from astromodels.utils.logging import setup_logger
+
+log = setup_logger(__name__)
+
+# Nodes and weights of the 15-point Kronrod rule and of the embedded 7-point Gauss rule (as in QUADPACK). Only the
+# non-negative nodes are listed, the rules are symmetric
+
+_XGK = np.array([
+    0.991455371120812639206854697526329,
+    0.949107912342758524526189684047851,
+    0.864864423359769072789712788640926,
+    0.741531185599394439863864773280788,
+    0.586087235467691130294144845693013,
+    0.405845151377397166906606412076961,
+    0.207784955007898467600689403773245,
+    0.000000000000000000000000000000000,
+])
+
+_WGK = np.array([
+    0.022935322010529224963732008058970,
+    0.063092092629978553290700663189204,
+    0.104790010322250183839876322541518,
+    0.140653259715525918745189590510238,
+    0.169004726639267902826583426598550,
+    0.190350578064785409913256402421014,
+    0.204432940075298892414161999234649,
+    0.209482141084727828012999174891714,
+])
+
+# Weights of the Gauss rule, for the nodes _XGK[1], _XGK[3], _XGK[5] and _XGK[7]
+_WG = np.array([
+    0.129484966168869693270611432679082,
+    0.279705391489276667901467771423780,
+    0.381830050505118944950369775488975,
+    0.417959183673469387755102040816327,
+])
+
+# All the 15 nodes in [-1, 1], with the corresponding weights of the two rules
+_NODES = np.concatenate([-_XGK[:-1], _XGK[::-1]])
+_KRONROD_WEIGHTS = np.concatenate([_WGK[:-1], _WGK[::-1]])
+_GAUSS_WEIGHTS = np.zeros(15)
+_GAUSS_WEIGHTS[[1, 3, 5, 7, 9, 11, 13]] = np.concatenate([_WG, _WG[-2::-1]])
+
+INTEGRATION_METHODS = ("gauss_kronrod", "gauss_legendre")
+
+
+def _gauss_kronrod(f, a, b):
+
+    # Integral estimate (15-point rule) and error estimate (difference with the 7-point rule) on [a, b]
+
+    half_length = 0.5 * (b - a)
+    center = 0.5 * (a + b)
+
+    values = np.array([f(center + half_length * node) for node in _NODES])
+
+    kronrod = half_length * np.dot(_KRONROD_WEIGHTS, values)
+    gauss = half_length * np.dot(_GAUSS_WEIGHTS, values)
+
+    return kronrod, np.abs(kronrod - gauss)
+
+
+def _get_tolerance(integral, epsabs, epsrel):
+
+    return np.maximum(epsabs, epsrel * np.abs(integral))
+
+
+def _adaptive_gauss_kronrod(f, a, b, epsabs, epsrel, limit):
+
+    intervals = [(a, b) + _gauss_kronrod(f, a, b)]
+
+    while True:
+
+        integral = sum(interval[2] for interval in intervals)
+        error = sum(interval[3] for interval in intervals)
+
+        tolerance = _get_tolerance(integral, epsabs, epsrel)
+
+        if np.all(error <= tolerance):
+
+            return integral
+
+        if len(intervals) >= limit:
+
+            log.warning("The maximum number of subdivisions (%i) has been reached in the integration between %s "
+                        "and %s. The result might not be accurate." % (limit, a, b))
+
+            return integral
+
+        # Bisect the interval contributing most to the error, relatively to the tolerance, for any of the outputs
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+
+            scores = [np.max(np.where(tolerance > 0, interval[3] / tolerance, np.where(interval[3] > 0, np.inf, 0)))
+                      for interval in intervals]
+
+        this_a, this_b, _, _ = intervals.pop(int(np.argmax(scores)))
+
+        midpoint = 0.5 * (this_a + this_b)
+
+        intervals.append((this_a, midpoint) + _gauss_kronrod(f, this_a, midpoint))
+        intervals.append((midpoint, this_b) + _gauss_kronrod(f, midpoint, this_b))
+
+
+def _gauss_legendre(f, a, b, epsabs, epsrel, limit):
+
+    # Fixed-order rules with an increasing number of nodes, until two successive estimates agree
+
+    previous = None
+
+    n_nodes = 8
+
+    while True:
+
+        nodes, weights = np.polynomial.legendre.leggauss(n_nodes)
+
+        values = np.array([f(0.5 * (b - a) * node + 0.5 * (a + b)) for node in nodes])
+
+        integral = 0.5 * (b - a) * np.dot(weights, values)
+
+        if previous is not None and np.all(np.abs(integral - previous) <= _get_tolerance(integral, epsabs, epsrel)):
+
+            return integral
+
+        if n_nodes >= limit:
+
+            log.warning("The maximum number of nodes (%i) has been reached in the integration between %s "
+                        "and %s. The result might not be accurate." % (limit, a, b))
+
+            return integral
+
+        previous = integral
+
+        n_nodes *= 2
+
+
+def integrate_vectorized(f, a, b, epsabs=0.0, epsrel=1e-5, method="gauss_kronrod", limit=None):
+    """
+    Integrates a function returning an array (for example, a spectrum evaluated on a grid of energies as a function
+    of time) between a and b, for all its outputs at once. The function is called with one value of the
+    integration variable at a time. The integration stops when the estimated error is below the tolerance for all
+    the outputs.
+
+    :param f: the function, taking a float and returning an array (always of the same shape)
+    :param a: lower bound of the integration
+    :param b: upper bound of the integration
+    :param epsabs: absolute tolerance (default: 0)
+    :param epsrel: relative tolerance (default: 1e-5)
+    :param method: either "gauss_kronrod" (adaptive 7-15 points Gauss-Kronrod rule, the default) or "gauss_legendre"
+    (Gauss-Legendre rule, doubling the number of nodes until convergence)
+    :param limit: maximum number of sub-intervals for "gauss_kronrod" (default: 50), or of nodes for
+    "gauss_legendre" (default: 256)
+    :return: the array of integrals
+    """
+
+    if method == "gauss_kronrod":
+
+        return _adaptive_gauss_kronrod(f, a, b, epsabs, epsrel, 50 if limit is None else limit)
+
+    elif method == "gauss_legendre":
+
+        return _gauss_legendre(f, a, b, epsabs, epsrel, 256 if limit is None else limit)
+
+    else:
+
+        log.error("Unknown integration method %s. Valid methods are: %s" % (method, ",".join(INTEGRATION_METHODS)))
+
+        raise AssertionError()
@@ -374,12 +374,38 @@ def get_models(model_dat_path):
 
 class_definition_code = '''
 
+from astromodels.core.evaluation_grid import get_grid_data
 from astromodels.functions.function import FunctionMeta, Function1D
 import numpy as np
 import astropy.units as u
 from astromodels.xspec import _xspec
 import six
 
+
+def _sort_energies(x):
+
+    # We need to make sure that the energy array is sorted because otherwise some Xspec models will give
+    # incorrect values
+    idx = np.argsort(x)
+
+    # This is needed to be able to "reverse" the sort operation
+    rev_idx = np.argsort(idx)
+
+    # Ordered input vector
+
+    xx = np.asarray(x)[idx]
+
+    return idx, rev_idx, xx
+
+
+def _get_bins(xx, scale):
+
+    # Adapt the epsilon to the value to reduce the error
+
+    epsilon = xx / scale
+
+    return epsilon, xx - epsilon, xx + epsilon
+
 # These are multiplicative functions which need numerical differentiation
 _force_differentiation = ['XS_gabs', 'XS_expfac', 'XS_plabs', 'XS_pwab',
                           'XS_spline', 'XS_swind1', 'XS_xion', 'XS_zxipcf',
@@ -444,16 +470,9 @@ $DOCSTRING$
 
             parameters_tuple = ($PARAMETERS_NAMES$,)
         
-        # We need to make sure that the energy array is sorted because otherwise some Xspec models will give
-        # incorrect values
-        idx = np.argsort(x)
-        
-        # This is needed to be able to "reverse" the sort operation
-        rev_idx = np.argsort(idx)
-        
-        # Ordered input vector
-        
-        xx = x[idx]
+        # On the energies of an EvaluationGrid the sorting (and the bins below) are computed only once
+
+        idx, rev_idx, xx = get_grid_data(x, ("xspec_sort",), lambda: _sort_energies(x))
         
         if self._differentiate:
 
@@ -462,9 +481,7 @@ $DOCSTRING$
             # of the function on energy ranges, while we need the
             # differential flux.
 
-            # Adapt the epsilon to the value to reduce the error
-
-            epsilon = xx / self._scale
+            epsilon, lower, upper = get_grid_data(x, ("xspec_bins", self._scale), lambda: _get_bins(xx, self._scale))
 
             # In the normal case, when x is an array of more than one
             # element, the first call will succeed. If however there
@@ -473,13 +490,13 @@ $DOCSTRING$
 
             try:
 
-                val = self._model(parameters_tuple, xx - epsilon, xx + epsilon)
+                val = self._model(parameters_tuple, lower, upper)
 
             except TypeError:
 
                 assert xx.shape[0]==1, "This is a bug, xspec call failed and x is not only one element"
 
-                val = np.array(self._model(parameters_tuple, ((xx - epsilon)[0], (xx + epsilon)[0]))[0], ndmin=1)
+                val = np.array(self._model(parameters_tuple, (lower[0], upper[0]))[0], ndmin=1)
             
             if self._model_type == 'add':
             